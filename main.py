@@ -1,12 +1,23 @@
+import argparse
 import logging
 import logging.config
 import os
 import sys
+import time
 
 import sentry_sdk
 
 from mtp_transaction_uploader import settings
-from mtp_transaction_uploader.upload import main as transaction_uploader
+from mtp_transaction_uploader.governor import APIUnavailableError
+from mtp_transaction_uploader.metrics import record_run, start_metrics_server
+from mtp_transaction_uploader.tracing import TraceFileTransport
+from mtp_transaction_uploader.pipeline import main as pipelined_transaction_uploader
+from mtp_transaction_uploader.profiling import start_profiling, stop_profiling
+from mtp_transaction_uploader.upload import (
+    main as transaction_uploader, reconcile_upload_watermark, replay_dead_letters, replay_quarantined_records,
+    reset_upload_watermark,
+)
+from mtp_transaction_uploader.watch import watch_drop_directory
 
 
 def setup_monitoring():
@@ -44,23 +55,57 @@ def setup_monitoring():
             },
         },
     }
-    sentry_enabled = False
-    if os.environ.get('SENTRY_DSN'):
+    sentry_enabled = bool(os.environ.get('SENTRY_DSN'))
+    if sentry_enabled or settings.SENTRY_TRACES_FILE:
         sentry_sdk.init(
             dsn=settings.SENTRY_DSN,
             environment=settings.ENVIRONMENT,
             release=settings.APP_GIT_COMMIT,
             send_default_pii=False,
             max_request_body_size='never',
+            traces_sample_rate=settings.SENTRY_TRACES_SAMPLE_RATE,
         )
-        sentry_enabled = True
+        if settings.SENTRY_TRACES_FILE:
+            # errors still go to Sentry if a DSN is set, only traces are diverted to the file
+            client = sentry_sdk.get_client()
+            client.transport = TraceFileTransport(settings.SENTRY_TRACES_FILE, forward_to=client.transport)
     logging.config.dictConfig(logging_conf)
     logger = logging.getLogger('mtp')
 
     return logger, sentry_enabled
 
 
+def upload():
+    if settings.ASYNC_PIPELINE:
+        pipelined_transaction_uploader()
+    else:
+        transaction_uploader()
+
+
+COMMANDS = {
+    'upload': upload,
+    'replay': replay_dead_letters,
+    'replay-quarantine': replay_quarantined_records,
+    'watch': watch_drop_directory,
+    'reconcile-watermark': reconcile_upload_watermark,
+    'reset-watermark': reset_upload_watermark,
+}
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Uploads transactions from bank files to the API')
+    parser.add_argument(
+        'command', nargs='?', choices=COMMANDS, default='upload',
+        help='upload new files (default), replay spooled transactions that failed to upload, '
+             'replay quarantined records, watch WATCH_DIR for new files '
+             'or reconcile or reset the upload watermark',
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='profile CPU time and memory allocations of each file and write reports to PROFILE_REPORTS_DIR',
+    )
+    args = parser.parse_args()
+
     logger, sentry_enabled = setup_monitoring()
 
     if settings.UPLOADER_DISABLED:
@@ -80,15 +125,30 @@ def main():
                      ', '.join(missing_params))
         sys.exit(1)
 
+    start_metrics_server()
+    if args.profile:
+        start_profiling(settings.PROFILE_REPORTS_DIR)
+    start_time = time.monotonic()
     try:
         # run the transaction uploader
-        transaction_uploader()
+        with sentry_sdk.start_transaction(op=f'uploader.{args.command}', name=f'{args.command.title()} transactions'):
+            COMMANDS[args.command]()
+        record_run(time.monotonic() - start_time, success=True)
+    except APIUnavailableError as e:
+        record_run(time.monotonic() - start_time, success=False)
+        logger.error('Stopped because the API is unavailable: %s', e)
+        if sentry_enabled:
+            sentry_sdk.capture_exception(e)
+        sys.exit(2)
     except Exception as e:
+        record_run(time.monotonic() - start_time, success=False)
         if sentry_enabled:
             sentry_sdk.capture_exception(e)
         else:
             logger.exception('Unhandled error')
         sys.exit(2)
+    finally:
+        stop_profiling()
 
 
 if __name__ == '__main__':
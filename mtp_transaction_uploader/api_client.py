@@ -6,6 +6,7 @@ from requests_oauthlib import OAuth2Session
 import slumber
 
 from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.governor import get_api_governor, GovernedHTTPAdapter
 
 REQUEST_TOKEN_URL = urljoin(settings.API_URL, '/oauth2/token/')
 
@@ -20,6 +21,8 @@ def get_authenticated_connection():
             client_id=settings.API_CLIENT_ID
         )
     )
+    # all requests are rate-limited and retried by the shared governor
+    session.mount(settings.API_URL, GovernedHTTPAdapter(get_api_governor()))
 
     session.fetch_token(
         token_url=REQUEST_TOKEN_URL,
@@ -0,0 +1,215 @@
+from collections import namedtuple
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.files import atomic_write
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+ArchivedFile = namedtuple(
+    'ArchivedFile',
+    ['filename', 'date', 'account_code', 'sha256', 'size', 'mtime', 'compressed_size', 'archived_at'],
+)
+
+_file_archive = SharedInstance()
+
+
+def get_file_archive():
+    """
+    Returns:
+        the shared FileArchive kept in ARCHIVE_DIR or, failing that, a short-lived one in DOWNLOAD_CACHE_DIR
+        used only so that retries do not download files again; None if neither is set.
+        ARCHIVE_DIR takes precedence and DOWNLOAD_CACHE_DIR is ignored if both are set
+    """
+    if settings.ARCHIVE_DIR:
+        def create_archive():
+            if settings.DOWNLOAD_CACHE_DIR:
+                logger.warning('DOWNLOAD_CACHE_DIR is not used because ARCHIVE_DIR is set and serves as the cache')
+            return FileArchive(
+                settings.ARCHIVE_DIR,
+                max_bytes=settings.ARCHIVE_MAX_BYTES,
+                max_age=settings.ARCHIVE_MAX_AGE_DAYS * 24 * 60 * 60,
+            )
+
+        return _file_archive.get(('archive', settings.ARCHIVE_DIR), create_archive)
+    if settings.DOWNLOAD_CACHE_DIR:
+        return _file_archive.get(('cache', settings.DOWNLOAD_CACHE_DIR), lambda: FileArchive(
+            settings.DOWNLOAD_CACHE_DIR,
+            max_bytes=settings.DOWNLOAD_CACHE_MAX_BYTES,
+            max_age=settings.DOWNLOAD_CACHE_MAX_AGE_DAYS * 24 * 60 * 60,
+            name='cache',
+        ))
+    return None
+
+
+class FileArchive:
+    """
+    Keeps gzipped copies of data services files so that they can be uploaded again, audited or benchmarked
+    without downloading them from the SFTP server. Contents are stored by sha256 in `objects/`
+    and indexed by file name in `index.json` with their date, account code, size and modification time.
+    The same store serves as a download cache with shorter retention; `name` labels where files were read from.
+    """
+
+    def __init__(self, directory, max_bytes, max_age, name='archive'):
+        self.directory = directory
+        self.objects_dir = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.index = self._load_index()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def log_stats(self):
+        logger.info(
+            'File %s: %d hits, %d misses, %d evictions', self.name, self.hits, self.misses, self.evictions,
+            extra={
+                'elk_fields': {
+                    f'@fields.file_{self.name}_{name}': value
+                    for name, value in self.stats.items()
+                },
+            },
+        )
+
+    def add(self, remote_file, account_code, source_file):
+        """
+        Compresses the contents of the readable binary file object into the archive
+        Returns:
+            the ArchivedFile
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        with atomic_write(lambda: self._object_path(sha256.hexdigest()), 'wb', directory=self.objects_dir) as temp_file:
+            with gzip.open(temp_file, 'wb') as f:
+                while chunk := source_file.read(settings.DOWNLOAD_CHUNK_SIZE_BYTES):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        self.index[remote_file.filename] = {
+            'date': remote_file.date.isoformat(),
+            'account_code': account_code,
+            'sha256': sha256.hexdigest(),
+            'size': size,
+            'mtime': remote_file.mtime,
+            'compressed_size': os.path.getsize(self._object_path(sha256.hexdigest())),
+            'archived_at': time.time(),
+        }
+        # the file just added is kept even if it is larger than the maximum size on its own
+        self.enforce_policy(keep=remote_file.filename)
+        self._save_index()
+        return self._get_archived_file(remote_file.filename)
+
+    def get(self, remote_file):
+        """
+        Returns:
+            the ArchivedFile for the remote file or None if it is not archived or has since changed
+        """
+        entry = self.index.get(remote_file.filename)
+        if not entry or entry['size'] != remote_file.size or entry['mtime'] != remote_file.mtime:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self._get_archived_file(remote_file.filename)
+
+    def discard(self, archived_file):
+        """
+        Removes a file whose archived copy failed its integrity check
+        """
+        if archived_file.filename in self.index:
+            self._remove(archived_file.filename)
+            self._save_index()
+
+    def find(self, date=None, account_code=None, sha256=None):
+        """
+        Returns:
+            ArchivedFile tuples matching all the given criteria in date order
+        """
+        archived_files = []
+        for filename in self.index:
+            archived_file = self._get_archived_file(filename)
+            if date and archived_file.date != date:
+                continue
+            if account_code and archived_file.account_code != account_code:
+                continue
+            if sha256 and archived_file.sha256 != sha256:
+                continue
+            archived_files.append(archived_file)
+        return sorted(archived_files, key=lambda archived_file: (archived_file.date, archived_file.filename))
+
+    def open(self, archived_file, binary=False):
+        return gzip.open(self._object_path(archived_file.sha256), 'rb' if binary else 'rt')
+
+    def extract(self, archived_file, target_file):
+        """
+        Decompresses an archived file into the writable binary file object, checking its hash
+        """
+        sha256 = hashlib.sha256()
+        with self.open(archived_file, binary=True) as f:
+            while chunk := f.read(settings.DOWNLOAD_CHUNK_SIZE_BYTES):
+                sha256.update(chunk)
+                target_file.write(chunk)
+        if sha256.hexdigest() != archived_file.sha256:
+            raise IOError(f'Archived copy of {archived_file.filename} failed integrity check')
+
+    def enforce_policy(self, keep=None):
+        """
+        Removes files archived longer ago than the maximum age and then the oldest until the archive fits
+        its maximum compressed size, except for the file named `keep`
+        """
+        now = time.time()
+        entries_by_age = sorted(self.index.items(), key=lambda item: item[1]['archived_at'])
+        total_size = sum(entry['compressed_size'] for entry in self.index.values())
+        for filename, entry in entries_by_age:
+            if filename == keep:
+                continue
+            if now - entry['archived_at'] <= self.max_age and total_size <= self.max_bytes:
+                continue
+            logger.info('Removing %s from file %s', filename, self.name)
+            self._remove(filename)
+            self.evictions += 1
+            total_size -= entry['compressed_size']
+
+    def _get_archived_file(self, filename):
+        entry = dict(self.index[filename])
+        entry['date'] = datetime.date.fromisoformat(entry['date'])
+        return ArchivedFile(filename, **entry)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.objects_dir, f'{sha256}.gz')
+
+    def _remove(self, filename):
+        entry = self.index.pop(filename)
+        # the same content may be indexed under several names
+        if not any(other['sha256'] == entry['sha256'] for other in self.index.values()):
+            try:
+                os.remove(self._object_path(entry['sha256']))
+            except FileNotFoundError:
+                pass
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning('File %s index is corrupt and will be rebuilt', self.name)
+            return {}
+
+    def _save_index(self):
+        with atomic_write(self.index_path) as f:
+            json.dump(self.index, f)
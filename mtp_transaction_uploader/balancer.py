@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from urllib3.exceptions import NewConnectionError
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+ROUND_ROBIN = 'round-robin'
+LEAST_OUTSTANDING = 'least-outstanding'
+
+_api_load_balancer = SharedInstance()
+
+
+def get_api_load_balancer():
+    """
+    Returns:
+        the APILoadBalancer shared by all API connections so that keep-alive connections are reused
+    """
+    base_urls = settings.API_URLS or [settings.API_URL]
+    return _api_load_balancer.get((base_urls, settings.API_URL), lambda: APILoadBalancer(
+        base_urls,
+        strategy=settings.API_LOAD_BALANCING,
+        # one connection for each upload thread and one for balance updates
+        pool_size=settings.UPLOAD_CONCURRENCY + 1,
+        unhealthy_seconds=settings.API_HOST_UNHEALTHY_SECONDS,
+        api_url=settings.API_URL,
+    ))
+
+
+class APIHost:
+    """
+    One API instance with its own pool of keep-alive connections;
+    request paths under `api_path` are moved under the path of its base URL, e.g. `https://host/api`
+    """
+
+    def __init__(self, base_url, pool_size, api_path=''):
+        self.base_url = base_url
+        url = urlsplit(base_url)
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/')
+        self.api_path = api_path.rstrip('/')
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.outstanding = 0
+        self.unhealthy_until = 0
+
+    def __str__(self):
+        return self.base_url
+
+    @property
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def get_url(self, url):
+        url = urlsplit(url)
+        path = url.path
+        if self.api_path and (path == self.api_path or path.startswith(f'{self.api_path}/')):
+            path = path[len(self.api_path):]
+        return url._replace(scheme=self.scheme, netloc=self.netloc, path=self.path + path).geturl()
+
+
+class APILoadBalancer:
+    """
+    Sends each API request to one of several API instances chosen by round-robin or least outstanding requests.
+    Hosts that cannot be connected to or that respond with a gateway error are skipped for `unhealthy_seconds`
+    unless all of them are unhealthy; requests that could not connect are tried on the next host.
+    Requests are addressed to `api_url` whose path is replaced by each host's base path.
+    """
+
+    def __init__(self, base_urls, strategy=ROUND_ROBIN, pool_size=10, unhealthy_seconds=30, api_url=''):
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError(f'Unknown load balancing strategy {strategy}')
+        self.base_urls = base_urls
+        self.strategy = strategy
+        self.unhealthy_seconds = unhealthy_seconds
+        api_path = urlsplit(api_url).path
+        self.hosts = [APIHost(base_url, pool_size, api_path) for base_url in base_urls]
+        self.next_host = 0
+        self.lock = threading.Lock()
+
+    def choose_host(self, excluded=()):
+        with self.lock:
+            # rotate so that ties are broken by round-robin
+            start = self.next_host % len(self.hosts)
+            hosts = self.hosts[start:] + self.hosts[:start]
+            hosts = [host for host in hosts if host not in excluded]
+            hosts = [host for host in hosts if host.is_healthy] or hosts
+            if self.strategy == LEAST_OUTSTANDING:
+                host = min(hosts, key=lambda host: host.outstanding)
+            else:
+                host = hosts[0]
+            self.next_host += 1
+            host.outstanding += 1
+            return host
+
+    def mark_unhealthy(self, host, reason):
+        logger.warning('API host %s is unhealthy: %s', host, reason)
+        with self.lock:
+            host.unhealthy_until = time.monotonic() + self.unhealthy_seconds
+
+    def send(self, request, **kwargs):
+        tried_hosts = []
+        while True:
+            host = self.choose_host(excluded=tried_hosts)
+            tried_hosts.append(host)
+            # a copy for each host so that failovers and retries of the same request start from its original URL
+            host_request = request.copy()
+            host_request.url = host.get_url(request.url)
+            try:
+                response = host.adapter.send(host_request, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                self.mark_unhealthy(host, e)
+                # nothing was sent so the request can be safely tried on another host
+                if self.could_not_connect(e) and len(tried_hosts) < len(self.hosts):
+                    continue
+                raise
+            finally:
+                with self.lock:
+                    host.outstanding -= 1
+            if response.status_code in (502, 504) or (
+                response.status_code == 503 and 'Retry-After' not in response.headers
+            ):
+                self.mark_unhealthy(host, f'responded {response.status_code}')
+            return response
+
+    @classmethod
+    def could_not_connect(cls, e):
+        reason = getattr(e.args[0], 'reason', None) if e.args else None
+        return isinstance(e, ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+    def close(self):
+        for host in self.hosts:
+            host.adapter.close()
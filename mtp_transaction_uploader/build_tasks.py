@@ -28,6 +28,15 @@ def test(context: Context, functional_tests=False):
     return context.shell('pytest', '--capture', 'no', '--verbose', '--junit-xml', 'junit.xml', environment=environment)
 
 
+@tasks.register('build')
+def benchmark(context: Context, update_baselines=False):
+    """
+    Benchmarks per-record functions against stored baselines
+    """
+    args = ['--update-baselines'] if update_baselines else []
+    return context.shell('python', '-m', 'tests.benchmarks', *args, environment={'IGNORE_LOCAL_SETTINGS': 'True'})
+
+
 @tasks.register()
 def clean(context: Context, delete_dependencies: bool = False):
     """
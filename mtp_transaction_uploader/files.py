@@ -0,0 +1,21 @@
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', directory=None):
+    """
+    Yields a temporary file in the same directory as `path` which is renamed to `path` once it has been written
+    so that an interrupted run cannot leave a partial file, and removed if writing fails.
+    `path` can be a callable if it depends on what is written, in which case `directory` must be given.
+    """
+    directory = directory or os.path.dirname(path) or '.'
+    with tempfile.NamedTemporaryFile(mode, dir=directory, suffix='.tmp', delete=False) as temp_file:
+        try:
+            yield temp_file
+        except BaseException:
+            temp_file.close()
+            os.remove(temp_file.name)
+            raise
+    os.replace(temp_file.name, path() if callable(path) else path)
@@ -0,0 +1,253 @@
+import contextlib
+import datetime
+import email.utils
+import logging
+import threading
+import time
+
+from requests.adapters import BaseAdapter
+
+from mtp_transaction_uploader import metrics, settings
+from mtp_transaction_uploader.balancer import get_api_load_balancer
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+_api_governor = SharedInstance()
+
+
+class APIUnavailableError(Exception):
+    """
+    Raised instead of sending API requests while the circuit breaker is open
+    """
+
+
+def get_api_governor():
+    """
+    Returns:
+        the APIGovernor shared by all API connections
+    """
+    return _api_governor.get(settings.API_RATE_LIMITS, lambda: APIGovernor(
+        settings.API_RATE_LIMITS,
+        CircuitBreaker(settings.API_CIRCUIT_BREAKER_THRESHOLD, settings.API_CIRCUIT_BREAKER_RESET_SECONDS),
+    ))
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second on average with bursts of up to one second's worth;
+    a request for more than that waits until the bucket would have refilled
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # tokens may go negative so that later callers queue behind this one
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class EndpointGovernor:
+    """
+    Limits requests per second, bytes per second and concurrent requests to one API endpoint;
+    a limit of 0 means unlimited
+    """
+
+    def __init__(self, requests_per_second=0, bytes_per_second=0, max_concurrency=0):
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.bytes = TokenBucket(bytes_per_second) if bytes_per_second else None
+        self.concurrency = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """
+        Holds back all requests to this endpoint, e.g. because the API asked for fewer requests
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @contextlib.contextmanager
+    def acquire(self, size=0):
+        with self.lock:
+            wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if self.requests:
+            self.requests.acquire()
+        if self.bytes and size:
+            self.bytes.acquire(size)
+        if self.concurrency:
+            with self.concurrency:
+                yield
+        else:
+            yield
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed requests so that later requests fail immediately.
+    Once `reset_seconds` have passed it is half-open: one probe request is allowed through
+    and it closes again if that succeeds or stays open for another `reset_seconds` if not.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                logger.info('API circuit breaker is half-open, probing')
+                return
+            raise APIUnavailableError(
+                f'API requests stopped after {self.failures} consecutive failures'
+            )
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info('API circuit breaker closed')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.threshold and self.failures >= self.threshold):
+                if self.state != self.OPEN:
+                    logger.warning('API circuit breaker opened after %d consecutive failures', self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class APIGovernor:
+    """
+    Governs every API request by endpoint, retrying those that the API rejects as too many
+    and failing fast while a circuit breaker is open
+    """
+
+    def __init__(self, rate_limits, circuit_breaker=None):
+        self.rate_limits = rate_limits
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(threshold=0, reset_seconds=0)
+        self.endpoints = {
+            endpoint: EndpointGovernor(**limits)
+            for endpoint, limits in rate_limits.items()
+        }
+        self.default = self.endpoints.pop('default', None) or EndpointGovernor()
+
+    @classmethod
+    def get_endpoint_name(cls, request):
+        path = request.path_url.split('?')[0]
+        return path.strip('/').split('/')[-1] or 'default'
+
+    def get_endpoint(self, endpoint_name):
+        return self.endpoints.get(endpoint_name, self.default)
+
+    def send(self, send, request):
+        """
+        Sends a prepared request using the `send` callable once it is allowed to, waiting and retrying
+        if the API responds with 429 or with 503 and a Retry-After header
+        """
+        endpoint_name = self.get_endpoint_name(request)
+        endpoint = self.get_endpoint(endpoint_name)
+        size = len(request.body or b'')
+        for attempt in range(settings.API_MAX_RETRIES + 1):
+            with endpoint.acquire(size):
+                response = self.send_through_circuit_breaker(send, request)
+            wait = self.get_retry_wait(response, attempt)
+            if wait is None or attempt == settings.API_MAX_RETRIES:
+                return response
+            logger.warning(
+                'API responded %d to %s %s, retrying in %.1f seconds',
+                response.status_code, request.method, endpoint_name, wait,
+            )
+            metrics.API_RETRIES.labels(endpoint=endpoint_name).inc()
+            endpoint.pause(wait)
+            response.close()
+        return response
+
+    def send_through_circuit_breaker(self, send, request):
+        self.circuit_breaker.before_request()
+        try:
+            response = send(request)
+        except BaseException:
+            # any error counts so that a half-open breaker never waits for a probe that will not finish
+            self.circuit_breaker.record_failure()
+            raise
+        # overloaded responses are retried rather than treated as failures
+        if response.status_code >= 500 and not (response.status_code == 503 and 'Retry-After' in response.headers):
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        return response
+
+    @classmethod
+    def get_retry_wait(cls, response, attempt):
+        """
+        Returns:
+            seconds to wait before retrying or None if the response should not be retried
+        """
+        retry_after = response.headers.get('Retry-After')
+        if response.status_code == 429 or (response.status_code == 503 and retry_after):
+            return parse_retry_after(retry_after) if retry_after else settings.API_RETRY_BACKOFF_SECONDS * 2 ** attempt
+        return None
+
+
+def parse_retry_after(retry_after):
+    """
+    Returns:
+        seconds to wait given a Retry-After header in seconds or as an HTTP date
+    """
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return settings.API_RETRY_BACKOFF_SECONDS
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class GovernedHTTPAdapter(BaseAdapter):
+    """
+    Sends requests through an APIGovernor to the API hosts chosen by the shared load balancer,
+    whose connection pools outlive each session
+    """
+
+    def __init__(self, governor, load_balancer=None):
+        super().__init__()
+        self.governor = governor
+        self.load_balancer = load_balancer or get_api_load_balancer()
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = settings.API_TIMEOUT_SECONDS
+        send = self.load_balancer.send
+        return self.governor.send(lambda prepared_request: send(prepared_request, **kwargs), request)
+
+    def close(self):
+        pass
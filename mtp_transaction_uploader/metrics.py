@@ -0,0 +1,105 @@
+import logging
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server, write_to_textfile
+
+from mtp_transaction_uploader import settings
+
+logger = logging.getLogger('mtp')
+
+registry = CollectorRegistry()
+
+FILES_SEEN = Counter(
+    'mtp_transaction_uploader_files_seen', 'New data services files found on the SFTP server',
+    registry=registry,
+)
+FILES_DOWNLOADED = Counter(
+    'mtp_transaction_uploader_files_downloaded', 'Data services files downloaded, by source',
+    ['source'], registry=registry,
+)
+FILES_SKIPPED = Counter(
+    'mtp_transaction_uploader_files_skipped', 'Data services files whose transactions were not all uploaded, by reason',
+    ['reason'], registry=registry,
+)
+DOWNLOADED_BYTES = Counter(
+    'mtp_transaction_uploader_downloaded_bytes', 'Size of downloaded data services files, by source',
+    ['source'], registry=registry,
+)
+RECORDS_PARSED = Counter(
+    'mtp_transaction_uploader_records_parsed', 'Relevant records read from data services files',
+    registry=registry,
+)
+TRANSACTIONS_UPLOADED = Counter(
+    'mtp_transaction_uploader_transactions_uploaded', 'Transactions posted to the API, by category',
+    ['category'], registry=registry,
+)
+PRISONER_REFERENCES = Counter(
+    'mtp_transaction_uploader_prisoner_references',
+    'Prisoner references parsed from credits, by whether they matched the prisoner locations snapshot',
+    ['match'], registry=registry,
+)
+RECORDS_QUARANTINED = Counter(
+    'mtp_transaction_uploader_records_quarantined', 'Records set aside because they could not be transformed',
+    registry=registry,
+)
+BALANCE_MISMATCHES = Counter(
+    'mtp_transaction_uploader_balance_mismatches',
+    'Files whose balance records do not reconcile with their transactions',
+    registry=registry,
+)
+UPLOAD_CHUNK_FAILURES = Counter(
+    'mtp_transaction_uploader_upload_chunk_failures', 'Requests posting transactions to the API that failed',
+    registry=registry,
+)
+TRANSACTIONS_SPOOLED = Counter(
+    'mtp_transaction_uploader_transactions_spooled', 'Transactions that failed to upload and were spooled for replay',
+    registry=registry,
+)
+REPLAY_ATTEMPTS = Counter(
+    'mtp_transaction_uploader_replay_attempts', 'Attempts to replay spooled transactions',
+    registry=registry,
+)
+API_RETRIES = Counter(
+    'mtp_transaction_uploader_api_retries', 'API requests retried because the API was overloaded, by endpoint',
+    ['endpoint'], registry=registry,
+)
+UPLOAD_CHUNK_SECONDS = Histogram(
+    'mtp_transaction_uploader_upload_chunk_seconds', 'Time taken to post each chunk of transactions to the API',
+    registry=registry,
+)
+BALANCE_POST_SECONDS = Histogram(
+    'mtp_transaction_uploader_balance_post_seconds', 'Time taken to update the balance after uploading a file',
+    registry=registry,
+)
+LAST_RUN_SUCCESS = Gauge(
+    'mtp_transaction_uploader_last_run_success', 'Whether the last run completed without an unhandled error',
+    registry=registry,
+)
+LAST_RUN_DURATION_SECONDS = Gauge(
+    'mtp_transaction_uploader_last_run_duration_seconds', 'Time taken by the last run',
+    registry=registry,
+)
+LAST_RUN_TIMESTAMP = Gauge(
+    'mtp_transaction_uploader_last_run_timestamp_seconds', 'When the last run finished',
+    registry=registry,
+)
+
+
+def start_metrics_server():
+    """
+    Serves metrics over HTTP for as long as the process runs if METRICS_PORT is set
+    """
+    if settings.METRICS_PORT:
+        start_http_server(settings.METRICS_PORT, registry=registry)
+        logger.info('Serving metrics on port %d', settings.METRICS_PORT)
+
+
+def record_run(duration, success):
+    """
+    Records the outcome of a run and writes all metrics to METRICS_TEXTFILE if it is set
+    """
+    LAST_RUN_SUCCESS.set(1 if success else 0)
+    LAST_RUN_DURATION_SECONDS.set(duration)
+    LAST_RUN_TIMESTAMP.set_to_current_time()
+    if settings.METRICS_TEXTFILE:
+        # written to a temporary file and renamed so that node-exporter never reads a partial file
+        write_to_textfile(settings.METRICS_TEXTFILE, registry)
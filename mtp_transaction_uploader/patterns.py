@@ -64,10 +64,20 @@ class PaymentIdentifier:
         value = value.strip() if value else ''
         return field.match(value) is not None
 
-    def matches(self, account_number, sort_code, sender_name, reference):
+    @property
+    def is_account_only(self):
+        # identifiers that depend only on the sender's account can be cached per account
+        return self.sender_name is None and self.reference is None
+
+    def matches_account(self, account_number, sort_code):
         return (
             self._field_matches(self.account_number, account_number) and
-            self._field_matches(self.sort_code, sort_code) and
+            self._field_matches(self.sort_code, sort_code)
+        )
+
+    def matches(self, account_number, sort_code, sender_name, reference):
+        return (
+            self.matches_account(account_number, sort_code) and
             self._field_matches(self.sender_name, sender_name) and
             self._field_matches(self.reference, reference)
         )
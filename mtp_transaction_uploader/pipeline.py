@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+import sentry_sdk
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.api_client import get_authenticated_connection
+from mtp_transaction_uploader.archive import get_file_archive
+from mtp_transaction_uploader.sources import get_file_source
+from mtp_transaction_uploader.sender_classification import (
+    finish_sender_classification_cache, start_sender_classification_cache,
+)
+
+logger = logging.getLogger('mtp')
+
+# marks the end of a stage's output
+_END = object()
+
+
+class Pipeline:
+    """
+    Downloads, parses and uploads new files as concurrent stages joined by bounded queues
+    so that file N+1 is downloading while file N is parsed and file N-1 is uploaded.
+    Balances are posted by a single final stage in date order through a BalanceCommitStage.
+
+    pysftp and slumber are blocking so each call is run in a worker thread; every stage handles
+    one file at a time so the SFTP and API connections are never used concurrently.
+    A stage that fails on a file passes the failure on in order and drops later files rather than
+    cancelling the other stages, so files uploaded before it still reach the balance stage.
+    """
+
+    def __init__(self, source, queue_size=None):
+        self.source = source
+        queue_size = queue_size or settings.PIPELINE_QUEUE_SIZE
+        self.parse_queue = asyncio.Queue(maxsize=queue_size)
+        self.upload_queue = asyncio.Queue(maxsize=queue_size)
+        self.balance_queue = asyncio.Queue(maxsize=queue_size)
+        self.balance_commit = None
+        # set once any stage fails so that no more files are downloaded
+        self.stopped = False
+
+    async def run(self, new_files):
+        self.balance_commit = await asyncio.to_thread(upload.BalanceCommitStage)
+        await asyncio.gather(self.download(new_files), self.parse(), self.upload(), self.update_balances())
+        if self.balance_commit.error:
+            raise self.balance_commit.error
+        return self.balance_commit.transaction_count
+
+    async def download(self, new_files):
+        for new_file in new_files:
+            if self.stopped:
+                break
+            try:
+                filename = await to_thread(upload.download_file, self.source, new_file)
+            except Exception as e:
+                upload.log_download_error(e)
+                break
+            await self.parse_queue.put(filename)
+        await self.parse_queue.put(_END)
+
+    async def parse(self):
+        failed = False
+        while (filename := await self.parse_queue.get()) is not _END:
+            if failed:
+                upload.discard_downloaded_file(filename)
+                continue
+            balance_records = []
+            try:
+                transactions = await to_thread(upload.get_transactions_from_local_file, filename, balance_records)
+            except Exception as e:
+                failed = self.stopped = True
+                upload.discard_downloaded_file(filename)
+                await self.upload_queue.put((filename, None, None, e))
+                continue
+            if transactions:
+                await self.upload_queue.put((filename, transactions, upload.get_file_balance(balance_records), None))
+            else:
+                upload.discard_downloaded_file(filename)
+        await self.upload_queue.put(_END)
+
+    async def upload(self):
+        api_conn = None
+        failed = False
+        while (item := await self.upload_queue.get()) is not _END:
+            filename, transactions, file_balance, error = item
+            if failed:
+                upload.discard_downloaded_file(filename)
+                continue
+            if error:
+                failed = True
+                await self.balance_queue.put((filename, None, error))
+                continue
+            try:
+                api_conn = api_conn or await to_thread(get_authenticated_connection)
+                uploaded = await to_thread(upload.post_transactions, api_conn, filename, transactions)
+            except Exception as e:
+                uploaded, error = None, e
+            finally:
+                upload.discard_downloaded_file(filename)
+            if uploaded:
+                uploaded = uploaded._replace(file_balance=file_balance)
+            else:
+                failed = self.stopped = True
+            await self.balance_queue.put((filename, uploaded, error))
+        await self.balance_queue.put(_END)
+
+    async def update_balances(self):
+        while (item := await self.balance_queue.get()) is not _END:
+            filename, uploaded, error = item
+            if error:
+                self.balance_commit.fail(filename, error)
+            else:
+                await to_thread(self.balance_commit.commit, filename, uploaded)
+
+
+def to_thread(func, *args):
+    """
+    Runs a blocking call in a worker thread with its own Sentry scope
+    so that spans started by concurrent stages are not nested inside each other
+    """
+    def call():
+        with sentry_sdk.new_scope():
+            return func(*args)
+
+    return asyncio.to_thread(call)
+
+
+async def upload_new_files():
+    await asyncio.to_thread(upload.prepare_new_files_dir)
+    last_date = await asyncio.to_thread(upload.get_last_uploaded_date)
+    source = await asyncio.to_thread(get_file_source)
+    try:
+        await upload_new_files_from_source(source, last_date)
+    finally:
+        await asyncio.to_thread(source.close)
+
+
+async def upload_new_files_from_source(source, last_date):
+    new_files = await asyncio.to_thread(upload.list_new_files, source, last_date)
+    file_count = len(new_files)
+    if file_count == 0:
+        logger.info(
+            'No new files available to upload',
+            extra={
+                'elk_fields': {
+                    '@fields.file_count': file_count,
+                },
+            },
+        )
+        return
+
+    logger.info(
+        'Uploading transactions from new files: %s', ', '.join(new_file.filename for new_file in new_files),
+        extra={
+            'elk_fields': {
+                '@fields.file_count': file_count,
+            },
+        }
+    )
+    start_sender_classification_cache()
+    transaction_count = await Pipeline(source).run(new_files)
+    finish_sender_classification_cache()
+    file_archive = get_file_archive()
+    if file_archive:
+        file_archive.log_stats()
+    logger.info(
+        'Upload of %d transactions complete', transaction_count,
+        extra={
+            'elk_fields': {
+                '@fields.transaction_count': transaction_count,
+            },
+        }
+    )
+
+
+def main():
+    asyncio.run(upload_new_files())
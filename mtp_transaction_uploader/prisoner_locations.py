@@ -0,0 +1,90 @@
+import csv
+import datetime
+import logging
+import os
+import threading
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+# the old index's refresh thread is stopped when the snapshot path changes
+_prisoner_location_index = SharedInstance(on_replace=lambda index: index.close())
+
+
+def get_prisoner_location_index():
+    """
+    Returns:
+        the shared PrisonerLocationIndex or None if PRISONER_LOCATIONS_FILE is not set
+    """
+    if not settings.PRISONER_LOCATIONS_FILE:
+        return None
+    return _prisoner_location_index.get(settings.PRISONER_LOCATIONS_FILE, lambda: PrisonerLocationIndex(
+        settings.PRISONER_LOCATIONS_FILE,
+        refresh_seconds=settings.PRISONER_LOCATIONS_REFRESH_SECONDS,
+    ))
+
+
+def get_location_key(prisoner_number, prisoner_dob):
+    # one short string per prisoner takes far less memory than a tuple of a string and a date
+    return f'{prisoner_number.upper()}{prisoner_dob:%Y%m%d}'
+
+
+class PrisonerLocationIndex:
+    """
+    Prisoner numbers and dates of birth from a snapshot of prisoner locations so that parsed references
+    can be checked without asking the API. The snapshot is a CSV file with `prisoner_number` and `prisoner_dob`
+    (YYYY-MM-DD) columns; it is reloaded in a background thread every `refresh_seconds` if it has changed.
+    """
+
+    def __init__(self, path, refresh_seconds=0):
+        self.path = path
+        self.refresh_seconds = refresh_seconds
+        self.locations = None
+        self.mtime = None
+        self.stopped = threading.Event()
+        self.refresh()
+        if refresh_seconds:
+            threading.Thread(target=self._refresh_periodically, name='prisoner-locations', daemon=True).start()
+
+    def __len__(self):
+        return len(self.locations or ())
+
+    def matches(self, prisoner_number, prisoner_dob):
+        """
+        Returns:
+            whether the prisoner is in the snapshot or None if no snapshot could be loaded
+        """
+        # read once because the snapshot may be replaced by the refresh thread
+        locations = self.locations
+        if locations is None:
+            return None
+        return get_location_key(prisoner_number, prisoner_dob) in locations
+
+    def refresh(self):
+        """
+        Loads the snapshot if it has changed since it was last loaded, keeping the previous one if it cannot be read
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path, newline='') as f:
+                locations = frozenset(
+                    get_location_key(row['prisoner_number'], datetime.date.fromisoformat(row['prisoner_dob']))
+                    for row in csv.DictReader(f)
+                )
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            logger.warning('Cannot load prisoner locations snapshot %s: %s', self.path, e)
+            return
+        self.locations = locations
+        self.mtime = mtime
+        logger.info('Loaded %d prisoner locations', len(locations))
+
+    def close(self):
+        self.stopped.set()
+
+    def _refresh_periodically(self):
+        while not self.stopped.wait(self.refresh_seconds):
+            self.refresh()
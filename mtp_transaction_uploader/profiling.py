@@ -0,0 +1,219 @@
+from collections import Counter, defaultdict
+import contextlib
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import os
+import pstats
+import resource
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger('mtp')
+
+# frames kept for each traced allocation; more are slower but group allocations by their callers too
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 25
+# paths through the call graph taking less time than this are left out of collapsed stacks
+MIN_STACK_SECONDS = 1e-6
+MAX_STACK_DEPTH = 100
+
+_profiler = None
+
+
+def start_profiling(reports_dir):
+    """
+    Profiles every stage of processing each file until `stop_profiling` is called,
+    writing reports to a new directory in `reports_dir` named after the time the run started
+    """
+    global _profiler
+    _profiler = Profiler(os.path.join(reports_dir, time.strftime('%Y%m%dT%H%M%S')))
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+
+
+def profiled(stage, filename_argument='filename'):
+    """
+    Decorates a function that processes one file so that each call is profiled as `stage` of that file
+    while profiling is on; the file is taken from the named argument, which may be a RemoteFile
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            file = signature.bind(*args, **kwargs).arguments[filename_argument]
+            filename = os.path.basename(str(getattr(file, 'filename', file)))
+            with profiler.profile(filename, stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_frame(func):
+    filename, lineno, name = func
+    if filename == '~':
+        # built-in function
+        return name
+    return f'{name} ({os.path.basename(filename)}:{lineno})'
+
+
+def get_collapsed_stacks(profile):
+    """
+    cProfile only records time spent in each function and by each caller-callee pair, not whole stacks,
+    so each function's time is split between the paths leading to it in proportion to the time spent
+    by each of its callers calling it
+    Returns:
+        lines of semicolon-separated frames followed by microseconds spent in the last frame,
+        as read by flame graph tools
+    """
+    stats = pstats.Stats(profile).stats
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller][func] = caller_stats[3]
+    stacks = Counter()
+
+    def walk(func, stack, funcs_in_stack, seconds):
+        _, _, own_seconds, cumulative_seconds, _ = stats[func]
+        stack = stack + (format_frame(func),)
+        share = seconds / cumulative_seconds if cumulative_seconds else 0
+        stacks[';'.join(stack)] += own_seconds * share
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        funcs_in_stack = funcs_in_stack | {func}
+        for callee, callee_seconds in callees[func].items():
+            # recursive calls are already included in the caller's time
+            if callee not in funcs_in_stack and callee_seconds * share >= MIN_STACK_SECONDS:
+                walk(callee, stack, funcs_in_stack, callee_seconds * share)
+
+    for func, (_, _, _, cumulative_seconds, callers) in stats.items():
+        if not callers:
+            walk(func, (), frozenset(), cumulative_seconds)
+    return [
+        f'{stack} {round(seconds * 1e6)}'
+        for stack, seconds in sorted(stacks.items())
+        if round(seconds * 1e6)
+    ]
+
+
+class Profiler:
+    """
+    Runs each stage of processing a file under cProfile and tracemalloc and writes, per file and stage,
+    a pstats dump, collapsed stacks for flame graphs and the allocation sites that grew the most.
+    Peak RSS and the traced Python heap are logged after each stage and appended to `summary.jsonl`.
+
+    cProfile can only profile one thing at a time and tracemalloc traces the whole process
+    so stages are run one at a time while profiling; a stage called from within another is part of it.
+    """
+
+    def __init__(self, reports_dir):
+        self.reports_dir = reports_dir
+        self.lock = threading.Lock()
+        self.active = threading.local()
+
+    def start(self):
+        os.makedirs(self.reports_dir, exist_ok=True)
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        logger.info('Profiling each file into %s', self.reports_dir)
+
+    def stop(self):
+        heap_size, heap_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info(
+            'Profiling finished: peak RSS %d bytes, Python heap %d bytes (peak %d bytes)',
+            get_peak_rss(), heap_size, heap_peak,
+            extra={
+                'elk_fields': {
+                    '@fields.peak_rss': get_peak_rss(),
+                    '@fields.heap_size': heap_size,
+                    '@fields.heap_peak': heap_peak,
+                },
+            },
+        )
+
+    @contextlib.contextmanager
+    def profile(self, filename, stage):
+        if getattr(self.active, 'stage', None):
+            yield
+            return
+        with self.lock:
+            self.active.stage = stage
+            try:
+                tracemalloc.reset_peak()
+                snapshot_before = self.take_snapshot()
+                profile = cProfile.Profile()
+                start_time = time.perf_counter()
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+                    seconds = time.perf_counter() - start_time
+                    self.write_reports(filename, stage, seconds, profile, snapshot_before, self.take_snapshot())
+            finally:
+                self.active.stage = None
+
+    @classmethod
+    def take_snapshot(cls):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+    def write_reports(self, filename, stage, seconds, profile, snapshot_before, snapshot_after):
+        file_dir = os.path.join(self.reports_dir, filename)
+        os.makedirs(file_dir, exist_ok=True)
+        report_path = os.path.join(file_dir, stage)
+
+        profile.dump_stats(f'{report_path}.prof')
+        with open(f'{report_path}.collapsed', 'w') as f:
+            f.writelines(f'{line}\n' for line in get_collapsed_stacks(profile))
+        with open(f'{report_path}.allocations.txt', 'w') as f:
+            for statistic in snapshot_after.compare_to(snapshot_before, 'lineno')[:TOP_ALLOCATIONS]:
+                f.write(f'{statistic}\n')
+
+        heap_size, heap_peak = tracemalloc.get_traced_memory()
+        summary = {
+            'filename': filename,
+            'stage': stage,
+            'seconds': seconds,
+            'heap_size': heap_size,
+            'heap_peak': heap_peak,
+            'peak_rss': get_peak_rss(),
+        }
+        with open(os.path.join(self.reports_dir, 'summary.jsonl'), 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+        logger.info(
+            'Profiled %s of %s in %.3f seconds: peak RSS %d bytes, Python heap %d bytes (peak %d bytes)',
+            stage, filename, seconds, summary['peak_rss'], heap_size, heap_peak,
+            extra={
+                'elk_fields': {
+                    '@fields.filename': filename,
+                    '@fields.stage': stage,
+                    '@fields.peak_rss': summary['peak_rss'],
+                    '@fields.heap_size': heap_size,
+                    '@fields.heap_peak': heap_peak,
+                },
+            },
+        )
@@ -0,0 +1,115 @@
+from collections import namedtuple
+import json
+import logging
+import os
+import time
+
+from bankline_parser.data_services import models
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.files import atomic_write
+
+logger = logging.getLogger('mtp')
+
+QuarantinedRecord = namedtuple('QuarantinedRecord', ['record', 'error'])
+QuarantineFile = namedtuple('QuarantineFile', ['path', 'filename', 'date', 'balance_change', 'quarantined_at'])
+
+
+def get_record_quarantine():
+    """
+    Returns:
+        a RecordQuarantine or None if QUARANTINE_DIR is not set
+    """
+    if not settings.QUARANTINE_DIR:
+        return None
+    return RecordQuarantine(settings.QUARANTINE_DIR)
+
+
+def get_record_balance_change(record):
+    if record.is_credit():
+        return record.amount
+    if record.is_debit():
+        return -record.amount
+    return 0
+
+
+class RecordQuarantine:
+    """
+    Keeps records that could not be transformed into transactions so that the rest of their file can be uploaded
+    and they can be replayed once fixed. Each data services file with quarantined records has a JSON lines file:
+    a header with the file name, date and balance change of the quarantined records,
+    followed by one record per line with its raw row, parsed fields and error.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, filename, date, quarantined_records, balance_change=None, quarantined_at=None):
+        """
+        Writes quarantined records for a file, replacing any already quarantined from it
+        """
+        if balance_change is None:
+            balance_change = sum(get_record_balance_change(record) for record, _ in quarantined_records)
+        header = {
+            'filename': filename,
+            'date': date.isoformat() if date else None,
+            'balance_change': balance_change,
+            'quarantined_at': quarantined_at or time.time(),
+        }
+        with atomic_write(self._path(filename)) as f:
+            f.write(json.dumps(header) + '\n')
+            for record, error in quarantined_records:
+                f.write(json.dumps({
+                    'row': record.row,
+                    'fields': {
+                        name: str(value)
+                        for name, value in vars(record).items()
+                        if name != 'row' and value is not None
+                    },
+                    'error': error if isinstance(error, str) else f'{type(error).__name__}: {error}',
+                }) + '\n')
+
+    def list(self):
+        """
+        Returns:
+            QuarantineFile tuples in date order
+        """
+        quarantine_files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.directory, name)
+            with open(path) as f:
+                header = json.loads(f.readline())
+            quarantine_files.append(QuarantineFile(path, **header))
+        return sorted(quarantine_files, key=lambda quarantine_file: (quarantine_file.date or '', quarantine_file.path))
+
+    def get_balance_change(self, filename):
+        """
+        Returns:
+            the balance change of records quarantined from a file, which is still included in its closing balance
+        """
+        try:
+            with open(self._path(filename)) as f:
+                return json.loads(f.readline())['balance_change']
+        except FileNotFoundError:
+            return 0
+
+    def read_records(self, quarantine_file):
+        """
+        Yields QuarantinedRecord tuples with records parsed again from their raw rows
+        """
+        with open(quarantine_file.path) as f:
+            f.readline()
+            for line in f:
+                stored_record = json.loads(line)
+                record = models.DataRecord(stored_record['row'])
+                record.row = stored_record['row']
+                yield QuarantinedRecord(record, stored_record['error'])
+
+    def remove(self, quarantine_file):
+        os.remove(quarantine_file.path)
+
+    def _path(self, filename):
+        return os.path.join(self.directory, f'{filename}.jsonl')
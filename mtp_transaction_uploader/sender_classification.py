@@ -0,0 +1,145 @@
+from collections import namedtuple, OrderedDict
+import json
+import logging
+import threading
+
+from mtp_common.bank_accounts import is_correspondence_account, roll_number_required
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.files import atomic_write
+from mtp_transaction_uploader.patterns import ADMINISTRATIVE_IDENTIFIERS
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+# 0 filled normally means absent, but some building societies use it for roll number accounts
+BUILDING_SOCIETY_ACCOUNT_NUMBER = '0' * 8
+
+AccountClassification = namedtuple(
+    'AccountClassification',
+    ['account_number', 'roll_number_required', 'correspondence_account', 'administrative_account']
+)
+
+_sender_classification_cache = SharedInstance()
+
+
+def classify_account(sort_code, account_number) -> AccountClassification:
+    """
+    Classifies a sender using only their sort code and account number;
+    checks that also depend on a record's reference or description are not included
+    """
+    building_soc_account_number = account_number or BUILDING_SOCIETY_ACCOUNT_NUMBER
+    requires_roll_number = roll_number_required(sort_code, building_soc_account_number)
+    if requires_roll_number:
+        account_number = building_soc_account_number
+    return AccountClassification(
+        account_number,
+        requires_roll_number,
+        is_correspondence_account(sort_code, account_number),
+        any(
+            identifier.matches_account(account_number, sort_code)
+            for identifier in ADMINISTRATIVE_IDENTIFIERS
+            if identifier.is_account_only
+        ),
+    )
+
+
+class SenderClassificationCache:
+    """
+    Bounded least-recently-used cache of `classify_account` results keyed on (sort code, account number)
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.use_counts = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def classify(self, sort_code, account_number) -> AccountClassification:
+        key = (sort_code, account_number)
+        with self.lock:
+            classification = self.entries.get(key)
+            if classification is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                self.use_counts[key] += 1
+                return classification
+            self.misses += 1
+        classification = classify_account(sort_code, account_number)
+        with self.lock:
+            self._store(key, classification)
+            self.use_counts[key] += 1
+        return classification
+
+    def prime(self, keys):
+        for sort_code, account_number in keys:
+            with self.lock:
+                self._store((sort_code, account_number), classify_account(sort_code, account_number))
+
+    def most_common(self, count):
+        with self.lock:
+            return sorted(self.use_counts, key=self.use_counts.get, reverse=True)[:count]
+
+    def log_stats(self):
+        logger.info(
+            'Sender classification cache: %d hits, %d misses', self.hits, self.misses,
+            extra={
+                'elk_fields': {
+                    '@fields.sender_classification_hits': self.hits,
+                    '@fields.sender_classification_misses': self.misses,
+                    '@fields.sender_classification_hit_rate': self.hit_rate,
+                },
+            },
+        )
+
+    def _store(self, key, classification):
+        self.entries[key] = classification
+        self.entries.move_to_end(key)
+        self.use_counts.setdefault(key, 0)
+        while len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last=False)
+            del self.use_counts[evicted_key]
+
+
+def get_sender_classification_cache():
+    """
+    Returns:
+        the cache started for this run or a new empty one if none has been started
+    """
+    size = settings.SENDER_CLASSIFICATION_CACHE_SIZE
+    return _sender_classification_cache.get(size, lambda: SenderClassificationCache(size))
+
+
+def start_sender_classification_cache():
+    """
+    Starts a new per-run cache, primed with the most common senders seen in earlier runs
+    """
+    size = settings.SENDER_CLASSIFICATION_CACHE_SIZE
+    cache = SenderClassificationCache(size)
+    if settings.SENDER_CLASSIFICATION_PRIMING_FILE:
+        try:
+            with open(settings.SENDER_CLASSIFICATION_PRIMING_FILE) as f:
+                cache.prime(json.load(f))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError):
+            logger.warning('Sender classification priming file is corrupt and will be replaced')
+    return _sender_classification_cache.replace(size, cache)
+
+
+def finish_sender_classification_cache():
+    """
+    Logs cache statistics and saves the most common senders to prime the next run
+    """
+    cache = get_sender_classification_cache()
+    cache.log_stats()
+    if settings.SENDER_CLASSIFICATION_PRIMING_FILE:
+        with atomic_write(settings.SENDER_CLASSIFICATION_PRIMING_FILE) as f:
+            json.dump(cache.most_common(settings.SENDER_CLASSIFICATION_PRIMING_COUNT), f)
@@ -9,14 +9,73 @@ APP_BUILD_TAG = os.environ.get('APP_BUILD_TAG', '')
 APP_GIT_COMMIT = os.environ.get('APP_GIT_COMMIT', '')
 
 SENTRY_DSN = os.environ.get('SENTRY_DSN', '')
+# proportion of runs whose performance traces are sent to Sentry
+SENTRY_TRACES_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE', '0'))
+# when set, performance traces are written to this file as JSON lines instead of being sent to Sentry;
+# errors are still reported to SENTRY_DSN and SENTRY_TRACES_SAMPLE_RATE must be above 0 or the file stays empty
+SENTRY_TRACES_FILE = os.environ.get('SENTRY_TRACES_FILE', '')
+# `main.py --profile` writes CPU and memory profiles of each file to a new directory in this one
+PROFILE_REPORTS_DIR = os.environ.get('PROFILE_REPORTS_DIR', '/tmp/mtp_profiles')
+
+# metrics are written to this file in node-exporter textfile format at the end of every run
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE', '')
+# when set, metrics are also served over HTTP on this port for as long as the uploader runs
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
 
 SFTP_HOST = os.environ.get('SFTP_HOST', '')
+SFTP_PORT = int(os.environ.get('SFTP_PORT', '22'))
 SFTP_USER = os.environ.get('SFTP_USER', '')
 SFTP_PRIVATE_KEY = os.environ.get('SFTP_PRIVATE_KEY', '~/.ssh/id_rsa')
 SFTP_DIR = os.environ.get('SFTP_DIR', '')
+# where data services files are read from: `sftp`, `archive` to read them from ARCHIVE_DIR,
+# or `local` or `memory` to read them from FILE_SOURCE_DIR,
+# e.g. a mirror of SFTP_DIR, either directly or after loading them all into memory
+FILE_SOURCE = os.environ.get('FILE_SOURCE', 'sftp')
+FILE_SOURCE_DIR = os.environ.get('FILE_SOURCE_DIR', '')
 ACCOUNT_CODE = os.environ.get('ACCOUNT_CODE', '444444')
 
 UPLOAD_REQUEST_SIZE = int(os.environ.get('UPLOAD_REQUEST_SIZE', '1000'))
+# number of files whose transactions are parsed and uploaded at once; balances are still updated in date order
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', '2'))
+
+# when enabled, closing balances are taken from files' balance records when they reconcile with the files'
+# transactions; otherwise they are the previous closing balance from the API plus the files' transactions
+USE_FILE_BALANCES = os.environ.get('USE_FILE_BALANCES', 'false').lower() in ('1', 'true')
+
+# when set, the date of the latest file uploaded is kept in this file so that runs start without asking the API
+# for its latest transaction; it is reconciled with the API once it is older than UPLOAD_WATERMARK_RECONCILE_SECONDS
+UPLOAD_WATERMARK_FILE = os.environ.get('UPLOAD_WATERMARK_FILE', '')
+UPLOAD_WATERMARK_RECONCILE_SECONDS = int(os.environ.get('UPLOAD_WATERMARK_RECONCILE_SECONDS', str(24 * 60 * 60)))
+
+# when set, transactions that fail to upload are spooled in this directory to be replayed with `main.py replay`
+DEAD_LETTER_DIR = os.environ.get('DEAD_LETTER_DIR', '')
+DEAD_LETTER_MAX_BYTES = int(os.environ.get('DEAD_LETTER_MAX_BYTES', str(100 * 1000 * 1000)))
+DEAD_LETTER_MAX_AGE_DAYS = int(os.environ.get('DEAD_LETTER_MAX_AGE_DAYS', '30'))
+# replaying stops after this many consecutive failures, waiting twice as long after each one
+DEAD_LETTER_REPLAY_ATTEMPTS = int(os.environ.get('DEAD_LETTER_REPLAY_ATTEMPTS', '5'))
+DEAD_LETTER_REPLAY_BACKOFF_SECONDS = float(os.environ.get('DEAD_LETTER_REPLAY_BACKOFF_SECONDS', '1'))
+
+# `main.py watch` uploads files dropped into this local directory, e.g. a mirror of SFTP_DIR, once their size
+# and modification time have not changed for WATCH_SETTLE_SECONDS; changes are noticed with inotify
+# unless WATCH_POLLING is enabled or inotify is unavailable, in which case the directory is polled
+WATCH_DIR = os.environ.get('WATCH_DIR', '')
+WATCH_SETTLE_SECONDS = float(os.environ.get('WATCH_SETTLE_SECONDS', '5'))
+WATCH_POLL_SECONDS = float(os.environ.get('WATCH_POLL_SECONDS', '1'))
+WATCH_POLLING = os.environ.get('WATCH_POLLING', '').lower() in ('1', 'true')
+
+# when set, records that raise errors while being transformed are written to this directory with the error
+# so that the rest of their file is still uploaded; they can be uploaded later with `main.py replay-quarantine`
+QUARANTINE_DIR = os.environ.get('QUARANTINE_DIR', '')
+
+# files larger than this are downloaded in chunks and their transactions are held in a temporary file
+# until the file is validated and uploaded rather than in memory
+LARGE_FILE_THRESHOLD_BYTES = int(os.environ.get('LARGE_FILE_THRESHOLD_BYTES', str(50 * 1000 * 1000)))
+DOWNLOAD_CHUNK_SIZE_BYTES = int(os.environ.get('DOWNLOAD_CHUNK_SIZE_BYTES', str(1024 * 1024)))
+
+# when enabled, downloading, parsing, uploading and balance updates run as overlapping asyncio stages
+ASYNC_PIPELINE = os.environ.get('ASYNC_PIPELINE', '').lower() in ('1', 'true')
+# number of downloaded files that can be waiting to be processed, and between other pipeline stages
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '2'))
 
 START_PAGE_URL = os.environ.get('START_PAGE_URL', 'https://www.gov.uk/send-prisoner-money')
 CASHBOOK_URL = (
@@ -46,9 +105,67 @@ API_PASSWORD = os.environ.get('API_PASSWORD', 'bank-admin')
 API_CLIENT_ID = os.environ.get('API_CLIENT_ID', 'bank-admin')
 API_CLIENT_SECRET = os.environ.get('API_CLIENT_SECRET', 'bank-admin')
 API_URL = os.environ.get('API_URL', 'http://localhost:8000')
+
+
+def _get_api_rate_limit(endpoint, name, default='0'):
+    # e.g. API_TRANSACTIONS_REQUESTS_PER_SECOND overrides API_REQUESTS_PER_SECOND for the transactions endpoint
+    return os.environ.get(f'API_{endpoint.upper()}_{name}', os.environ.get(f'API_{name}', default))
+
+
+# requests to API_URL are sent to one of these API instances instead if set, e.g. several internal service addresses
+API_URLS = [url.strip() for url in os.environ.get('API_URLS', '').split(',') if url.strip()]
+# 'round-robin' or 'least-outstanding'
+API_LOAD_BALANCING = os.environ.get('API_LOAD_BALANCING', 'round-robin')
+# instances that cannot be connected to or respond with gateway errors are skipped for this long
+API_HOST_UNHEALTHY_SECONDS = float(os.environ.get('API_HOST_UNHEALTHY_SECONDS', '30'))
+
+# requests to each API endpoint are limited to these rates and numbers of concurrent requests; 0 means unlimited
+API_RATE_LIMITS = {
+    endpoint: {
+        'requests_per_second': float(_get_api_rate_limit(endpoint, 'REQUESTS_PER_SECOND')),
+        'bytes_per_second': int(_get_api_rate_limit(endpoint, 'BYTES_PER_SECOND')),
+        'max_concurrency': int(_get_api_rate_limit(endpoint, 'MAX_CONCURRENCY')),
+    }
+    for endpoint in ('default', 'transactions', 'balances', 'batches')
+}
+# requests the API rejects with 429, or 503 and a Retry-After header, are retried after waiting as asked
+# or otherwise twice as long after each attempt
+API_MAX_RETRIES = int(os.environ.get('API_MAX_RETRIES', '5'))
+API_RETRY_BACKOFF_SECONDS = float(os.environ.get('API_RETRY_BACKOFF_SECONDS', '1'))
+# after this many consecutive failed API requests, including timeouts, later requests fail immediately
+# until one probe request succeeds after waiting API_CIRCUIT_BREAKER_RESET_SECONDS; 0 disables the circuit breaker
+API_CIRCUIT_BREAKER_THRESHOLD = int(os.environ.get('API_CIRCUIT_BREAKER_THRESHOLD', '5'))
+API_CIRCUIT_BREAKER_RESET_SECONDS = float(os.environ.get('API_CIRCUIT_BREAKER_RESET_SECONDS', '30'))
+API_TIMEOUT_SECONDS = float(os.environ.get('API_TIMEOUT_SECONDS', '60'))
 PUBLIC_STATIC_URL = urljoin(SEND_MONEY_URL, '/static/')
 
 DS_NEW_FILES_DIR = os.environ.get('DS_NEW_FILES_DIR', '/tmp/ds_new_files')
+# when set, downloaded files are kept in this directory across runs so that retries do not download them again
+# it must not be inside DS_NEW_FILES_DIR which is emptied on every run; unused if ARCHIVE_DIR is set
+# because the archive is the same store with longer retention
+DOWNLOAD_CACHE_DIR = os.environ.get('DOWNLOAD_CACHE_DIR', '')
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get('DOWNLOAD_CACHE_MAX_BYTES', str(500 * 1000 * 1000)))
+DOWNLOAD_CACHE_MAX_AGE_DAYS = int(os.environ.get('DOWNLOAD_CACHE_MAX_AGE_DAYS', '7'))
+# when set, downloaded files are compressed into this directory and indexed by date, account code and sha256
+# so that later runs, replays and audits can read them without the SFTP server
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', '')
+ARCHIVE_MAX_BYTES = int(os.environ.get('ARCHIVE_MAX_BYTES', str(1000 * 1000 * 1000)))
+ARCHIVE_MAX_AGE_DAYS = int(os.environ.get('ARCHIVE_MAX_AGE_DAYS', '400'))
+# when enabled, downloaded files are kept in memory and passed straight to the parser
+# only files larger than IN_MEMORY_DOWNLOAD_MAX_BYTES are spilled into temporary files in DS_NEW_FILES_DIR
+IN_MEMORY_DOWNLOADS = os.environ.get('IN_MEMORY_DOWNLOADS', '').lower() in ('1', 'true')
+IN_MEMORY_DOWNLOAD_MAX_BYTES = int(os.environ.get('IN_MEMORY_DOWNLOAD_MAX_BYTES', str(50 * 1000 * 1000)))
+
+# when set, prisoner references parsed from credits are checked against this CSV snapshot of prisoner numbers
+# and dates of birth before upload; it is reloaded every PRISONER_LOCATIONS_REFRESH_SECONDS if it has changed
+PRISONER_LOCATIONS_FILE = os.environ.get('PRISONER_LOCATIONS_FILE', '')
+PRISONER_LOCATIONS_REFRESH_SECONDS = float(os.environ.get('PRISONER_LOCATIONS_REFRESH_SECONDS', '300'))
+
+# sender classification by sort code and account number is cached for each run
+# when a priming file is set, the most common senders are saved to it and used to prime the next run's cache
+SENDER_CLASSIFICATION_CACHE_SIZE = int(os.environ.get('SENDER_CLASSIFICATION_CACHE_SIZE', '10000'))
+SENDER_CLASSIFICATION_PRIMING_FILE = os.environ.get('SENDER_CLASSIFICATION_PRIMING_FILE', '')
+SENDER_CLASSIFICATION_PRIMING_COUNT = int(os.environ.get('SENDER_CLASSIFICATION_PRIMING_COUNT', '1000'))
 
 # fallback account is for tests
 NOMS_AGENCY_ACCOUNT_NUMBER = os.environ.get('NOMS_AGENCY_ACCOUNT_NUMBER', '67175315')
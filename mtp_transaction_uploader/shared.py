@@ -0,0 +1,40 @@
+import threading
+
+
+class SharedInstance:
+    """
+    An object shared by all threads, created when it is first needed and replaced when the settings
+    it was created from change; creation is locked so that concurrent workers never create two
+    """
+
+    def __init__(self, on_replace=None):
+        self.on_replace = on_replace
+        self.lock = threading.Lock()
+        self.key = None
+        self.instance = None
+
+    def get(self, key, create):
+        """
+        Returns:
+            the shared object, first created by calling `create` or again if `key` has changed
+        """
+        with self.lock:
+            if self.instance is None or self.key != key:
+                self._replace(key, create())
+            return self.instance
+
+    def replace(self, key, instance):
+        """
+        Shares `instance` in place of the current object even if `key` has not changed, e.g. to start afresh
+        Returns:
+            `instance`
+        """
+        with self.lock:
+            self._replace(key, instance)
+            return instance
+
+    def _replace(self, key, instance):
+        if self.instance is not None and self.on_replace:
+            self.on_replace(self.instance)
+        self.instance = instance
+        self.key = key
@@ -0,0 +1,204 @@
+from collections import namedtuple
+import io
+import os
+import shutil
+
+from pysftp import Connection, CnOpts
+import sentry_sdk
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.archive import get_file_archive
+
+SFTP = 'sftp'
+LOCAL = 'local'
+MEMORY = 'memory'
+ARCHIVE = 'archive'
+
+FileStat = namedtuple('FileStat', ['st_size', 'st_mtime'])
+
+
+def get_file_source():
+    """
+    Returns:
+        a new FileSource of the kind set by FILE_SOURCE; it should be closed once files have been downloaded
+    """
+    if settings.FILE_SOURCE == SFTP:
+        return SFTPFileSource.connect()
+    if settings.FILE_SOURCE == LOCAL:
+        return LocalFileSource(settings.FILE_SOURCE_DIR)
+    if settings.FILE_SOURCE == MEMORY:
+        return MemoryFileSource.from_directory(settings.FILE_SOURCE_DIR)
+    if settings.FILE_SOURCE == ARCHIVE:
+        if not settings.ARCHIVE_DIR:
+            raise ValueError('ARCHIVE_DIR must be set to read files from the archive')
+        return ArchiveFileSource(get_file_archive(), settings.ACCOUNT_CODE)
+    raise ValueError(f'Unknown file source {settings.FILE_SOURCE}')
+
+
+class FileSource:
+    """
+    A directory in which data services files are found. Files are referred to by name;
+    `listdir` and `stat` work like their `os` equivalents and `open` returns a readable binary file object.
+    """
+    name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def listdir(self):
+        raise NotImplementedError
+
+    def stat(self, filename):
+        raise NotImplementedError
+
+    def open(self, filename, size=None):
+        """
+        Opens a file for reading; `size` is the number of bytes that are going to be read, if known
+        """
+        raise NotImplementedError
+
+    def get(self, filename, local_path):
+        with self.open(filename) as source_file, open(local_path, 'wb') as local_file:
+            shutil.copyfileobj(source_file, local_file)
+
+    def getfo(self, filename, local_file):
+        with self.open(filename) as source_file:
+            shutil.copyfileobj(source_file, local_file)
+
+
+class SFTPFileSource(FileSource):
+    """
+    SFTP_DIR on the bank's SFTP server
+    """
+    name = SFTP
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @classmethod
+    def connect(cls):
+        opts = CnOpts()
+        opts.hostkeys = None
+        with sentry_sdk.start_span(op='sftp.connect', name=settings.SFTP_HOST):
+            conn = Connection(settings.SFTP_HOST, port=settings.SFTP_PORT, username=settings.SFTP_USER,
+                              private_key=settings.SFTP_PRIVATE_KEY, cnopts=opts)
+        conn.chdir(settings.SFTP_DIR)
+        return cls(conn)
+
+    def close(self):
+        self.conn.close()
+
+    def listdir(self):
+        return self.conn.listdir()
+
+    def stat(self, filename):
+        return self.conn.stat(filename)
+
+    def open(self, filename, size=None):
+        remote_file = self.conn.open(filename, 'rb')
+        if size:
+            # requests the whole file up front rather than waiting for each read
+            remote_file.prefetch(size)
+        return remote_file
+
+    def get(self, filename, local_path):
+        self.conn.get(filename, localpath=local_path)
+
+    def getfo(self, filename, local_file):
+        self.conn.getfo(filename, local_file)
+
+
+class LocalFileSource(FileSource):
+    """
+    A local directory, e.g. a mirror of the SFTP directory
+    """
+    name = LOCAL
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def listdir(self):
+        return [
+            filename
+            for filename in os.listdir(self.directory)
+            if os.path.isfile(os.path.join(self.directory, filename))
+        ]
+
+    def stat(self, filename):
+        return os.stat(os.path.join(self.directory, filename))
+
+    def open(self, filename, size=None):
+        return open(os.path.join(self.directory, filename), 'rb')
+
+    def get(self, filename, local_path):
+        shutil.copyfile(os.path.join(self.directory, filename), local_path)
+
+
+class MemoryFileSource(FileSource):
+    """
+    Files held in memory, e.g. to measure the rest of the uploader without reading from disk or the network
+    """
+    name = MEMORY
+
+    def __init__(self, files):
+        # file name -> (contents, modification time)
+        self.files = files
+
+    @classmethod
+    def from_directory(cls, directory):
+        source = LocalFileSource(directory)
+        files = {}
+        for filename in source.listdir():
+            with source.open(filename) as f:
+                files[filename] = (f.read(), source.stat(filename).st_mtime)
+        return cls(files)
+
+    def listdir(self):
+        return list(self.files)
+
+    def stat(self, filename):
+        contents, mtime = self.files[filename]
+        return FileStat(len(contents), mtime)
+
+    def open(self, filename, size=None):
+        contents, _ = self.files[filename]
+        return io.BytesIO(contents)
+
+
+class ArchiveFileSource(FileSource):
+    """
+    Files kept in the file archive for an account, e.g. to upload them again, audit or benchmark them
+    without the SFTP server; archived copies are decompressed as they are read
+    """
+    name = ARCHIVE
+
+    def __init__(self, file_archive, account_code):
+        self.file_archive = file_archive
+        self.archived_files = {
+            archived_file.filename: archived_file
+            for archived_file in file_archive.find(account_code=account_code)
+        }
+
+    def listdir(self):
+        return list(self.archived_files)
+
+    def stat(self, filename):
+        archived_file = self.archived_files[filename]
+        return FileStat(archived_file.size, archived_file.mtime)
+
+    def open(self, filename, size=None):
+        return self.file_archive.open(self.archived_files[filename], binary=True)
+
+    def get(self, filename, local_path):
+        with open(local_path, 'wb') as local_file:
+            self.getfo(filename, local_file)
+
+    def getfo(self, filename, local_file):
+        # checks the archived copy's hash
+        self.file_archive.extract(self.archived_files[filename], local_file)
@@ -0,0 +1,117 @@
+from collections import namedtuple
+import gzip
+import json
+import logging
+import os
+import time
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.files import atomic_write
+
+logger = logging.getLogger('mtp')
+
+DeadLetter = namedtuple('DeadLetter', ['path', 'filename', 'date', 'balance_change', 'error', 'attempts', 'created_at'])
+
+
+def get_dead_letter_spool():
+    """
+    Returns:
+        a DeadLetterSpool or None if DEAD_LETTER_DIR is not set
+    """
+    if not settings.DEAD_LETTER_DIR:
+        return None
+    return DeadLetterSpool(
+        settings.DEAD_LETTER_DIR,
+        max_bytes=settings.DEAD_LETTER_MAX_BYTES,
+        max_age=settings.DEAD_LETTER_MAX_AGE_DAYS * 24 * 60 * 60,
+    )
+
+
+class DeadLetterSpool:
+    """
+    Keeps transactions that failed to upload so that they can be replayed without downloading and parsing
+    the original file again. Each dead letter is a gzipped JSON lines file: a header with the file name and date,
+    the balance change of transactions from the file that were already uploaded, the error and attempt count,
+    followed by one transaction per line. File names sort in date order.
+    """
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, filename, date, transactions, balance_change, error, attempts=1, created_at=None):
+        """
+        Writes transactions from the iterable to a new dead letter
+        Returns:
+            the number of transactions spooled
+        """
+        header = {
+            'filename': filename,
+            'date': date.isoformat(),
+            'balance_change': balance_change,
+            'error': error,
+            'attempts': attempts,
+            'created_at': created_at or time.time(),
+        }
+        transaction_count = 0
+        path = os.path.join(self.directory, f'{header["date"]}-{time.time_ns()}.jsonl.gz')
+        with atomic_write(path, 'wb') as temp_file:
+            with gzip.open(temp_file, 'wt') as f:
+                f.write(json.dumps(header) + '\n')
+                for transaction in transactions:
+                    f.write(json.dumps(transaction) + '\n')
+                    transaction_count += 1
+        self.enforce_policy()
+        return transaction_count
+
+    def list(self):
+        """
+        Returns:
+            DeadLetter tuples in date order
+        """
+        dead_letters = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.jsonl.gz'):
+                continue
+            path = os.path.join(self.directory, name)
+            with gzip.open(path, 'rt') as f:
+                header = json.loads(f.readline())
+            dead_letters.append(DeadLetter(path, **header))
+        return dead_letters
+
+    def get_filenames(self):
+        return {dead_letter.filename for dead_letter in self.list()}
+
+    def read_transactions(self, dead_letter):
+        with gzip.open(dead_letter.path, 'rt') as f:
+            f.readline()
+            for line in f:
+                yield json.loads(line)
+
+    def remove(self, dead_letter):
+        os.remove(dead_letter.path)
+
+    def enforce_policy(self):
+        """
+        Discards dead letters older than the maximum age and then the oldest until the spool fits its maximum size;
+        transactions can still be recovered from the original files
+        """
+        now = time.time()
+        dead_letters = sorted(self.list(), key=lambda dead_letter: dead_letter.created_at)
+        total_size = sum(os.path.getsize(dead_letter.path) for dead_letter in dead_letters)
+        for dead_letter in dead_letters:
+            size = os.path.getsize(dead_letter.path)
+            if now - dead_letter.created_at > self.max_age:
+                reason = 'is too old'
+            elif total_size > self.max_bytes:
+                reason = 'does not fit in the spool'
+            else:
+                continue
+            logger.error(
+                'Discarding dead letter %s with transactions from %s which %s',
+                os.path.basename(dead_letter.path), dead_letter.filename, reason,
+            )
+            self.remove(dead_letter)
+            total_size -= size
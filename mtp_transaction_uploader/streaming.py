@@ -0,0 +1,166 @@
+import itertools
+import json
+import tempfile
+
+from bankline_parser.data_services import models
+from bankline_parser.data_services.exceptions import ParseError
+from bankline_parser.data_services.utils import IndexTrackingIterator
+
+
+class AccountTotals:
+    """
+    Running totals of an account's records, checked against its user trailer label
+    in the same way as `bankline_parser.data_services.models.Account.validate`
+    """
+
+    def __init__(self):
+        self.total_debit = 0
+        self.total_credit = 0
+        self.count_debit = 0
+        self.count_credit = 0
+        self.count_balance = 0
+
+    def add(self, record):
+        if record.is_debit():
+            self.total_debit += record.amount
+            self.count_debit += 1
+        elif record.is_credit():
+            self.total_credit += record.amount
+            self.count_credit += 1
+        elif record.is_balance():
+            self.count_balance += 1
+
+    def get_errors(self, utl):
+        errors = []
+        if self.total_debit != utl.monetary_total_debit_items:
+            errors.append(
+                'Monetary total of debit items does not match expected: '
+                f'counted {self.total_debit}, expected {utl.monetary_total_debit_items}',
+            )
+        if self.count_debit != utl.count_debit_items:
+            errors.append(
+                'Count of debit items does not match expected: '
+                f'counted {self.count_debit}, expected {utl.count_debit_items}',
+            )
+        if self.total_credit != utl.monetary_total_credit_items:
+            errors.append(
+                'Monetary total of credit items does not match expected: '
+                f'counted {self.total_credit}, expected {utl.monetary_total_credit_items}',
+            )
+        if self.count_credit != utl.count_credit_items:
+            errors.append(
+                'Count of credit items does not match expected: '
+                f'counted {self.count_credit}, expected {utl.count_credit_items}',
+            )
+        if ((utl.count_balance_records is not None or self.count_balance > 0)
+                and self.count_balance != utl.count_balance_records):
+            errors.append(
+                'Count of balance records does not match expected: '
+                f'counted {self.count_balance}, expected {utl.count_balance_records}',
+            )
+        return errors
+
+
+class StreamingDataServicesFile:
+    """
+    Reads a data services file one record at a time so that memory use does not depend on file size.
+    `errors` matches `DataServicesFile.errors` but is only complete once `records()` is exhausted.
+    """
+
+    def __init__(self, iterable):
+        self.lines = IndexTrackingIterator(iterable)
+        self.errors = {}
+
+    def is_valid(self):
+        return not self.errors
+
+    def validate(self):
+        for _ in self.records():
+            pass
+        return self.errors
+
+    def records(self):
+        try:
+            models.VolumeHeaderLabel(self._next_line())
+            account_index = 0
+            while (yield from self._account_records(account_index)):
+                account_index += 1
+            if account_index == 0:
+                raise ParseError('No accounts found in data services file')
+        except ParseError as e:
+            raise ParseError(f'Line {self.lines.current_index}: {e}')
+        except EOFError:
+            raise ParseError('File ended unexpectedly')
+
+    def _next_line(self):
+        # StopIteration cannot propagate out of a generator so is re-raised as EOFError
+        try:
+            return next(self.lines)
+        except StopIteration:
+            raise EOFError
+
+    def _account_records(self, account_index):
+        # check for end of iteration on opening label of next account
+        try:
+            models.FileHeaderLabel(next(self.lines))
+        except StopIteration:
+            return False
+        models.UserHeaderLabel(self._next_line())
+
+        totals = AccountTotals()
+        while True:
+            current_row = self._next_line()
+            try:
+                user_trailer_label = models.UserTrailerLabel(current_row)
+                break
+            except ParseError:
+                record = models.BaseRecord(current_row)
+                if record.transaction_code is models.TransactionCode.balance_record:
+                    record = models.BalanceRecord(current_row)
+                else:
+                    record = models.DataRecord(current_row)
+            # kept so that records can be quarantined and parsed again
+            record.row = current_row
+            totals.add(record)
+            yield record
+
+        errors = totals.get_errors(user_trailer_label)
+        if errors:
+            self.errors[f'account {account_index}'] = errors
+        return True
+
+
+class SpooledTransactions:
+    """
+    Transactions written to a temporary file as JSON lines so that a large file's transactions can be
+    held until the file is known to be valid and then read back one at a time
+    """
+
+    def __init__(self, dir=None):
+        self.file = tempfile.TemporaryFile('w+', dir=dir)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.file.seek(0)
+        try:
+            for line in self.file:
+                yield json.loads(line)
+        finally:
+            self.file.close()
+
+    def extend(self, transactions):
+        for transaction in transactions:
+            self.file.write(json.dumps(transaction) + '\n')
+            self.count += 1
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
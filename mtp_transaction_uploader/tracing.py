@@ -0,0 +1,44 @@
+import json
+import threading
+
+from sentry_sdk.transport import Transport
+
+
+class TraceFileTransport(Transport):
+    """
+    Appends each Sentry performance transaction to a file as a line of JSON instead of sending it to Sentry;
+    useful for inspecting traces locally and in tests. Anything else, such as error events,
+    is passed on to `forward_to` (normally the transport that sends to Sentry) or dropped if there is none
+    """
+
+    def __init__(self, path, forward_to=None):
+        super().__init__()
+        self.path = path
+        self.forward_to = forward_to
+        self.lock = threading.Lock()
+
+    def capture_envelope(self, envelope):
+        transaction = envelope.get_transaction_event()
+        if transaction is None:
+            if self.forward_to is not None:
+                self.forward_to.capture_envelope(envelope)
+            return
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(transaction, default=str) + '\n')
+
+    def flush(self, timeout, callback=None):
+        if self.forward_to is not None:
+            self.forward_to.flush(timeout, callback=callback)
+
+    def kill(self):
+        if self.forward_to is not None:
+            self.forward_to.kill()
+
+
+def read_traces(path):
+    """
+    Returns:
+        transactions written by TraceFileTransport
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f]
@@ -1,36 +1,71 @@
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import contextvars
 import datetime
 from datetime import timezone
+import hashlib
+import io
 import itertools
 import logging
-import math
 import os
+import queue
 import re
 import shutil
+import tempfile
+import threading
+import time
 import typing
 
-from bankline_parser.data_services import parse
-from bankline_parser.data_services.enums import TransactionCode
-from mtp_common.bank_accounts import (
-    is_correspondence_account, roll_number_required, roll_number_valid_for_account
-)
-from pysftp import Connection, CnOpts
+from bankline_parser.data_services.enums import BalanceType, TransactionCode
+from mtp_common.bank_accounts import roll_number_valid_for_account
+from requests.exceptions import ConnectionError, Timeout
+import sentry_sdk
 from slumber.exceptions import SlumberHttpBaseException
 
-from mtp_transaction_uploader import settings
+from mtp_transaction_uploader import metrics, settings
 from mtp_transaction_uploader.api_client import get_authenticated_connection
+from mtp_transaction_uploader.archive import get_file_archive
+from mtp_transaction_uploader.governor import APIUnavailableError
 from mtp_transaction_uploader.patterns import (
     CREDIT_REF_PATTERN, CREDIT_REF_PATTERN_REVERSED, FILE_PATTERN_STR,
     ADMINISTRATIVE_IDENTIFIERS, WORLDPAY_SETTLEMENT_REFERENCE_PATTERN,
 )
+from mtp_transaction_uploader.prisoner_locations import get_prisoner_location_index
+from mtp_transaction_uploader.profiling import profiled
+from mtp_transaction_uploader.quarantine import get_record_quarantine, QuarantinedRecord
+from mtp_transaction_uploader.sender_classification import (
+    finish_sender_classification_cache, get_sender_classification_cache, start_sender_classification_cache,
+)
+from mtp_transaction_uploader.sources import get_file_source
+from mtp_transaction_uploader.spool import get_dead_letter_spool
+from mtp_transaction_uploader.streaming import iter_chunks, SpooledTransactions, StreamingDataServicesFile
+from mtp_transaction_uploader.watermark import get_upload_watermark
 
 logger = logging.getLogger('mtp')
 
+# marks the end of files downloaded in the background
+_DOWNLOADS_COMPLETE = object()
+# returned by workers for files whose transactions were not posted because an earlier file failed
+_NOT_UPLOADED = object()
+
+# errors talking to the API, which are not caused by the file being uploaded
+API_ERRORS = (SlumberHttpBaseException, ConnectionError, Timeout, APIUnavailableError)
+
 DATE_FORMAT = '%d%m%y'
-SIZE_LIMIT_BYTES = 50 * 1000 * 1000  # 50MB
+TRANSFORM_BATCH_SIZE = 1000
+
+PAYMENT_CREDIT_CODES = {TransactionCode.credit_bacs_credit, TransactionCode.credit_sundry_credit}
+CATEGORY_BY_CODE = {
+    code: 'credit' if code.name.startswith('credit') else 'debit' if code.name.startswith('debit') else None
+    for code in TransactionCode
+}
 
-NewFiles = namedtuple('NewFiles', ['new_dates', 'new_filenames'])
-RetrievedFiles = namedtuple('RetrievedFiles', ['new_last_date', 'new_filenames'])
+RemoteFile = namedtuple('RemoteFile', ['date', 'filename', 'size', 'mtime'], defaults=[None])
+UploadedTransactions = namedtuple(
+    'UploadedTransactions', ['transaction_count', 'balance_change', 'file_balance'], defaults=[None]
+)
+FileBalance = namedtuple('FileBalance', ['opening_balance', 'closing_balance'])
 PrisonerDetails = namedtuple('PrisonerDetails', ['prisoner_number', 'prisoner_dob', 'from_description_field'])
 ParsedReference = namedtuple('ParsedReference', ['prisoner_number', 'prisoner_dob'])
 SenderInformation = namedtuple(
@@ -39,36 +74,217 @@ SenderInformation = namedtuple(
 )
 
 
-def download_new_files(last_date: typing.Optional[datetime.date]):
-    new_dates = []
-    new_filenames = []
-    opts = CnOpts()
-    opts.hostkeys = None
-    with Connection(settings.SFTP_HOST, username=settings.SFTP_USER,
-                    private_key=settings.SFTP_PRIVATE_KEY, cnopts=opts) as conn:
-        with conn.cd(settings.SFTP_DIR):
-            dir_listing = conn.listdir()
-            for filename in dir_listing:
-                date = parse_filename(filename, settings.ACCOUNT_CODE)
-
-                if date:
-                    stat = conn.stat(filename)
-                    if stat.st_size > SIZE_LIMIT_BYTES:
-                        logger.error('%s is too large (%s), download skipped.', filename, stat.st_size)
-                        continue
-
-                    if last_date is None or date > last_date:
-                        local_path = os.path.join(settings.DS_NEW_FILES_DIR,
-                                                  filename)
-                        new_filenames.append(local_path)
-                        new_dates.append(date)
-                        conn.get(filename, localpath=local_path)
-
-    if new_dates and new_filenames:
-        sorted_dates, sorted_files = zip(*sorted(zip(new_dates, new_filenames)))
-        return NewFiles(list(sorted_dates), list(sorted_files))
+def list_new_files(source, last_date: typing.Optional[datetime.date]):
+    """
+    Returns:
+        RemoteFile tuples for files in the file source dated after last_date, in date order
+    """
+    new_files = []
+    spool = get_dead_letter_spool()
+    # files with spooled transactions are only uploaded by replaying them so that nothing is uploaded twice
+    spooled_filenames = spool.get_filenames() if spool else set()
+    for filename in source.listdir():
+        date = parse_filename(filename, settings.ACCOUNT_CODE)
+        if date and (last_date is None or date > last_date):
+            if filename in spooled_filenames:
+                logger.info('Skipping %s because it has transactions waiting to be replayed', filename)
+                continue
+            stat = source.stat(filename)
+            new_files.append(RemoteFile(date, filename, stat.st_size, stat.st_mtime))
+    metrics.FILES_SEEN.inc(len(new_files))
+    return sorted(new_files)
+
+
+@profiled('download', 'remote_file')
+def download_file(source, remote_file):
+    """
+    Returns:
+        the local path of the downloaded file or a DownloadedFile if IN_MEMORY_DOWNLOADS is enabled
+    """
+    with sentry_sdk.start_span(op='file.download', name=remote_file.filename) as span:
+        span.set_data('byte_count', remote_file.size)
+        local_path = os.path.join(settings.DS_NEW_FILES_DIR, remote_file.filename)
+        file_archive = get_file_archive()
+        if file_archive:
+            downloaded_file = extract_archived_file(file_archive, remote_file, local_path)
+            if downloaded_file:
+                record_download(span, file_archive.name, remote_file.size)
+                return downloaded_file
+
+        downloaded_file = fetch_file(source, remote_file, local_path)
+        record_download(span, source.name, remote_file.size)
+        if file_archive:
+            with open_downloaded_file(downloaded_file, binary=True) as f:
+                file_archive.add(remote_file, settings.ACCOUNT_CODE, f)
+        return downloaded_file
+
+
+def record_download(span, source, size):
+    span.set_data('source', source)
+    metrics.FILES_DOWNLOADED.labels(source=source).inc()
+    metrics.DOWNLOADED_BYTES.labels(source=source).inc(size)
+
+
+def download_files_in_background(source, new_files):
+    """
+    Downloads files in a background thread and yields each one as soon as it lands, in the given order;
+    at most PIPELINE_QUEUE_SIZE downloaded files wait to be processed.
+    A download error is logged and ends the files so that those before it are still uploaded;
+    the rest are downloaded by the next run.
+    """
+    downloaded = queue.Queue(maxsize=settings.PIPELINE_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def download_files():
+        # a separate Sentry scope so that download spans do not nest inside processing spans
+        with sentry_sdk.new_scope():
+            try:
+                for new_file in new_files:
+                    if stopped.is_set():
+                        return
+                    downloaded.put(download_file(source, new_file))
+            except Exception as e:
+                downloaded.put(e)
+                return
+            downloaded.put(_DOWNLOADS_COMPLETE)
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(download_files,), daemon=True)
+    thread.start()
+    try:
+        while (item := downloaded.get()) is not _DOWNLOADS_COMPLETE:
+            if isinstance(item, Exception):
+                log_download_error(item)
+                return
+            yield item
+    finally:
+        # unblock the download thread if processing stopped early
+        stopped.set()
+        while thread.is_alive():
+            try:
+                item = downloaded.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is not _DOWNLOADS_COMPLETE and not isinstance(item, Exception):
+                discard_downloaded_file(item)
+        thread.join()
+
+
+def log_download_error(error):
+    metrics.FILES_SKIPPED.labels(reason='download_failed').inc()
+    logger.error('Stopped downloading new files: %s', error, exc_info=error)
+
+
+def extract_archived_file(file_archive, remote_file, local_path):
+    """
+    Returns:
+        the local path or DownloadedFile of the archived copy of the remote file or None if there is no good copy
+    """
+    archived_file = file_archive.get(remote_file)
+    if not archived_file:
+        return None
+    logger.info('Using copy of %s from file %s', remote_file.filename, file_archive.name)
+    downloaded_file = local_path
+    try:
+        if settings.IN_MEMORY_DOWNLOADS:
+            downloaded_file = DownloadedFile(local_path, remote_file.size)
+            file_archive.extract(archived_file, downloaded_file.buffer)
+        else:
+            with open(local_path, 'wb') as f:
+                file_archive.extract(archived_file, f)
+    except (IOError, EOFError) as e:
+        # the file is archived again once downloaded
+        logger.warning('%s so it will be downloaded', e)
+        file_archive.discard(archived_file)
+        discard_downloaded_file(downloaded_file)
+        return None
+    return downloaded_file
+
+
+def fetch_file(source, remote_file, local_path):
+    is_large = remote_file.size > settings.LARGE_FILE_THRESHOLD_BYTES
+    if is_large:
+        logger.info('%s is large (%s), downloading in chunks.', remote_file.filename, remote_file.size)
+
+    if settings.IN_MEMORY_DOWNLOADS:
+        downloaded_file = DownloadedFile(local_path, remote_file.size)
+        if is_large:
+            download_in_chunks(source, remote_file.filename, downloaded_file.buffer, remote_file.size)
+        else:
+            source.getfo(remote_file.filename, downloaded_file.buffer)
+        return downloaded_file
+
+    if is_large:
+        with open(local_path, 'wb') as local_file:
+            download_in_chunks(source, remote_file.filename, local_file, remote_file.size)
     else:
-        return NewFiles([], [])
+        source.get(remote_file.filename, local_path)
+    return local_path
+
+
+class DownloadedFile:
+    """
+    A downloaded file held in memory rather than written to DS_NEW_FILES_DIR,
+    unless it is larger than IN_MEMORY_DOWNLOAD_MAX_BYTES in which case it spills into a temporary file there
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.buffer = tempfile.SpooledTemporaryFile(
+            max_size=settings.IN_MEMORY_DOWNLOAD_MAX_BYTES,
+            dir=settings.DS_NEW_FILES_DIR,
+        )
+
+    def __str__(self):
+        return self.path
+
+    @contextlib.contextmanager
+    def open(self, binary=False):
+        self.buffer.seek(0)
+        if binary:
+            yield self.buffer
+            return
+        text_file = io.TextIOWrapper(self.buffer)
+        try:
+            yield text_file
+        finally:
+            # leave the buffer open so that the file can be read again
+            text_file.detach()
+
+    def close(self):
+        self.buffer.close()
+
+
+def open_downloaded_file(filename, binary=False):
+    if isinstance(filename, DownloadedFile):
+        return filename.open(binary=binary)
+    return open(filename, 'rb' if binary else 'r')
+
+
+def get_downloaded_file_size(filename):
+    if isinstance(filename, DownloadedFile):
+        return filename.size
+    return os.path.getsize(filename)
+
+
+def discard_downloaded_file(filename):
+    # files on disk are removed at the start of the next run
+    if isinstance(filename, DownloadedFile):
+        filename.close()
+
+
+def download_in_chunks(source, filename, local_file, expected_size):
+    sha256 = hashlib.sha256()
+    size = 0
+    with source.open(filename, size=expected_size) as remote_file:
+        while chunk := remote_file.read(settings.DOWNLOAD_CHUNK_SIZE_BYTES):
+            sha256.update(chunk)
+            size += len(chunk)
+            local_file.write(chunk)
+    if size != expected_size:
+        raise IOError(f'{filename} download incomplete: received {size} of {expected_size} bytes')
+    logger.info('Downloaded %s (%d bytes, sha256 %s)', filename, size, sha256.hexdigest())
+    return sha256.hexdigest()
 
 
 def parse_filename(filename, account_code) -> typing.Optional[datetime.date]:
@@ -81,60 +297,507 @@ def parse_filename(filename, account_code) -> typing.Optional[datetime.date]:
     return None
 
 
-def retrieve_data_services_files():
+def prepare_new_files_dir():
     # check for existing downloaded files and remove if found
     if os.path.exists(settings.DS_NEW_FILES_DIR):
         shutil.rmtree(settings.DS_NEW_FILES_DIR)
     os.mkdir(settings.DS_NEW_FILES_DIR)
 
+
+def get_last_uploaded_date() -> typing.Optional[datetime.date]:
+    """
+    Returns:
+        the date of the most recent transactions uploaded, from the local watermark if UPLOAD_WATERMARK_FILE is set
+        and it was reconciled with the API recently enough
+    """
+    watermark = get_upload_watermark()
+    if not watermark:
+        return get_last_uploaded_date_from_api()
+    state = watermark.read()
+    if state and time.time() - state.reconciled_at < settings.UPLOAD_WATERMARK_RECONCILE_SECONDS:
+        return state.last_date
+    return reconcile_upload_watermark()
+
+
+def reconcile_upload_watermark() -> typing.Optional[datetime.date]:
+    """
+    Sets the local watermark to the date of the most recent transactions uploaded according to the API
+    """
+    watermark = get_upload_watermark()
+    if not watermark:
+        raise ValueError('UPLOAD_WATERMARK_FILE must be set to reconcile the upload watermark')
+    last_date = get_last_uploaded_date_from_api()
+    watermark.reconcile(last_date)
+    logger.info('Upload watermark reconciled with API: %s', last_date)
+    return last_date
+
+
+def reset_upload_watermark():
+    """
+    Removes the local watermark so that the next run starts from the API's most recent transactions
+    """
+    watermark = get_upload_watermark()
+    if not watermark:
+        raise ValueError('UPLOAD_WATERMARK_FILE must be set to reset the upload watermark')
+    watermark.reset()
+    logger.info('Upload watermark reset')
+
+
+def advance_upload_watermark(filename):
+    watermark = get_upload_watermark()
+    if watermark:
+        watermark.advance(parse_filename(str(filename), settings.ACCOUNT_CODE))
+
+
+def get_last_uploaded_date_from_api() -> typing.Optional[datetime.date]:
     # check date of most recent transactions uploaded
-    last_date = None
     conn = get_authenticated_connection()
     response = conn.transactions.get(ordering='-received_at', limit=1)
     if response.get('results'):
         last_date = response['results'][0]['received_at'][:10]
-        last_date = datetime.datetime.strptime(last_date, '%Y-%m-%d').date()
+        return datetime.datetime.strptime(last_date, '%Y-%m-%d').date()
+    return None
 
-    new_dates, new_filenames = download_new_files(last_date)
 
-    new_last_date = None
-    # find last dated file
-    if len(new_dates) > 0:
-        new_last_date = sorted(new_dates)[-1]
+def upload_transactions_from_files(files, balance_commit=None):
+    """
+    Parses and posts transactions from up to UPLOAD_CONCURRENCY files at once
+    while balances are updated in the files' date order.
+    A file's transactions are only posted once every earlier file has been parsed and no more files are started
+    once one fails, so that later files do not move the last uploaded date past a file that still needs uploading.
+    Raises:
+        the error raised by a file's worker once earlier files' balances have been updated
+    Returns:
+        the number of transactions uploaded from files whose balance was updated
+    """
+    connections = threading.local()
+    balance_commit = balance_commit or BalanceCommitStage()
+    with ThreadPoolExecutor(max_workers=settings.UPLOAD_CONCURRENCY) as executor:
+        uploads = deque()
+        upload_gate = None
+        try:
+            for filename in files:
+                # stop accepting files until the oldest is done so that only a few are held in memory
+                if len(uploads) >= settings.UPLOAD_CONCURRENCY:
+                    commit_upload(balance_commit, uploads)
+                if balance_commit.failed_filename:
+                    discard_downloaded_file(filename)
+                    break
+                upload_gate = UploadGate(upload_gate)
+                future = executor.submit(
+                    contextvars.copy_context().run, post_transactions_from_file, connections, filename, upload_gate,
+                )
+                uploads.append((filename, future, upload_gate))
+        finally:
+            # files already being uploaded are committed even if a later download or worker failed
+            while uploads:
+                commit_upload(balance_commit, uploads)
+    if balance_commit.error:
+        raise balance_commit.error
+    return balance_commit.transaction_count
+
+
+def commit_upload(balance_commit, uploads):
+    filename, future, _ = uploads.popleft()
+    if future.cancelled():
+        discard_downloaded_file(filename)
+        return
+    try:
+        uploaded = future.result()
+    except Exception as e:
+        balance_commit.fail(filename, e)
+        uploaded = _NOT_UPLOADED
+    if balance_commit.failed_filename:
+        # the latest first so that no worker starts a file after the one before it was cancelled
+        for _, later_future, later_upload_gate in reversed(uploads):
+            if later_future.cancel():
+                later_upload_gate.fail()
+    if uploaded is not _NOT_UPLOADED:
+        balance_commit.commit(filename, uploaded)
+
+
+class UploadGate:
+    """
+    Lets a worker post a file's transactions only once every earlier file has been parsed
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous
+        self.parsed = threading.Event()
+        self.failed = False
+
+    def wait_for_earlier_files(self):
+        """
+        Returns:
+            False if an earlier file failed to parse or was not started
+        """
+        if self.previous is None:
+            return True
+        self.previous.parsed.wait()
+        return not self.previous.failed
+
+    def open(self):
+        self.parsed.set()
+
+    def fail(self):
+        self.failed = True
+        self.parsed.set()
+
+
+class BalanceCommitStage:
+    """
+    Updates balances, which depend on the previous day's balance, strictly in date order.
+    Once a file fails or while earlier transactions are spooled for replay, balances for later files
+    are held back in the dead letter spool so that replaying it updates them in order.
+    `finished_filenames` are the files whose transactions were uploaded or spooled.
+    """
+
+    def __init__(self):
+        self.transaction_count = 0
+        self.failed_filename = None
+        self.error = None
+        self.finished_filenames = []
+        spool = get_dead_letter_spool()
+        dead_letters = spool.list() if spool else []
+        self.spooled_filename = dead_letters[0].filename if dead_letters else None
+
+    def fail(self, filename, error=None):
+        if self.failed_filename is None:
+            self.failed_filename = filename
+            self.error = error
+
+    def commit(self, filename, uploaded: typing.Optional[UploadedTransactions]):
+        self.finished_filenames.append(filename)
+        if uploaded is None:
+            self.fail(filename)
+            return
+        if not uploaded.transaction_count:
+            return
+        if self.failed_filename or self.spooled_filename:
+            hold_back_balance(
+                filename, uploaded, f'{self.failed_filename or self.spooled_filename} is waiting to be uploaded',
+            )
+            return
+        try:
+            transaction_count = post_balance_for_file(filename, uploaded)
+        except Exception as e:
+            self.fail(filename, e)
+            transaction_count = None
+        if transaction_count is None:
+            self.fail(filename)
+            hold_back_balance(filename, uploaded, 'balance could not be updated')
+            return
+        self.transaction_count += transaction_count
+
+
+def hold_back_balance(filename, uploaded: UploadedTransactions, reason):
+    """
+    Spools the balance change of uploaded transactions without any transactions
+    so that the balance is updated when the spool is replayed
+    """
+    metrics.FILES_SKIPPED.labels(reason='balance_held_back').inc()
+    logger.error(
+        'Balance not updated after uploading %d transactions from %s because %s',
+        uploaded.transaction_count, filename, reason,
+    )
+    spool_failed_transactions(filename, [], uploaded.balance_change, f'Balance held back because {reason}')
+
 
-    return RetrievedFiles(new_last_date, new_filenames)
+def post_transactions_from_file(connections, filename, upload_gate) -> typing.Optional[UploadedTransactions]:
+    """
+    Parses and posts transactions from a file in a worker thread using the thread's own API connection
+    Returns:
+        the transactions uploaded, with a count of 0 if the file has none to upload, None if uploading failed
+        or _NOT_UPLOADED if an earlier file failed before this one's transactions were posted
+    """
+    with sentry_sdk.new_scope():
+        try:
+            balance_records = []
+            try:
+                transactions = iter(get_transactions_from_local_file(filename, balance_records) or [])
+            except BaseException:
+                upload_gate.fail()
+                raise
+            if not upload_gate.wait_for_earlier_files():
+                upload_gate.fail()
+                return _NOT_UPLOADED
+            upload_gate.open()
+            first_transaction = next(transactions, None)
+            if first_transaction is None:
+                return UploadedTransactions(0, 0)
+            if not hasattr(connections, 'conn'):
+                connections.conn = get_authenticated_connection()
+            uploaded = post_transactions(connections.conn, filename, itertools.chain([first_transaction], transactions))
+            if uploaded:
+                uploaded = uploaded._replace(file_balance=get_file_balance(balance_records))
+            return uploaded
+        finally:
+            discard_downloaded_file(filename)
+
+
+@profiled('parse')
+def get_transactions_from_local_file(filename, balance_records=None):
+    """
+    Parses, validates and transforms a file in a single streaming pass;
+    if a list for balance records is given, the file's balance records are added to it
+    Returns:
+        the file's transactions, which are only returned once its totals are checked, or None if it is invalid
+        or has no relevant records; transactions from large files are held in a temporary file rather than in memory
+    """
+    logger.info('Processing %s...', filename)
+    size = get_downloaded_file_size(filename)
+    if size > settings.LARGE_FILE_THRESHOLD_BYTES:
+        # in the default temporary directory because DS_NEW_FILES_DIR only exists while files are downloaded
+        transactions = SpooledTransactions()
+    else:
+        transactions = []
+    quarantine = get_record_quarantine()
+    quarantined_records = [] if quarantine else None
+    with sentry_sdk.start_span(op='file.parse', name=os.path.basename(str(filename))) as span:
+        span.set_data('byte_count', size)
+        with open_downloaded_file(filename) as f:
+            data_services_file = StreamingDataServicesFile(f)
+            records = filter(is_relevant_record, data_services_file.records())
+            if balance_records is not None:
+                records = collect_balance_records(records, balance_records)
+            transactions.extend(get_transactions_from_records(records, quarantined_records))
+        span.set_data('transaction_count', len(transactions))
+    if not data_services_file.is_valid():
+        logger.error('Errors: %s', data_services_file.errors)
+        metrics.FILES_SKIPPED.labels(reason='invalid').inc()
+        return None
+    if quarantined_records:
+        quarantine_records(quarantine, filename, quarantined_records)
+    if not transactions:
+        logger.info('No records found.')
+        metrics.FILES_SKIPPED.labels(reason='no_records').inc()
+        return None
+    return transactions
 
 
-def upload_transactions_from_files(files):
+def collect_balance_records(records, balance_records):
+    # balance records are still passed on so that they are counted with the rest
+    for record in records:
+        if record.is_balance():
+            balance_records.append(record)
+        yield record
+
+
+def get_file_balance(balance_records) -> typing.Optional[FileBalance]:
+    """
+    Returns:
+        the balance brought forward (recorded ledger balance) of the first balance record and the closing balance
+        (ledger balance) of the last one, or None if the file has no balance records
+    """
+    if not balance_records:
+        return None
+    return FileBalance(
+        get_signed_balance(balance_records[0].recorded_ledger_balance, balance_records[0].recorded_ledger_balance_type),
+        get_signed_balance(balance_records[-1].ledger_balance, balance_records[-1].ledger_balance_type),
+    )
+
+
+def get_signed_balance(balance, balance_type):
+    return -balance if balance_type is BalanceType.debit else balance
+
+
+@profiled('upload')
+def post_transactions(conn, filename, transactions, dead_letter=None) -> typing.Optional[UploadedTransactions]:
+    """
+    Posts transactions in chunks; if a chunk fails, it and all later transactions are spooled for replay
+    if DEAD_LETTER_DIR is set
+    Returns:
+        the number of transactions uploaded and their balance change, or None if uploading failed
+    Raises:
+        APIUnavailableError once the transactions are spooled if the API circuit breaker is open
+    """
+    transactions = iter(transactions)
+    transaction_count = 0
+    balance_change = 0
+    if dead_letter:
+        # transactions from the same file that were uploaded before it was spooled
+        balance_change = dead_letter.balance_change
+    try:
+        for chunk in iter_chunks(transactions, settings.UPLOAD_REQUEST_SIZE):
+            with metrics.UPLOAD_CHUNK_SECONDS.time(), \
+                    sentry_sdk.start_span(op='api.post_transactions', name=os.path.basename(str(filename))) as span:
+                span.set_data('transaction_count', len(chunk))
+                conn.transactions.post(clean_request_data(chunk))
+            transaction_count += len(chunk)
+            balance_change += get_balance_change(chunk)
+            record_uploaded_transactions(chunk)
+    except API_ERRORS as e:
+        if transaction_count:
+            # like the API's latest transaction, the watermark covers partly uploaded files
+            advance_upload_watermark(filename)
+        metrics.UPLOAD_CHUNK_FAILURES.inc()
+        metrics.FILES_SKIPPED.labels(reason='upload_failed').inc()
+        logger.error(
+            'Failed to upload transactions from %s after %d were uploaded.\n%s',
+            filename,
+            transaction_count,
+            getattr(e, 'content', e)
+        )
+        spool_failed_transactions(
+            filename, itertools.chain(chunk, transactions), balance_change, getattr(e, 'content', e), dead_letter,
+        )
+        if isinstance(e, APIUnavailableError):
+            raise
+        return None
+    if not transaction_count:
+        if dead_letter:
+            # a balance held back after all of the file's transactions were uploaded
+            return UploadedTransactions(0, balance_change)
+        logger.info('No records found.')
+        metrics.FILES_SKIPPED.labels(reason='no_records').inc()
+        return None
+    advance_upload_watermark(filename)
+    return UploadedTransactions(transaction_count, balance_change)
+
+
+def spool_failed_transactions(filename, transactions, balance_change, error, dead_letter=None):
+    spool = get_dead_letter_spool()
+    if not spool:
+        return
+    filename = os.path.basename(str(filename))
+    if isinstance(error, bytes):
+        error = error.decode(errors='replace')
+    spooled_count = spool.add(
+        filename, parse_filename(filename, settings.ACCOUNT_CODE), transactions, balance_change, str(error),
+        attempts=dead_letter.attempts + 1 if dead_letter else 1,
+        created_at=dead_letter.created_at if dead_letter else None,
+    )
+    metrics.TRANSACTIONS_SPOOLED.inc(spooled_count)
+    logger.info('Spooled %d transactions from %s for replay', spooled_count, filename)
+
+
+def replay_dead_letters():
+    """
+    Replays spooled transactions in date order, retrying with exponential backoff
+    and stopping after DEAD_LETTER_REPLAY_ATTEMPTS consecutive failures
+    Returns:
+        the number of transactions uploaded
+    """
+    spool = get_dead_letter_spool()
+    if not spool:
+        logger.info('Dead letter spool is not enabled')
+        return 0
+    spool.enforce_policy()
     conn = get_authenticated_connection()
-    successful_transaction_count = 0
-    for filename in files:
-        logger.info('Processing %s...', filename)
-        with open(filename) as f:
-            data_services_file = parse(f)
-        transactions = get_transactions_from_file(data_services_file)
-        if transactions:
-            transaction_count = len(transactions)
-            try:
-                for i in range(math.ceil(transaction_count / settings.UPLOAD_REQUEST_SIZE)):
-                    conn.transactions.post(
-                        clean_request_data(transactions[
-                            i * settings.UPLOAD_REQUEST_SIZE:
-                            (i + 1) * settings.UPLOAD_REQUEST_SIZE
-                        ])
-                    )
-                stmt_date = parse_filename(filename, settings.ACCOUNT_CODE)
-                update_new_balance(transactions, stmt_date)
-                logger.info('Uploaded %d transactions from %s', transaction_count, filename)
-                successful_transaction_count += transaction_count
-            except SlumberHttpBaseException as e:
-                logger.error(
-                    'Failed to upload %d transactions from %s.\n%s',
-                    transaction_count,
-                    filename,
-                    getattr(e, 'content', e)
-                )
-    return successful_transaction_count
+    transaction_count = 0
+    failures = 0
+    while dead_letters := spool.list():
+        if failures >= settings.DEAD_LETTER_REPLAY_ATTEMPTS:
+            logger.error('Stopped replaying dead letters after %d failed attempts', failures)
+            break
+        if failures:
+            time.sleep(settings.DEAD_LETTER_REPLAY_BACKOFF_SECONDS * 2 ** (failures - 1))
+        uploaded_count = replay_dead_letter(conn, spool, dead_letters[0])
+        if uploaded_count is None:
+            # later dead letters are not replayed so that balances are updated in date order
+            failures += 1
+        else:
+            failures = 0
+            transaction_count += uploaded_count
+    logger.info(
+        'Replay of %d transactions complete', transaction_count,
+        extra={
+            'elk_fields': {
+                '@fields.transaction_count': transaction_count,
+            },
+        }
+    )
+    return transaction_count
+
+
+def replay_dead_letter(conn, spool, dead_letter):
+    """
+    Posts a dead letter's transactions and then updates the balance for its file's date;
+    any transactions that fail again, or the balance change if the balance cannot be updated,
+    are spooled as a new dead letter
+    Returns:
+        the number of transactions uploaded or None if uploading or updating the balance failed
+    """
+    logger.info(
+        'Replaying transactions from %s after %d failed attempts', dead_letter.filename, dead_letter.attempts,
+    )
+    metrics.REPLAY_ATTEMPTS.inc()
+    try:
+        uploaded = post_transactions(conn, dead_letter.filename, spool.read_transactions(dead_letter), dead_letter)
+    except APIUnavailableError:
+        # what remains has been spooled again
+        spool.remove(dead_letter)
+        raise
+    spool.remove(dead_letter)
+    if not uploaded:
+        return None
+    transaction_count = post_balance_for_file(dead_letter.filename, uploaded)
+    if transaction_count is None:
+        # replayed again so that later balances are still updated in order
+        spool_failed_transactions(
+            dead_letter.filename, [], uploaded.balance_change, 'Balance could not be updated', dead_letter,
+        )
+    return transaction_count
+
+
+def record_uploaded_transactions(transactions):
+    for category, count in Counter(transaction['category'] for transaction in transactions).items():
+        metrics.TRANSACTIONS_UPLOADED.labels(category=category or 'none').inc(count)
+
+
+@profiled('balance')
+def post_balance_for_file(filename, uploaded: UploadedTransactions):
+    """
+    Returns:
+        the number of transactions uploaded or None if the balance could not be updated
+    """
+    stmt_date = parse_filename(str(filename), settings.ACCOUNT_CODE)
+    balance_change = uploaded.balance_change
+    quarantine = get_record_quarantine()
+    if quarantine:
+        # the closing balance includes quarantined records so that it still matches the bank statement
+        balance_change += quarantine.get_balance_change(os.path.basename(str(filename)))
+    file_balance = uploaded.file_balance if settings.USE_FILE_BALANCES else None
+    if file_balance and not file_balance_reconciles(filename, file_balance, balance_change):
+        file_balance = None
+    try:
+        with metrics.BALANCE_POST_SECONDS.time():
+            if file_balance:
+                post_closing_balance(file_balance.closing_balance, stmt_date)
+            else:
+                post_new_balance(balance_change, stmt_date)
+    except SlumberHttpBaseException as e:
+        metrics.FILES_SKIPPED.labels(reason='balance_failed').inc()
+        logger.error(
+            'Failed to update balance after uploading %d transactions from %s.\n%s',
+            uploaded.transaction_count,
+            filename,
+            getattr(e, 'content', e)
+        )
+        return None
+    logger.info('Uploaded %d transactions from %s', uploaded.transaction_count, filename)
+    return uploaded.transaction_count
+
+
+def file_balance_reconciles(filename, file_balance: FileBalance, balance_change):
+    """
+    Checks that the file's closing balance is its opening balance plus the balance change of its records
+    """
+    expected_closing_balance = file_balance.opening_balance + balance_change
+    if file_balance.closing_balance == expected_closing_balance:
+        return True
+    metrics.BALANCE_MISMATCHES.inc()
+    logger.error(
+        'Closing balance in %s is %d but its opening balance and transactions add up to %d',
+        filename, file_balance.closing_balance, expected_closing_balance,
+        extra={
+            'elk_fields': {
+                '@fields.file_closing_balance': file_balance.closing_balance,
+                '@fields.expected_closing_balance': expected_closing_balance,
+            },
+        },
+    )
+    return False
 
 
 def clean_request_data(data):
@@ -148,25 +811,154 @@ def clean_request_data(data):
     return cleaned_data
 
 
-def get_transactions_from_file(data_services_file):
-    if not data_services_file.is_valid():
-        logger.error('Errors: %s', data_services_file.errors)
-        return None
+def get_transactions_from_records(records, quarantined_records=None):
+    """
+    Transforms records in batches; if a list for quarantined records is given, records that cannot be transformed
+    are added to it instead of raising an error
+    """
+    for batch in iter_chunks(records, TRANSFORM_BATCH_SIZE):
+        metrics.RECORDS_PARSED.inc(len(batch))
+        # the span must be closed before yielding so that it does not enclose the caller's spans
+        with sentry_sdk.start_span(op='records.transform') as span:
+            span.set_data('record_count', len(batch))
+            if quarantined_records is None:
+                transactions = transform_records(batch)
+            else:
+                transactions = transform_records_in_isolation(batch, quarantined_records)
+        yield from transactions
+
+
+def transform_records_in_isolation(records, quarantined_records):
+    """
+    Transforms a batch of records as a whole and, only if that fails, one record at a time
+    so that the records which raise errors can be set aside; errors talking to the API are still raised
+    """
+    try:
+        return transform_records(records)
+    except API_ERRORS:
+        raise
+    except Exception:
+        pass
+    transactions = []
+    for record in records:
+        try:
+            transactions.extend(transform_records([record]))
+        except API_ERRORS:
+            raise
+        except Exception as e:
+            quarantined_records.append(QuarantinedRecord(record, e))
+    return transactions
 
-    filtered_records = filter_relevant_records_from_all_accounts(data_services_file.accounts)
 
-    if not filtered_records:
-        logger.info('No records found.')
-        return None
+def quarantine_records(quarantine, filename, quarantined_records):
+    filename = os.path.basename(str(filename))
+    for record, error in quarantined_records:
+        logger.error(
+            'Quarantined record from %s with reference %r: %s: %s',
+            filename, record.reference_number, type(error).__name__, error,
+        )
+    quarantine.add(filename, parse_filename(filename, settings.ACCOUNT_CODE), quarantined_records)
+    metrics.RECORDS_QUARANTINED.inc(len(quarantined_records))
+    logger.info(
+        'Quarantined %d records from %s', len(quarantined_records), filename,
+        extra={
+            'elk_fields': {
+                '@fields.quarantined_record_count': len(quarantined_records),
+            },
+        },
+    )
+
+
+def replay_quarantined_records():
+    """
+    Transforms quarantined records again, e.g. once the error that stopped them has been fixed, and posts those
+    that succeed; balances already include quarantined records so they are not updated
+    Returns:
+        the number of transactions uploaded
+    """
+    quarantine = get_record_quarantine()
+    if not quarantine:
+        logger.info('Record quarantine is not enabled')
+        return 0
+    conn = get_authenticated_connection()
+    transaction_count = 0
+    for quarantine_file in quarantine.list():
+        logger.info('Replaying quarantined records from %s', quarantine_file.filename)
+        transaction_count += replay_quarantine_file(conn, quarantine, quarantine_file)
+    logger.info(
+        'Replay of %d quarantined transactions complete', transaction_count,
+        extra={
+            'elk_fields': {
+                '@fields.transaction_count': transaction_count,
+            },
+        }
+    )
+    return transaction_count
 
+
+def replay_quarantine_file(conn, quarantine, quarantine_file):
+    """
+    Returns:
+        the number of transactions uploaded; records that still fail or were not uploaded stay quarantined
+    """
+    remaining_records = []
+    replayable_records = []
     transactions = []
-    for record in filtered_records:
-        if record.is_total() or record.is_balance():
+    for quarantined_record in quarantine.read_records(quarantine_file):
+        try:
+            (transaction,) = transform_records([quarantined_record.record])
+        except API_ERRORS:
+            raise
+        except Exception as e:
+            remaining_records.append(quarantined_record._replace(error=e))
             continue
+        replayable_records.append(quarantined_record)
+        transactions.append(transaction)
 
-        sender_information = extract_sender_information(record)
-        received_at = datetime.datetime.combine(record.date, datetime.time(12, 0, 0, tzinfo=timezone.utc))
-        transaction = {
+    transaction_count = 0
+    for chunk in iter_chunks(transactions, settings.UPLOAD_REQUEST_SIZE):
+        try:
+            conn.transactions.post(clean_request_data(chunk))
+        except API_ERRORS as e:
+            logger.error(
+                'Failed to upload quarantined transactions from %s.\n%s',
+                quarantine_file.filename, getattr(e, 'content', e),
+            )
+            remaining_records.extend(replayable_records[transaction_count:])
+            break
+        transaction_count += len(chunk)
+        record_uploaded_transactions(chunk)
+
+    if remaining_records:
+        date = datetime.date.fromisoformat(quarantine_file.date) if quarantine_file.date else None
+        quarantine.add(
+            quarantine_file.filename, date, remaining_records,
+            balance_change=quarantine_file.balance_change, quarantined_at=quarantine_file.quarantined_at,
+        )
+    else:
+        quarantine.remove(quarantine_file)
+    return transaction_count
+
+
+def transform_records(records):
+    """
+    Transforms a batch of records column by column; only reference parsing and settlement matching are done per row
+    """
+    records = [record for record in records if not (record.is_total() or record.is_balance())]
+    codes = [record.transaction_code for record in records]
+    senders = [extract_sender_information(record) for record in records]
+    received_at_by_date = {
+        date: datetime.datetime.combine(date, datetime.time(12, 0, 0, tzinfo=timezone.utc)).isoformat()
+        for date in set(record.date for record in records)
+    }
+    payment_credits = [
+        code in PAYMENT_CREDIT_CODES and not sender_information.administrative
+        for code, sender_information in zip(codes, senders)
+    ]
+    categories = [CATEGORY_BY_CODE[code] for code in codes]
+
+    transactions = [
+        {
             'amount': record.amount,
             'sender_sort_code': sender_information.sort_code,
             'sender_account_number': sender_information.account_number,
@@ -175,55 +967,52 @@ def get_transactions_from_file(data_services_file):
             'incomplete_sender_info': sender_information.incomplete,
             'sender_name': record.transaction_description,
             'reference': record.reference_number,
-            'received_at': received_at.isoformat(),
-            'processor_type_code': record.transaction_code.value,
+            'received_at': received_at_by_date[record.date],
+            'processor_type_code': code.value,
         }
-        # payment credits
-        if ((record.transaction_code == TransactionCode.credit_bacs_credit or
-                record.transaction_code == TransactionCode.credit_sundry_credit) and
-                not sender_information.administrative):
-            transaction['category'] = 'credit'
-            transaction['source'] = 'bank_transfer'
-
-            parsed_ref = extract_prisoner_details(record)
-            if parsed_ref:
-                number, dob, from_description_field = parsed_ref
-                transaction['prisoner_number'] = number
-                transaction['prisoner_dob'] = dob.isoformat()
-                transaction['reference_in_sender_field'] = from_description_field
-
-            if settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED:
-                # makes all credit-type transactions "unidentified" so that they will not be credited or refunded
-                transaction['blocked'] = True
-                transaction['incomplete_sender_info'] = True
-        # other credits (e.g. bacs returned)
-        elif record.is_credit():
-            transaction['category'] = 'credit'
-            transaction['source'] = 'administrative'
-
+        for record, code, sender_information in zip(records, codes, senders)
+    ]
+    for transaction, category, payment_credit in zip(transactions, categories, payment_credits):
+        if category:
+            transaction['category'] = category
+            transaction['source'] = 'bank_transfer' if payment_credit else 'administrative'
+
+    for record, transaction, category, payment_credit in zip(records, transactions, categories, payment_credits):
+        if payment_credit:
+            add_prisoner_details(transaction, record)
+        elif category == 'credit':
             batch_id = get_matching_batch_id_for_settlement(record)
             if batch_id:
                 transaction['batch'] = batch_id
-        # all debits
-        elif record.is_debit():
-            transaction['category'] = 'debit'
-            transaction['source'] = 'administrative'
-
-        transactions.append(transaction)
-
     return transactions
 
 
-def filter_relevant_records_from_all_accounts(accounts):
-    # read transactions from all data services file "accounts"
-    # to cater for both single-account and multiple-account formats
-    records = itertools.chain.from_iterable(account.records for account in accounts)
+def add_prisoner_details(transaction, record):
+    parsed_ref = extract_prisoner_details(record)
+    if parsed_ref:
+        number, dob, from_description_field = parsed_ref
+        transaction['prisoner_number'] = number
+        transaction['prisoner_dob'] = dob.isoformat()
+        transaction['reference_in_sender_field'] = from_description_field
+        prisoner_location_index = get_prisoner_location_index()
+        matched = prisoner_location_index.matches(number, dob) if prisoner_location_index else None
+        if matched is not None:
+            metrics.PRISONER_REFERENCES.labels(match='matched' if matched else 'unmatched').inc()
+            if not matched:
+                logger.info('Prisoner number %s is not in the prisoner locations snapshot', number)
+
+    if settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED:
+        # makes all credit-type transactions "unidentified" so that they will not be credited or refunded
+        transaction['blocked'] = True
+        transaction['incomplete_sender_info'] = True
+
+
+def is_relevant_record(record):
     # filter out only transactions involving account selected with settings
-    records = filter(lambda record: (
+    return (
         record.branch_sort_code == settings.NOMS_AGENCY_SORT_CODE and
         record.branch_account_number == settings.NOMS_AGENCY_ACCOUNT_NUMBER
-    ), records)
-    return list(records)
+    )
 
 
 def extract_prisoner_details(record):
@@ -269,18 +1058,11 @@ def parse_credit_reference(ref):
 
 def extract_sender_information(record):
     sort_code = record.originators_sort_code
-    account_number = record.originators_account_number
+    classification = get_sender_classification_cache().classify(sort_code, record.originators_account_number)
+    account_number = classification.account_number
     roll_number = None
-    roll_number_expected = False
-
-    # 0 filled normally means absent, but some building societies
-    # use it for roll number accounts
-    building_soc_account_number = account_number or ('0' * 8)
-
-    if roll_number_required(sort_code, building_soc_account_number):
-        roll_number_expected = True
-        account_number = building_soc_account_number
 
+    if classification.roll_number_required:
         if record.is_debit():
             candidate_roll_number = record.reference_number
         else:
@@ -292,15 +1074,16 @@ def extract_sender_information(record):
     anonymous = sort_code is None or account_number is None
     incomplete_sender_info = (
         anonymous or
-        (roll_number_expected and roll_number is None) or
-        is_correspondence_account(sort_code, account_number)
+        (classification.roll_number_required and roll_number is None) or
+        classification.correspondence_account
     )
 
     return SenderInformation(
         sort_code, account_number, roll_number, anonymous, incomplete_sender_info,
-        any(
+        classification.administrative_account or any(
             identifier.matches(account_number, sort_code, record.transaction_description, record.reference_number)
             for identifier in ADMINISTRATIVE_IDENTIFIERS
+            if not identifier.is_account_only
         )
     )
 
@@ -328,7 +1111,8 @@ def get_matching_batch_id_for_settlement(record):
 
     # get batch id for date if found
     conn = get_authenticated_connection()
-    response = conn.batches.get(date=batch_date.isoformat())
+    with sentry_sdk.start_span(op='api.get_batches', name=batch_date.isoformat()):
+        response = conn.batches.get(date=batch_date.isoformat())
     if response.get('results'):
         return response['results'][0]['id']
 
@@ -355,28 +1139,62 @@ def parse_4_digit_date(date_str, relative_date: datetime.date) -> datetime.date:
 
 
 def update_new_balance(transactions, date: datetime.date):
-    conn = get_authenticated_connection()
-    response = conn.balances.get(limit=1, date__lt=date.isoformat())
-    if response.get('results'):
-        balance = response['results'][0]['closing_balance']
-    else:
-        balance = 0
+    post_new_balance(get_balance_change(transactions), date)
 
+
+def get_balance_change(transactions):
+    balance_change = 0
     for t in transactions:
         if t['category'] == 'credit':
-            balance += t['amount']
+            balance_change += t['amount']
         elif t['category'] == 'debit':
-            balance -= t['amount']
+            balance_change -= t['amount']
+    return balance_change
+
+
+def post_new_balance(balance_change, date: datetime.date):
+    with sentry_sdk.start_span(op='api.post_balance', name=date.isoformat()) as span:
+        span.set_data('balance_change', balance_change)
+        conn = get_authenticated_connection()
+        response = conn.balances.get(limit=1, date__lt=date.isoformat())
+        if response.get('results'):
+            balance = response['results'][0]['closing_balance']
+        else:
+            balance = 0
+
+        conn.balances.post({
+            'date': date.isoformat(),
+            'closing_balance': balance + balance_change,
+        })
+
 
-    conn.balances.post({
-        'date': date.isoformat(),
-        'closing_balance': balance,
-    })
+def post_closing_balance(closing_balance, date: datetime.date):
+    # taken from the file's balance records so the previous balance does not need to be looked up
+    with sentry_sdk.start_span(op='api.post_balance', name=date.isoformat()) as span:
+        span.set_data('closing_balance', closing_balance)
+        conn = get_authenticated_connection()
+        conn.balances.post({
+            'date': date.isoformat(),
+            'closing_balance': closing_balance,
+        })
 
 
 def main():
-    last_date, files = retrieve_data_services_files()
-    file_count = len(files)
+    prepare_new_files_dir()
+    last_date = get_last_uploaded_date()
+    with get_file_source() as source:
+        new_files = list_new_files(source, last_date)
+        upload_new_files(source, new_files)
+    file_archive = get_file_archive()
+    if file_archive:
+        file_archive.log_stats()
+
+
+def upload_new_files(source, new_files):
+    """
+    Processes each file in date order as soon as it is downloaded while later files continue downloading
+    """
+    file_count = len(new_files)
     if file_count == 0:
         logger.info(
             'No new files available to upload',
@@ -389,14 +1207,17 @@ def main():
         return
 
     logger.info(
-        'Uploading transactions from new files: %s', ', '.join(files),
+        'Uploading transactions from new files: %s', ', '.join(new_file.filename for new_file in new_files),
         extra={
             'elk_fields': {
                 '@fields.file_count': file_count,
             },
         }
     )
-    transaction_count = upload_transactions_from_files(files)
+    start_sender_classification_cache()
+    with contextlib.closing(download_files_in_background(source, new_files)) as downloaded_files:
+        transaction_count = upload_transactions_from_files(downloaded_files)
+    finish_sender_classification_cache()
     logger.info(
         'Upload of %d transactions complete', transaction_count,
         extra={
@@ -0,0 +1,223 @@
+import logging
+import os
+import re
+import signal
+import threading
+import time
+
+import sentry_sdk
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+from mtp_transaction_uploader import metrics, settings, upload
+from mtp_transaction_uploader.patterns import FILE_PATTERN_STR
+from mtp_transaction_uploader.sender_classification import (
+    finish_sender_classification_cache, start_sender_classification_cache,
+)
+from mtp_transaction_uploader.spool import get_dead_letter_spool
+
+logger = logging.getLogger('mtp')
+
+
+def watch_drop_directory():
+    """
+    Uploads files dropped into WATCH_DIR until the process is interrupted or terminated
+    """
+    if not settings.WATCH_DIR:
+        raise ValueError('WATCH_DIR must be set to watch a drop directory')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    watcher = DropDirectoryWatcher(
+        settings.WATCH_DIR,
+        settle_seconds=settings.WATCH_SETTLE_SECONDS,
+        poll_seconds=settings.WATCH_POLL_SECONDS,
+        use_polling=settings.WATCH_POLLING,
+    )
+    try:
+        watcher.run(stop)
+    except KeyboardInterrupt:
+        pass
+    logger.info('Stopped watching %s', settings.WATCH_DIR)
+
+
+class DropDirectoryEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.watcher.file_changed(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.watcher.file_changed(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.watcher.file_changed(event.dest_path)
+
+
+class DropDirectoryWatcher:
+    """
+    Uploads data services files dropped into a local directory, e.g. a mirror of the SFTP directory,
+    as soon as they have stopped changing for `settle_seconds`.
+    Changes are noticed with inotify where available and otherwise by polling the directory.
+    Like scheduled runs, only files dated after the last uploaded transactions are uploaded, each date only once.
+    Files that were not uploaded because an earlier file failed are retried with the next batch of settled files
+    so that later files are never uploaded before them.
+    """
+
+    def __init__(self, directory, settle_seconds, poll_seconds, use_polling=False):
+        self.directory = directory
+        self.settle_seconds = settle_seconds
+        self.poll_seconds = poll_seconds
+        self.use_polling = use_polling
+        # whole names only so that partly copied files with a temporary suffix are ignored
+        self.file_pattern = re.compile(FILE_PATTERN_STR % {'code': settings.ACCOUNT_CODE}, re.X)
+        # file name -> (size, modification time, monotonic time since which they have been unchanged)
+        self.pending = {}
+        self.uploaded_dates = set()
+        self.unfinished_paths = []
+        self.last_date = None
+        self.lock = threading.Lock()
+
+    def run(self, stop):
+        self.last_date = upload.get_last_uploaded_date()
+        observer = self.start_observer()
+        try:
+            # files dropped while the uploader was not running
+            for filename in os.listdir(self.directory):
+                self.file_changed(os.path.join(self.directory, filename))
+            while not stop.wait(self.poll_seconds):
+                settled_files = self.get_settled_files()
+                if settled_files:
+                    self.upload(settled_files)
+        finally:
+            observer.stop()
+            observer.join()
+
+    def start_observer(self):
+        if not self.use_polling:
+            try:
+                observer = Observer()
+                observer.schedule(DropDirectoryEventHandler(self), self.directory)
+                observer.start()
+                logger.info('Watching %s for new files', self.directory)
+                return observer
+            except OSError as e:
+                logger.warning('Cannot watch %s for changes so polling instead: %s', self.directory, e)
+        observer = PollingObserver(timeout=self.poll_seconds)
+        observer.schedule(DropDirectoryEventHandler(self), self.directory)
+        observer.start()
+        logger.info('Polling %s for new files', self.directory)
+        return observer
+
+    def file_changed(self, path):
+        filename = os.path.basename(path)
+        if not self.file_pattern.fullmatch(filename):
+            return
+        date = upload.parse_filename(filename, settings.ACCOUNT_CODE)
+        if date in self.uploaded_dates:
+            return
+        if self.last_date and date <= self.last_date:
+            logger.info('Ignoring %s because transactions have already been uploaded for that date', filename)
+            return
+        with self.lock:
+            # (re)starts the wait for the file to settle
+            self.pending[filename] = None
+
+    def get_settled_files(self):
+        """
+        Returns:
+            paths of pending files whose size and modification time have not changed for `settle_seconds`,
+            in date order
+        """
+        now = time.monotonic()
+        settled_files = []
+        with self.lock:
+            for filename, last_seen in list(self.pending.items()):
+                try:
+                    stat = os.stat(os.path.join(self.directory, filename))
+                except FileNotFoundError:
+                    # e.g. a temporary file that was renamed
+                    del self.pending[filename]
+                    continue
+                if last_seen is None or last_seen[:2] != (stat.st_size, stat.st_mtime):
+                    self.pending[filename] = (stat.st_size, stat.st_mtime, now)
+                elif now - last_seen[2] >= self.settle_seconds:
+                    del self.pending[filename]
+                    settled_files.append(filename)
+        return [
+            os.path.join(self.directory, filename)
+            for filename in sorted(settled_files, key=lambda filename: upload.parse_filename(
+                filename, settings.ACCOUNT_CODE
+            ))
+        ]
+
+    def get_new_paths(self, paths):
+        """
+        Returns:
+            paths of files dated after the last uploaded transactions that have not been uploaded, in date order
+        """
+        # scheduled runs or replays may have uploaded transactions since the last batch
+        self.last_date = upload.get_last_uploaded_date()
+        spool = get_dead_letter_spool()
+        spooled_filenames = spool.get_filenames() if spool else set()
+        new_paths = []
+        for path in sorted(paths, key=self.get_date):
+            filename = os.path.basename(path)
+            date = self.get_date(path)
+            if date in self.uploaded_dates:
+                continue
+            if self.last_date and date <= self.last_date:
+                logger.info('Ignoring %s because transactions have already been uploaded for that date', filename)
+                continue
+            if filename in spooled_filenames:
+                logger.info('Skipping %s because it has transactions waiting to be replayed', filename)
+                continue
+            self.uploaded_dates.add(date)
+            new_paths.append(path)
+        return new_paths
+
+    @classmethod
+    def get_date(cls, path):
+        return upload.parse_filename(os.path.basename(path), settings.ACCOUNT_CODE)
+
+    def upload(self, paths):
+        paths = self.unfinished_paths + [path for path in paths if path not in self.unfinished_paths]
+        new_paths = paths
+        balance_commit = None
+        start_time = time.monotonic()
+        try:
+            new_paths = self.get_new_paths(paths)
+            if not new_paths:
+                return
+            metrics.FILES_SEEN.inc(len(new_paths))
+            logger.info('Uploading transactions from dropped files: %s', ', '.join(map(os.path.basename, new_paths)))
+            with sentry_sdk.start_transaction(op='uploader.watch', name='Upload dropped files'):
+                start_sender_classification_cache()
+                balance_commit = upload.BalanceCommitStage()
+                transaction_count = upload.upload_transactions_from_files(new_paths, balance_commit)
+                finish_sender_classification_cache()
+        except Exception as e:
+            # keep watching; unfinished files are retried with the next batch
+            metrics.record_run(time.monotonic() - start_time, success=False)
+            logger.exception('Failed to upload dropped files')
+            sentry_sdk.capture_exception(e)
+            return
+        finally:
+            finished_paths = balance_commit.finished_filenames if balance_commit else []
+            self.unfinished_paths = [path for path in new_paths if path not in finished_paths]
+            for path in self.unfinished_paths:
+                self.uploaded_dates.discard(self.get_date(path))
+        metrics.record_run(time.monotonic() - start_time, success=True)
+        logger.info(
+            'Upload of %d transactions complete', transaction_count,
+            extra={
+                'elk_fields': {
+                    '@fields.transaction_count': transaction_count,
+                },
+            }
+        )
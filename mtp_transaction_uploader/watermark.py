@@ -0,0 +1,102 @@
+from collections import namedtuple
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.files import atomic_write
+from mtp_transaction_uploader.shared import SharedInstance
+
+logger = logging.getLogger('mtp')
+
+Watermark = namedtuple('Watermark', ['last_date', 'updated_at', 'reconciled_at'])
+
+_upload_watermark = SharedInstance()
+
+
+def get_upload_watermark():
+    """
+    Returns:
+        the shared UploadWatermark or None if UPLOAD_WATERMARK_FILE is not set
+    """
+    path = settings.UPLOAD_WATERMARK_FILE
+    if not path:
+        return None
+    return _upload_watermark.get(path, lambda: UploadWatermark(path))
+
+
+class UploadWatermark:
+    """
+    Date of the latest file from which transactions were uploaded, kept in a local JSON file so that
+    the API does not need to be asked for its latest transaction at the start of each run.
+    `reconciled_at` is when the date was last set from the API rather than advanced locally.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def read(self):
+        """
+        Returns:
+            the Watermark or None if there is none or it cannot be read
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            return Watermark(
+                datetime.date.fromisoformat(state['last_date']) if state['last_date'] else None,
+                state['updated_at'],
+                state['reconciled_at'],
+            )
+        except FileNotFoundError:
+            return None
+        except (KeyError, TypeError, ValueError):
+            logger.warning('Upload watermark is corrupt and will be replaced')
+            return None
+
+    def advance(self, date: datetime.date):
+        """
+        Moves the watermark forward to the date of a file whose transactions were uploaded;
+        it never moves back so files can be uploaded concurrently or replayed out of order
+        """
+        with self.lock:
+            watermark = self.read()
+            if watermark is None:
+                # only a date from the API can be trusted as the starting point
+                return
+            if watermark.last_date and watermark.last_date >= date:
+                return
+            self._write(Watermark(date, time.time(), watermark.reconciled_at))
+
+    def reconcile(self, last_date: datetime.date):
+        """
+        Replaces the watermark with the date of the latest transaction in the API
+        """
+        with self.lock:
+            watermark = self.read()
+            if watermark and watermark.last_date != last_date:
+                logger.warning(
+                    'Upload watermark was %s but the latest transactions in the API are from %s',
+                    watermark.last_date, last_date,
+                )
+            now = time.time()
+            self._write(Watermark(last_date, now, now))
+
+    def reset(self):
+        with self.lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def _write(self, watermark):
+        with atomic_write(self.path) as f:
+            json.dump({
+                'last_date': watermark.last_date.isoformat() if watermark.last_date else None,
+                'updated_at': watermark.updated_at,
+                'reconciled_at': watermark.reconciled_at,
+            }, f)
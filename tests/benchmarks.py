@@ -0,0 +1,317 @@
+"""
+Micro-benchmarks of functions called once or more for every record in a data services file,
+run against generated corpora shaped like real files.
+
+Costs are measured relative to a fixed calibration workload timed in the same run so that baselines
+recorded on one machine can be compared on another. To compare with the stored baselines:
+
+    python -m tests.benchmarks
+
+and to record new baselines after an intended change in performance:
+
+    python -m tests.benchmarks --update-baselines
+"""
+import argparse
+from collections import namedtuple
+import datetime
+import gc
+import json
+import os
+import random
+import re
+import sys
+import time
+
+from bankline_parser.data_services.models import DataRecord
+
+from mtp_transaction_uploader import upload
+from mtp_transaction_uploader.patterns import ADMINISTRATIVE_IDENTIFIERS
+from mtp_transaction_uploader.sender_classification import start_sender_classification_cache
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), 'data', 'benchmark_baselines.json')
+# relative costs may rise by this fraction before counting as a regression; micro-benchmarks are noisy
+DEFAULT_TOLERANCE = 0.3
+CORPUS_SIZE = 5000
+REPEAT = 7
+
+Benchmark = namedtuple('Benchmark', ['name', 'func', 'get_inputs'])
+BenchmarkResult = namedtuple('BenchmarkResult', ['name', 'cost', 'baseline', 'regressed'])
+
+# (sort code, account number) of sender banks: ordinary accounts, building societies needing roll numbers
+# and correspondence accounts
+SENDER_BANKS = [
+    ('608006', None), ('245432', None), ('400530', None), ('309634', None), ('771424', None),
+    ('134000', '00000000'), ('621719', None), ('571327', '00000000'), ('235954', '00000008'),
+    ('203253', None), ('200353', '73152596'),
+]
+
+
+class Corpus:
+    """
+    Inputs generated deterministically from a seed; most credits have a well-formed prisoner reference
+    while the rest have typos, reversed or missing dates of birth or are settlements and refunds
+    """
+
+    def __init__(self, size=CORPUS_SIZE, seed=0):
+        self.random = random.Random(seed)
+        senders = [self.make_sender() for _ in range(max(size // 4, 1))]
+        # people tend to send money repeatedly so senders recur
+        self.records = [self.make_record(self.random.choice(senders)) for _ in range(size)]
+        self.filenames = [self.make_filename() for _ in range(size)]
+        self.settlement_dates = [self.make_settlement_date() for _ in range(size)]
+        self.transactions = [self.make_transaction(record) for record in self.records]
+
+    def make_sender(self):
+        sort_code, account_number = self.random.choice(SENDER_BANKS)
+        return sort_code, account_number or f'{self.random.randrange(10 ** 8):08d}'
+
+    def make_prisoner_reference(self):
+        number = (
+            f'{self.random.choice("ABG")}{self.random.randrange(10 ** 4):04d}'
+            f'{self.random.choice("ABCDEFXYZ")}{self.random.choice("ABCDEFXYZ")}'
+        )
+        day, month, year = self.random.randint(1, 28), self.random.randint(1, 12), self.random.randint(1940, 2005)
+        dob = self.random.choice([
+            f'{day:02d}/{month:02d}/{year}', f'{day}/{month}/{year % 100:02d}', f'{day:02d}{month:02d}{year}',
+            f'{day:02d}-{month:02d}-{year}', f'{day:02d}.{month:02d}.{year % 100:02d}',
+        ])
+        return self.random.choice([
+            f'{number} {dob}', f'{number}{dob}', f'{number.lower()} {dob}', f'{dob} {number}', f' {number}  {dob} ',
+        ])
+
+    def make_reference(self):
+        kind = self.random.random()
+        if kind < 0.7:
+            return self.make_prisoner_reference(), ''
+        if kind < 0.8:
+            # reference given in the sender's name field
+            return 'PAYMENT', self.make_prisoner_reference()
+        if kind < 0.85:
+            return f'TT- GGGGGGGG -{self.random.randint(1, 28):02d}{self.random.randint(1, 12):02d}', ''
+        return self.random.choice([
+            '', 'BIRTHDAY MONEY', 'A1234', 'PRISONER A1234BC', 'A1234BC 31/02/1990', 'A1234BC1990', '12345678',
+        ]), ''
+
+    def make_record(self, sender):
+        sort_code, account_number = sender
+        code = self.random.choices(['99', '93', '03', '86'], weights=[80, 10, 5, 5])[0]
+        reference, description = self.make_reference()
+        description = description or self.random.choice(['J SMITH', 'MRS A JONES', 'NW-CHASE  PSC-0302', 'SAVINGS'])
+        row = (
+            f'12345667175315'  # NOMS account
+            f'0{code}{sort_code}{account_number}0000{self.random.randint(100, 50000):011d}'
+            f'{description[:18]:<18}{reference[:18]:<18}{"":18} 04036'
+        )
+        return DataRecord(row)
+
+    def make_filename(self):
+        date = datetime.date(2014, 1, 1) + datetime.timedelta(days=self.random.randrange(3000))
+        return self.random.choices([
+            f'/tmp/ds_new_files/Y01A.CARS.#D.444444.D{date:%d%m%y}',
+            f'Y01A.CARS.#D.444444.D{date:%d%m%y}',
+            f'Y01A.CARS.#D.555555.D{date:%d%m%y}',
+            'Y01A.CARS.#D.444444.README',
+        ], weights=[45, 45, 5, 5])[0]
+
+    def make_settlement_date(self):
+        relative_date = datetime.date(2014, 1, 1) + datetime.timedelta(days=self.random.randrange(3000))
+        settlement_date = relative_date - datetime.timedelta(days=self.random.randrange(60))
+        return relative_date, settlement_date
+
+    def make_transaction(self, record):
+        sender_information = upload.extract_sender_information(record)
+        transaction = {
+            'amount': record.amount,
+            'sender_sort_code': sender_information.sort_code,
+            'sender_account_number': sender_information.account_number,
+            'sender_roll_number': sender_information.roll_number,
+            'blocked': sender_information.anonymous,
+            'incomplete_sender_info': sender_information.incomplete,
+            'sender_name': record.transaction_description,
+            'reference': record.reference_number,
+            'received_at': '2014-02-05T12:00:00+00:00',
+            'processor_type_code': record.transaction_code.value,
+            'category': 'credit' if record.is_credit() else 'debit',
+            'source': 'bank_transfer',
+        }
+        upload.add_prisoner_details(transaction, record)
+        return transaction
+
+
+def match_administrative_identifiers(account_number, sort_code, sender_name, reference):
+    return [
+        identifier.matches(account_number, sort_code, sender_name, reference)
+        for identifier in ADMINISTRATIVE_IDENTIFIERS
+    ]
+
+
+def parse_settlement_date(parse_date, date_str, relative_date):
+    # dates that do not exist in the relative month are skipped as in get_matching_batch_id_for_settlement
+    try:
+        return parse_date(date_str, relative_date)
+    except ValueError:
+        return None
+
+
+def chunk(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+BENCHMARKS = [
+    Benchmark(
+        'parse_credit_reference', upload.parse_credit_reference,
+        lambda corpus: [(record.reference_number,) for record in corpus.records],
+    ),
+    Benchmark(
+        'extract_prisoner_details', upload.extract_prisoner_details,
+        lambda corpus: [(record,) for record in corpus.records],
+    ),
+    Benchmark(
+        'extract_sender_information', upload.extract_sender_information,
+        lambda corpus: [(record,) for record in corpus.records],
+    ),
+    Benchmark(
+        'PaymentIdentifier.matches', match_administrative_identifiers,
+        lambda corpus: [
+            (
+                record.originators_account_number, record.originators_sort_code,
+                record.transaction_description, record.reference_number,
+            )
+            for record in corpus.records
+        ],
+    ),
+    Benchmark(
+        'parse_filename', upload.parse_filename,
+        lambda corpus: [(filename, '444444') for filename in corpus.filenames],
+    ),
+    Benchmark(
+        'parse_2_digit_date', parse_settlement_date,
+        lambda corpus: [
+            (upload.parse_2_digit_date, f'{settlement_date:%d}', relative_date)
+            for relative_date, settlement_date in corpus.settlement_dates
+        ],
+    ),
+    Benchmark(
+        'parse_4_digit_date', parse_settlement_date,
+        lambda corpus: [
+            (upload.parse_4_digit_date, f'{settlement_date:%d%m}', relative_date)
+            for relative_date, settlement_date in corpus.settlement_dates
+        ],
+    ),
+    Benchmark(
+        # per request of UPLOAD_REQUEST_SIZE transactions rather than per record
+        'clean_request_data', upload.clean_request_data,
+        lambda corpus: [(transactions,) for transactions in chunk(corpus.transactions, 100)],
+    ),
+]
+
+_CALIBRATION_PATTERN = re.compile(r'(?P<word>[A-Z]+)(?P<number>[0-9]+)')
+
+
+def calibration_workload(text):
+    # a mix of the regular expression, string and dict work typical of per-record functions
+    fields = {}
+    for match in _CALIBRATION_PATTERN.finditer(text):
+        fields[match.group('word').lower()] = int(match.group('number'))
+    return sorted(fields.items())
+
+
+def time_pass(func, inputs):
+    start = time.perf_counter()
+    for args in inputs:
+        func(*args)
+    return (time.perf_counter() - start) / len(inputs)
+
+
+def time_relative(func, inputs, calibration_inputs, repeat):
+    """
+    Returns:
+        the fastest of `repeat` passes over the inputs relative to the fastest pass of the calibration workload;
+        passes alternate so that changes in machine speed during the run affect both
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = best_calibration = float('inf')
+        for _ in range(repeat):
+            best_calibration = min(best_calibration, time_pass(calibration_workload, calibration_inputs))
+            best = min(best, time_pass(func, inputs))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return best / best_calibration
+
+
+def run_benchmarks(names=None, corpus_size=CORPUS_SIZE, repeat=REPEAT):
+    """
+    Returns:
+        the cost of each benchmark per call relative to the calibration workload
+    """
+    start_sender_classification_cache()
+    corpus = Corpus(corpus_size)
+    calibration_inputs = [
+        (f'{record.transaction_description}{record.amount} {record.reference_number}',)
+        for record in corpus.records
+    ]
+    return {
+        benchmark.name: time_relative(benchmark.func, benchmark.get_inputs(corpus), calibration_inputs, repeat)
+        for benchmark in BENCHMARKS
+        if not names or benchmark.name in names
+    }
+
+
+def load_baselines(path=BASELINES_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(costs, path=BASELINES_PATH):
+    baselines = load_baselines(path)
+    baselines.update({name: round(cost, 3) for name, cost in costs.items()})
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare_with_baselines(costs, baselines, tolerance=DEFAULT_TOLERANCE):
+    """
+    Returns:
+        BenchmarkResult tuples; benchmarks without a baseline never count as regressed
+    """
+    results = []
+    for name, cost in costs.items():
+        baseline = baselines.get(name)
+        results.append(BenchmarkResult(name, cost, baseline, bool(baseline) and cost > baseline * (1 + tolerance)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks per-record functions against stored baselines')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--update-baselines', action='store_true', help='store the results as new baselines')
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help=f'fraction by which a cost may exceed its baseline (default: {DEFAULT_TOLERANCE})',
+    )
+    parser.add_argument('--corpus-size', type=int, default=CORPUS_SIZE)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    args = parser.parse_args()
+
+    costs = run_benchmarks(args.names, corpus_size=args.corpus_size, repeat=args.repeat)
+    if args.update_baselines:
+        save_baselines(costs)
+        print(f'Baselines saved to {BASELINES_PATH}')
+        return 0
+
+    results = compare_with_baselines(costs, load_baselines(), args.tolerance)
+    for result in results:
+        baseline = f'{result.baseline:10.3f}' if result.baseline else '       n/a'
+        print(f'{result.name:30} {result.cost:10.3f} {baseline}  {"REGRESSED" if result.regressed else "ok"}')
+    return 1 if any(result.regressed for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import socket
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import paramiko
+
+
+class Faults:
+    """
+    Injectable latency, error rate and throughput cap;
+    API errors respond with `error_status` and a Retry-After header if `retry_after` is set
+    """
+
+    def __init__(self, latency=0, error_rate=0, bytes_per_second=None, seed=None, error_status=500, retry_after=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.bytes_per_second = bytes_per_second
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self, size=0):
+        delay = self.latency
+        if self.bytes_per_second:
+            delay += size / self.bytes_per_second
+        if delay:
+            time.sleep(delay)
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class StandInAPI:
+    """
+    Serves the oauth token, `transactions`, `balances` and `batches` endpoints from memory.
+    Faults can be set for all endpoints or per endpoint as 'transactions' or 'POST transactions'.
+    """
+    access_token = 'stand-in-token'
+
+    def __init__(self, faults=None, endpoint_faults=None, batches=None):
+        self.faults = faults or Faults()
+        self.endpoint_faults = endpoint_faults or {}
+        self.transactions = []
+        self.balances = []
+        self.batches = list(batches or [])
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _APIRequestHandler)
+        self.server.stand_in = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def get_faults(self, method, endpoint):
+        return self.endpoint_faults.get(f'{method} {endpoint}') or self.endpoint_faults.get(endpoint) or self.faults
+
+    def handle(self, method, endpoint, query, body):
+        """
+        Returns:
+            (status code, response data)
+        """
+        with self.lock:
+            self.request_count += 1
+            handler = getattr(self, f'{method.lower()}_{endpoint}', None)
+            if not handler:
+                return 404, {'detail': 'Not found.'}
+            return handler(query, body)
+
+    def get_transactions(self, query, _):
+        results = self.transactions
+        if query.get('ordering') == '-received_at':
+            results = sorted(results, key=lambda transaction: transaction['received_at'], reverse=True)
+        return 200, self._paginate(results, query)
+
+    def post_transactions(self, _, body):
+        for transaction in body:
+            transaction['id'] = len(self.transactions) + 1
+            self.transactions.append(transaction)
+        return 201, body
+
+    def get_balances(self, query, _):
+        results = sorted(self.balances, key=lambda balance: balance['date'], reverse=True)
+        if 'date__lt' in query:
+            results = [balance for balance in results if balance['date'] < query['date__lt']]
+        return 200, self._paginate(results, query)
+
+    def post_balances(self, _, body):
+        self.balances = [balance for balance in self.balances if balance['date'] != body['date']]
+        self.balances.append(body)
+        return 201, body
+
+    def get_batches(self, query, _):
+        results = self.batches
+        if 'date' in query:
+            results = [batch for batch in results if batch['date'] == query['date']]
+        return 200, self._paginate(results, query)
+
+    @classmethod
+    def _paginate(cls, results, query):
+        limit = int(query.get('limit', 100))
+        return {'count': len(results), 'results': results[:limit]}
+
+
+class _APIRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802
+        self.respond('GET')
+
+    def do_POST(self):  # noqa: N802
+        self.respond('POST')
+
+    def respond(self, method):
+        stand_in = self.server.stand_in
+        url = urlparse(self.path)
+        endpoint = url.path.strip('/').split('/')[-1]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        faults = stand_in.get_faults(method, endpoint)
+        faults.delay(len(body))
+        if faults.should_fail():
+            headers = {'Retry-After': str(faults.retry_after)} if faults.retry_after is not None else {}
+            return self.send_json(faults.error_status, {'detail': 'Injected error'}, headers)
+
+        if endpoint == 'token':
+            return self.send_json(200, {
+                'access_token': stand_in.access_token,
+                'token_type': 'Bearer',
+                'expires_in': 36000,
+                'refresh_token': 'stand-in-refresh-token',
+            })
+        if self.headers.get('Authorization') != f'Bearer {stand_in.access_token}':
+            return self.send_json(401, {'detail': 'Authentication credentials were not provided.'})
+
+        status, data = stand_in.handle(method, endpoint, query, json.loads(body) if body else None)
+        self.send_json(status, data)
+
+    def send_json(self, status, data, headers=None):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+
+class StandInSFTPServer:
+    """
+    Serves a local directory read-only over SFTP, accepting any credentials
+    """
+
+    def __init__(self, root, faults=None):
+        self.root = os.path.realpath(root)
+        self.faults = faults or Faults()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.create_server(('127.0.0.1', 0))
+        self.socket.settimeout(0.1)
+        self.stopped = threading.Event()
+        self.transports = []
+        self.thread = None
+
+    @property
+    def host(self):
+        return self.socket.getsockname()[0]
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.accept_connections, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+    def accept_connections(self):
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _DirectorySFTPServer, stand_in=self)
+            transport.start_server(server=_SSHServer())
+            self.transports.append(transport)
+
+    def local_path(self, path):
+        local_path = os.path.realpath(os.path.join(self.root, path.lstrip('/')))
+        if os.path.commonpath([self.root, local_path]) != self.root:
+            raise PermissionError(path)
+        return local_path
+
+
+class _SSHServer(paramiko.ServerInterface):
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey,password'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+class _DirectorySFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, stand_in=None, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.stand_in = stand_in
+
+    def _call(self, method, path, *args):
+        faults = self.stand_in.faults
+        faults.delay()
+        if faults.should_fail():
+            return paramiko.SFTP_FAILURE
+        try:
+            return method(self.stand_in.local_path(path), *args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        return self._call(lambda local_path: [
+            paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(local_path, filename)), filename)
+            for filename in os.listdir(local_path)
+        ], path)
+
+    def stat(self, path):
+        return self._call(lambda local_path: paramiko.SFTPAttributes.from_stat(os.stat(local_path)), path)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        return self._call(lambda local_path: _ThrottledSFTPHandle(local_path, self.stand_in.faults), path)
+
+
+class _ThrottledSFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, local_path, faults):
+        super().__init__()
+        self.readfile = open(local_path, 'rb')
+        self.faults = faults
+
+    def read(self, offset, length):
+        data = super().read(offset, length)
+        if isinstance(data, bytes):
+            self.faults.delay(len(data))
+        return data
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
@@ -0,0 +1,165 @@
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.archive import FileArchive, get_file_archive
+
+REMOTE_FILE = upload.RemoteFile(datetime.date(2014, 12, 9), 'Y01A.CARS.#D.444444.D091214', 12, 1418083200)
+
+
+class FileArchiveTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.archive_dir = temp_dir.name
+
+    def make_archive(self, max_bytes=1000, max_age=60):
+        return FileArchive(self.archive_dir, max_bytes=max_bytes, max_age=max_age)
+
+    def test_add_and_extract(self):
+        archive = self.make_archive()
+        self.assertIsNone(archive.get(REMOTE_FILE))
+        archived_file = archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        self.assertEqual(archived_file.sha256, hashlib.sha256(b'file content').hexdigest())
+        self.assertEqual(archived_file.size, 12)
+
+        # index persists across runs
+        archive = self.make_archive()
+        archived_file = archive.get(REMOTE_FILE)
+        self.assertEqual(archived_file.date, datetime.date(2014, 12, 9))
+        self.assertEqual(archived_file.account_code, '444444')
+        extracted = io.BytesIO()
+        archive.extract(archived_file, extracted)
+        self.assertEqual(extracted.getvalue(), b'file content')
+        with archive.open(archived_file) as f:
+            self.assertEqual(f.read(), 'file content')
+
+    def test_stored_compressed(self):
+        archive = self.make_archive(max_bytes=10 * 1000)
+        content = b'0' * 100 * 1000
+        archived_file = archive.add(REMOTE_FILE._replace(size=len(content)), '444444', io.BytesIO(content))
+        self.assertLess(archived_file.compressed_size, 1000)
+        self.assertEqual(
+            archived_file.compressed_size,
+            os.path.getsize(os.path.join(self.archive_dir, 'objects', f'{archived_file.sha256}.gz')),
+        )
+
+    def test_not_found_if_remote_file_changed(self):
+        archive = self.make_archive()
+        archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+
+        self.assertIsNone(archive.get(REMOTE_FILE._replace(mtime=1418083201)))
+        self.assertIsNone(archive.get(REMOTE_FILE._replace(size=13)))
+
+    def test_find_by_date_account_code_and_hash(self):
+        archive = self.make_archive()
+        archive.add(REMOTE_FILE._replace(filename='Y01A.CARS.#D.555555.D101214', date=datetime.date(2014, 12, 10)),
+                    '555555', io.BytesIO(b'other content'))
+        archive.add(REMOTE_FILE._replace(filename='Y01A.CARS.#D.444444.D101214', date=datetime.date(2014, 12, 10)),
+                    '444444', io.BytesIO(b'file content'))
+        archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+
+        self.assertEqual([archived_file.filename for archived_file in archive.find()], [
+            'Y01A.CARS.#D.444444.D091214',
+            'Y01A.CARS.#D.444444.D101214',
+            'Y01A.CARS.#D.555555.D101214',
+        ])
+        self.assertEqual([archived_file.filename for archived_file in archive.find(account_code='444444')], [
+            'Y01A.CARS.#D.444444.D091214',
+            'Y01A.CARS.#D.444444.D101214',
+        ])
+        self.assertEqual([
+            archived_file.filename
+            for archived_file in archive.find(date=datetime.date(2014, 12, 10), account_code='444444')
+        ], ['Y01A.CARS.#D.444444.D101214'])
+        self.assertEqual([
+            archived_file.filename
+            for archived_file in archive.find(sha256=hashlib.sha256(b'other content').hexdigest())
+        ], ['Y01A.CARS.#D.555555.D101214'])
+        # identical contents are stored once
+        self.assertEqual(len(os.listdir(os.path.join(self.archive_dir, 'objects'))), 2)
+
+    def test_extract_fails_if_archived_file_corrupted(self):
+        archive = self.make_archive()
+        archived_file = archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        with gzip.open(os.path.join(self.archive_dir, 'objects', f'{archived_file.sha256}.gz'), 'wb') as f:
+            f.write(b'file CONTENT')
+
+        with self.assertRaises(IOError):
+            archive.extract(archived_file, io.BytesIO())
+
+    def test_removes_oldest_files_over_size_limit(self):
+        remote_files = [
+            REMOTE_FILE._replace(
+                filename=f'Y01A.CARS.#D.444444.D{day}1214', date=datetime.date(2014, 12, int(day)), size=14,
+            )
+            for day in ('09', '10', '11')
+        ]
+        archive = self.make_archive()
+        compressed_size = archive.add(remote_files[0], '444444', io.BytesIO(b'content 091214')).compressed_size
+        archive.max_bytes = compressed_size * 5 // 2
+        for remote_file in remote_files[1:]:
+            archive.add(remote_file, '444444', io.BytesIO(f'content {remote_file.filename[-6:]}'.encode()))
+
+        self.assertIsNone(archive.get(remote_files[0]))
+        self.assertIsNotNone(archive.get(remote_files[1]))
+        self.assertIsNotNone(archive.get(remote_files[2]))
+        self.assertEqual(len(os.listdir(os.path.join(self.archive_dir, 'objects'))), 2)
+
+    def test_removes_expired_files(self):
+        archive = self.make_archive(max_age=60)
+        with mock.patch('mtp_transaction_uploader.archive.time.time', return_value=1000):
+            archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        other_remote_file = REMOTE_FILE._replace(filename='Y01A.CARS.#D.444444.D101214', size=13)
+        with mock.patch('mtp_transaction_uploader.archive.time.time', return_value=1100):
+            archive.add(other_remote_file, '444444', io.BytesIO(b'other content'))
+
+        self.assertIsNone(archive.get(REMOTE_FILE))
+        self.assertIsNotNone(archive.get(other_remote_file))
+        self.assertEqual(archive.evictions, 1)
+
+    def test_file_just_added_is_kept(self):
+        archive = self.make_archive(max_bytes=10, max_age=0)
+        archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        other_remote_file = REMOTE_FILE._replace(filename='Y01A.CARS.#D.444444.D101214', size=13)
+
+        archived_file = archive.add(other_remote_file, '444444', io.BytesIO(b'other content'))
+
+        self.assertEqual(archived_file.filename, other_remote_file.filename)
+        self.assertIsNone(archive.get(REMOTE_FILE))
+        self.assertEqual(archive.get(other_remote_file), archived_file)
+
+    def test_stats(self):
+        archive = self.make_archive()
+        self.assertIsNone(archive.get(REMOTE_FILE))
+        archived_file = archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        self.assertEqual(archive.get(REMOTE_FILE), archived_file)
+        self.assertEqual(archive.stats, {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_discard_corrupted_file(self):
+        archive = self.make_archive()
+        archived_file = archive.add(REMOTE_FILE, '444444', io.BytesIO(b'file content'))
+        archive.discard(archived_file)
+
+        self.assertIsNone(self.make_archive().get(REMOTE_FILE))
+        self.assertEqual(os.listdir(os.path.join(self.archive_dir, 'objects')), [])
+
+    def test_download_cache_is_archive_with_shorter_retention(self):
+        with mock.patch.multiple(settings, ARCHIVE_DIR='', DOWNLOAD_CACHE_DIR=self.archive_dir,
+                                 DOWNLOAD_CACHE_MAX_BYTES=100, DOWNLOAD_CACHE_MAX_AGE_DAYS=1):
+            download_cache = get_file_archive()
+        self.assertEqual(download_cache.name, 'cache')
+        self.assertEqual((download_cache.max_bytes, download_cache.max_age), (100, 24 * 60 * 60))
+
+        with mock.patch.multiple(settings, ARCHIVE_DIR=self.archive_dir, DOWNLOAD_CACHE_DIR='/tmp/unused'), \
+                self.assertLogs('mtp', level='WARNING') as logs:
+            self.assertEqual(get_file_archive().name, 'archive')
+        self.assertIn('DOWNLOAD_CACHE_DIR is not used', logs.output[0])
+        with mock.patch.multiple(settings, ARCHIVE_DIR='', DOWNLOAD_CACHE_DIR=''):
+            self.assertIsNone(get_file_archive())
@@ -0,0 +1,152 @@
+from unittest import mock, TestCase
+
+from requests.exceptions import ConnectionError, ConnectTimeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from mtp_transaction_uploader.balancer import APILoadBalancer, LEAST_OUTSTANDING
+from mtp_transaction_uploader.governor import APIGovernor, GovernedHTTPAdapter
+from tests.test_governor import make_request, make_response
+
+API_URLS = ['http://api-1:8000', 'http://api-2:8000', 'http://api-3:8000']
+
+
+def connection_refused(url):
+    reason = NewConnectionError(None, 'Connection refused')
+    return ConnectionError(MaxRetryError(None, url, reason))
+
+
+class APILoadBalancerTestCase(TestCase):
+    def make_balancer(self, *args, base_urls=API_URLS, **kwargs):
+        balancer = APILoadBalancer(base_urls, *args, **kwargs)
+        # records requests sent to every host in order
+        self.adapters = mock.MagicMock()
+        for index, host in enumerate(balancer.hosts):
+            host.adapter = mock.MagicMock()
+            host.adapter.send.return_value = make_response(200)
+            self.adapters.attach_mock(host.adapter, f'host_{index}')
+        return balancer
+
+    def get_sent_urls(self):
+        return [call.args[0].url for call in self.adapters.mock_calls if call[0].endswith('.send')]
+
+    def send(self, balancer, path='/transactions/'):
+        request = make_request('GET', f'http://api.local{path}?page=1')
+        balancer.send(request)
+        # the request itself is left addressed to the API URL
+        self.assertEqual(request.url, f'http://api.local{path}?page=1')
+        return self.get_sent_urls()[-1]
+
+    def test_round_robin(self):
+        balancer = self.make_balancer()
+        urls = [self.send(balancer) for _ in range(4)]
+        self.assertEqual(urls, [
+            'http://api-1:8000/transactions/?page=1',
+            'http://api-2:8000/transactions/?page=1',
+            'http://api-3:8000/transactions/?page=1',
+            'http://api-1:8000/transactions/?page=1',
+        ])
+
+    def test_base_url_paths_kept(self):
+        balancer = self.make_balancer(base_urls=['http://api-1:8000/api/', 'http://api-2:8000'],
+                                      api_url='http://api.local/public')
+        urls = [self.send(balancer, path='/public/transactions/') for _ in range(2)]
+        self.assertEqual(urls, [
+            'http://api-1:8000/api/transactions/?page=1',
+            'http://api-2:8000/transactions/?page=1',
+        ])
+        # paths not under the API URL's are only prefixed
+        self.assertEqual(self.send(balancer, path='/publication/'), 'http://api-1:8000/api/publication/?page=1')
+
+    def test_failover_and_retries_keep_base_url_paths(self):
+        balancer = self.make_balancer(base_urls=['http://api-1/api', 'http://api-2/api', 'http://api-3/api'],
+                                      api_url='http://api.local')
+        balancer.hosts[0].adapter.send.side_effect = connection_refused('/api/transactions/')
+        balancer.hosts[1].adapter.send.side_effect = [make_response(429, {'Retry-After': '0'}), make_response(200)]
+        balancer.hosts[2].adapter.send.return_value = make_response(429, {'Retry-After': '0'})
+        adapter = GovernedHTTPAdapter(APIGovernor({}), balancer)
+
+        with mock.patch('mtp_transaction_uploader.governor.settings') as mock_settings:
+            mock_settings.API_MAX_RETRIES = 2
+            mock_settings.API_TIMEOUT_SECONDS = 10
+            response = adapter.send(make_request('POST', 'http://api.local/transactions/', body=b'[]'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_sent_urls(), [
+            'http://api-1/api/transactions/',
+            'http://api-2/api/transactions/',
+            'http://api-3/api/transactions/',
+            'http://api-2/api/transactions/',
+        ])
+
+    def test_least_outstanding(self):
+        balancer = self.make_balancer(strategy=LEAST_OUTSTANDING)
+        balancer.hosts[0].outstanding = 2
+        balancer.hosts[1].outstanding = 1
+        urls = [self.send(balancer) for _ in range(2)]
+        self.assertEqual(urls, [
+            'http://api-3:8000/transactions/?page=1',
+            'http://api-3:8000/transactions/?page=1',
+        ])
+        self.assertEqual([host.outstanding for host in balancer.hosts], [2, 1, 0])
+
+    def test_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            APILoadBalancer(API_URLS, strategy='random')
+
+    def test_unhealthy_host_skipped(self):
+        balancer = self.make_balancer()
+        balancer.hosts[0].adapter.send.return_value = make_response(502)
+        self.assertEqual(self.send(balancer), 'http://api-1:8000/transactions/?page=1')
+        self.assertFalse(balancer.hosts[0].is_healthy)
+        urls = [self.send(balancer) for _ in range(3)]
+        self.assertNotIn('http://api-1:8000/transactions/?page=1', urls)
+
+    def test_overloaded_host_not_marked_unhealthy(self):
+        balancer = self.make_balancer()
+        balancer.hosts[0].adapter.send.return_value = make_response(503, {'Retry-After': '1'})
+        self.send(balancer)
+        self.assertTrue(balancer.hosts[0].is_healthy)
+
+    def test_unhealthy_hosts_used_if_none_healthy(self):
+        balancer = self.make_balancer(unhealthy_seconds=60)
+        for host in balancer.hosts:
+            balancer.mark_unhealthy(host, 'test')
+        self.assertEqual(self.send(balancer), 'http://api-1:8000/transactions/?page=1')
+
+    def test_unhealthy_host_used_again_later(self):
+        balancer = self.make_balancer(unhealthy_seconds=60)
+        with mock.patch('mtp_transaction_uploader.balancer.time') as mock_time:
+            mock_time.monotonic.return_value = 100
+            balancer.mark_unhealthy(balancer.hosts[0], 'test')
+            self.assertFalse(balancer.hosts[0].is_healthy)
+            mock_time.monotonic.return_value = 160
+            self.assertTrue(balancer.hosts[0].is_healthy)
+
+    def test_fails_over_when_connection_refused(self):
+        balancer = self.make_balancer()
+        balancer.hosts[0].adapter.send.side_effect = connection_refused('/transactions/')
+        self.assertEqual(self.send(balancer), 'http://api-2:8000/transactions/?page=1')
+        self.assertFalse(balancer.hosts[0].is_healthy)
+        self.assertEqual([host.outstanding for host in balancer.hosts], [0, 0, 0])
+
+    def test_fails_over_when_connection_times_out(self):
+        balancer = self.make_balancer()
+        balancer.hosts[0].adapter.send.side_effect = ConnectTimeout()
+        self.assertEqual(self.send(balancer), 'http://api-2:8000/transactions/?page=1')
+
+    def test_raises_when_all_hosts_refuse_connections(self):
+        balancer = self.make_balancer()
+        for host in balancer.hosts:
+            host.adapter.send.side_effect = connection_refused('/transactions/')
+        with self.assertRaises(ConnectionError):
+            self.send(balancer)
+        for host in balancer.hosts:
+            host.adapter.send.assert_called_once()
+
+    def test_does_not_fail_over_once_request_was_sent(self):
+        balancer = self.make_balancer()
+        balancer.hosts[0].adapter.send.side_effect = ConnectionError('Connection reset by peer')
+        with self.assertRaises(ConnectionError):
+            self.send(balancer)
+        balancer.hosts[1].adapter.send.assert_not_called()
+        self.assertFalse(balancer.hosts[0].is_healthy)
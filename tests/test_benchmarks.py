@@ -0,0 +1,31 @@
+import os
+from unittest import skipUnless, TestCase
+
+from tests import benchmarks
+
+
+class BenchmarkSuiteTestCase(TestCase):
+    def test_benchmarks_run_and_have_baselines(self):
+        costs = benchmarks.run_benchmarks(corpus_size=50, repeat=1)
+        self.assertEqual(set(costs), {benchmark.name for benchmark in benchmarks.BENCHMARKS})
+        self.assertTrue(all(cost > 0 for cost in costs.values()))
+        self.assertEqual(set(benchmarks.load_baselines()), set(costs))
+
+    def test_compare_with_baselines(self):
+        results = benchmarks.compare_with_baselines(
+            {'fast': 1.2, 'slow': 1.4, 'new': 5}, {'fast': 1, 'slow': 1}, tolerance=0.3,
+        )
+        self.assertEqual([result.regressed for result in results], [False, True, False])
+
+
+@skipUnless('RUN_BENCHMARKS' in os.environ, 'benchmarks are disabled')
+class BenchmarkRegressionTestCase(TestCase):
+    def test_no_regressions(self):
+        tolerance = float(os.environ.get('BENCHMARK_TOLERANCE', benchmarks.DEFAULT_TOLERANCE))
+        results = benchmarks.compare_with_baselines(benchmarks.run_benchmarks(), benchmarks.load_baselines(), tolerance)
+        regressions = [
+            f'{result.name}: {result.cost:.3f} against baseline {result.baseline:.3f}'
+            for result in results
+            if result.regressed
+        ]
+        self.assertFalse(regressions, msg='Benchmarks regressed:\n' + '\n'.join(regressions))
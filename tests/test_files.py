@@ -0,0 +1,43 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from mtp_transaction_uploader.files import atomic_write
+
+
+class AtomicWriteTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = temp_dir.name
+        self.path = os.path.join(self.directory, 'file.json')
+
+    def test_file_replaced_once_written(self):
+        with open(self.path, 'w') as f:
+            f.write('old')
+
+        with atomic_write(self.path) as f:
+            f.write('new')
+            with open(self.path) as current_file:
+                self.assertEqual(current_file.read(), 'old')
+
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.directory), ['file.json'])
+
+    def test_nothing_left_if_writing_fails(self):
+        with self.assertRaises(ValueError), atomic_write(self.path) as f:
+            f.write('partial')
+            raise ValueError
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_path_chosen_after_writing(self):
+        content = []
+        with atomic_write(lambda: os.path.join(self.directory, ''.join(content)), 'wb',
+                          directory=self.directory) as f:
+            f.write(b'abc')
+            content.append('abc')
+
+        self.assertEqual(os.listdir(self.directory), ['abc'])
@@ -0,0 +1,264 @@
+import io
+import threading
+import time
+from unittest import mock, TestCase
+
+from requests import PreparedRequest, Response
+from requests.exceptions import ConnectionError
+
+from mtp_transaction_uploader.governor import (
+    APIGovernor, APIUnavailableError, CircuitBreaker, EndpointGovernor, parse_retry_after, TokenBucket,
+)
+
+
+def make_request(method, url, body=None):
+    request = PreparedRequest()
+    request.prepare(method=method, url=url, data=body)
+    return request
+
+
+def make_response(status_code, headers=None):
+    response = Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(b'')
+    response.headers.update(headers or {})
+    return response
+
+
+@mock.patch('mtp_transaction_uploader.governor.time')
+class TokenBucketTestCase(TestCase):
+
+    def test_bursts_allowed_then_limited_to_rate(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        bucket = TokenBucket(rate=2)
+
+        bucket.acquire()
+        bucket.acquire()
+        mock_time.sleep.assert_not_called()
+
+        bucket.acquire()
+        mock_time.sleep.assert_called_once_with(0.5)
+        bucket.acquire()
+        mock_time.sleep.assert_called_with(1)
+
+    def test_bucket_refills_over_time(self, mock_time):
+        mock_time.monotonic.return_value = 100
+        bucket = TokenBucket(rate=1000)
+        bucket.acquire(1000)
+
+        mock_time.monotonic.return_value = 100.5
+        bucket.acquire(500)
+        mock_time.sleep.assert_not_called()
+
+        bucket.acquire(2000)
+        mock_time.sleep.assert_called_once_with(2)
+
+
+class EndpointGovernorTestCase(TestCase):
+
+    def test_concurrency_limited(self):
+        endpoint = EndpointGovernor(max_concurrency=2)
+        lock = threading.Lock()
+        concurrent = []
+        active = 0
+
+        def request():
+            nonlocal active
+            with endpoint.acquire():
+                with lock:
+                    active += 1
+                    concurrent.append(active)
+                time.sleep(0.01)
+                with lock:
+                    active -= 1
+
+        threads = [threading.Thread(target=request) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(concurrent), 6)
+        self.assertEqual(max(concurrent), 2)
+
+
+@mock.patch('mtp_transaction_uploader.governor.settings')
+@mock.patch('mtp_transaction_uploader.governor.time')
+class APIGovernorTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100
+
+    def use_clock(self, mock_time):
+        def sleep(seconds):
+            self.now += seconds
+
+        mock_time.monotonic.side_effect = lambda: self.now
+        mock_time.sleep.side_effect = sleep
+
+    def test_endpoints_governed_separately(self, mock_time, mock_settings):
+        governor = APIGovernor({
+            'default': {},
+            'transactions': {'requests_per_second': 5},
+        })
+        self.assertIs(governor.get_endpoint('transactions'), governor.endpoints['transactions'])
+        self.assertIs(governor.get_endpoint('balances'), governor.default)
+        self.assertEqual(
+            governor.get_endpoint_name(make_request('GET', 'http://localhost/transactions/?limit=1')),
+            'transactions',
+        )
+        self.assertEqual(governor.get_endpoint_name(make_request('POST', 'http://localhost/oauth2/token/')), 'token')
+
+    def test_throttled_requests_retried(self, mock_time, mock_settings):
+        mock_settings.API_MAX_RETRIES = 5
+        mock_settings.API_RETRY_BACKOFF_SECONDS = 1
+        self.use_clock(mock_time)
+        governor = APIGovernor({})
+        send = mock.MagicMock(side_effect=[
+            make_response(429, {'Retry-After': '3'}),
+            make_response(429),
+            make_response(503, {'Retry-After': '1'}),
+            make_response(201),
+        ])
+
+        response = governor.send(send, make_request('POST', 'http://localhost/transactions/', b'[]'))
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(send.call_count, 4)
+        self.assertEqual([call.args[0] for call in mock_time.sleep.call_args_list], [3, 2, 1])
+
+    def test_retries_limited(self, mock_time, mock_settings):
+        mock_settings.API_MAX_RETRIES = 2
+        mock_settings.API_RETRY_BACKOFF_SECONDS = 1
+        self.use_clock(mock_time)
+        governor = APIGovernor({})
+        send = mock.MagicMock(return_value=make_response(429, {'Retry-After': '0'}))
+
+        response = governor.send(send, make_request('GET', 'http://localhost/balances/'))
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(send.call_count, 3)
+
+    def test_errors_not_retried(self, mock_time, mock_settings):
+        mock_settings.API_MAX_RETRIES = 5
+        self.use_clock(mock_time)
+        governor = APIGovernor({})
+        for response in (make_response(500), make_response(503), make_response(400, {'Retry-After': '1'})):
+            send = mock.MagicMock(return_value=response)
+            self.assertIs(governor.send(send, make_request('GET', 'http://localhost/batches/')), response)
+            send.assert_called_once()
+        mock_time.sleep.assert_not_called()
+
+
+@mock.patch('mtp_transaction_uploader.governor.logger')
+@mock.patch('mtp_transaction_uploader.governor.time')
+class CircuitBreakerTestCase(TestCase):
+
+    def test_opens_after_consecutive_failures(self, mock_time, _):
+        mock_time.monotonic.return_value = 100
+        circuit_breaker = CircuitBreaker(threshold=3, reset_seconds=30)
+
+        for _ in range(2):
+            circuit_breaker.before_request()
+            circuit_breaker.record_failure()
+        circuit_breaker.before_request()
+        circuit_breaker.record_success()
+        for _ in range(3):
+            circuit_breaker.before_request()
+            circuit_breaker.record_failure()
+
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(APIUnavailableError):
+            circuit_breaker.before_request()
+
+    def test_half_open_probe(self, mock_time, _):
+        mock_time.monotonic.return_value = 100
+        circuit_breaker = CircuitBreaker(threshold=1, reset_seconds=30)
+        circuit_breaker.record_failure()
+
+        mock_time.monotonic.return_value = 130
+        circuit_breaker.before_request()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        # only one probe is allowed at a time
+        with self.assertRaises(APIUnavailableError):
+            circuit_breaker.before_request()
+
+        # a failed probe keeps it open for longer
+        circuit_breaker.record_failure()
+        mock_time.monotonic.return_value = 159
+        with self.assertRaises(APIUnavailableError):
+            circuit_breaker.before_request()
+
+        mock_time.monotonic.return_value = 160
+        circuit_breaker.before_request()
+        circuit_breaker.record_success()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+        circuit_breaker.before_request()
+
+    def test_governor_records_failures(self, mock_time, _):
+        mock_time.monotonic.return_value = 100
+        circuit_breaker = CircuitBreaker(threshold=2, reset_seconds=30)
+        governor = APIGovernor({}, circuit_breaker)
+
+        with mock.patch('mtp_transaction_uploader.governor.settings') as mock_settings:
+            mock_settings.API_MAX_RETRIES = 0
+            governor.send(mock.MagicMock(return_value=make_response(503, {'Retry-After': '1'})), make_request(
+                'GET', 'http://localhost/balances/'
+            ))
+            governor.send(mock.MagicMock(return_value=make_response(400)), make_request(
+                'GET', 'http://localhost/balances/'
+            ))
+            self.assertEqual(circuit_breaker.failures, 0)
+
+            governor.send(mock.MagicMock(return_value=make_response(502)), make_request(
+                'GET', 'http://localhost/balances/'
+            ))
+            with self.assertRaises(ConnectionError):
+                governor.send(mock.MagicMock(side_effect=ConnectionError), make_request(
+                    'GET', 'http://localhost/balances/'
+                ))
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+            send = mock.MagicMock()
+            with self.assertRaises(APIUnavailableError):
+                governor.send(send, make_request('GET', 'http://localhost/balances/'))
+            send.assert_not_called()
+
+    def test_probe_failing_with_any_error_reopens(self, mock_time, _):
+        mock_time.monotonic.return_value = 100
+        circuit_breaker = CircuitBreaker(threshold=1, reset_seconds=30)
+        circuit_breaker.record_failure()
+        governor = APIGovernor({}, circuit_breaker)
+
+        mock_time.monotonic.return_value = 130
+        with mock.patch('mtp_transaction_uploader.governor.settings') as mock_settings:
+            mock_settings.API_MAX_RETRIES = 0
+            with self.assertRaises(ValueError):
+                governor.send(mock.MagicMock(side_effect=ValueError), make_request(
+                    'GET', 'http://localhost/balances/'
+                ))
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+
+            mock_time.monotonic.return_value = 160
+            governor.send(mock.MagicMock(return_value=make_response(200)), make_request(
+                'GET', 'http://localhost/balances/'
+            ))
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.CLOSED)
+
+
+class ParseRetryAfterTestCase(TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('-1'), 0)
+
+    def test_http_date(self):
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        retry_after = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))
+        self.assertAlmostEqual(parse_retry_after(retry_after), 60, delta=2)
+
+    @mock.patch('mtp_transaction_uploader.governor.settings')
+    def test_invalid(self, mock_settings):
+        mock_settings.API_RETRY_BACKOFF_SECONDS = 1
+        self.assertEqual(parse_retry_after('soon'), 1)
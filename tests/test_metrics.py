@@ -0,0 +1,35 @@
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import metrics
+
+
+class RecordRunTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    @mock.patch('mtp_transaction_uploader.metrics.settings')
+    def test_metrics_written_to_textfile(self, mock_settings):
+        mock_settings.METRICS_TEXTFILE = os.path.join(self.temp_dir, 'transaction_uploader.prom')
+        metrics.record_run(12.5, success=False)
+
+        with open(mock_settings.METRICS_TEXTFILE) as f:
+            textfile = f.read()
+        self.assertIn('mtp_transaction_uploader_last_run_success 0.0', textfile)
+        self.assertIn('mtp_transaction_uploader_last_run_duration_seconds 12.5', textfile)
+        self.assertIn('# TYPE mtp_transaction_uploader_upload_chunk_seconds histogram', textfile)
+        self.assertEqual(os.listdir(self.temp_dir), ['transaction_uploader.prom'])
+
+    @mock.patch('mtp_transaction_uploader.metrics.write_to_textfile')
+    @mock.patch('mtp_transaction_uploader.metrics.settings')
+    def test_no_textfile_written_if_not_set(self, mock_settings, mock_write_to_textfile):
+        mock_settings.METRICS_TEXTFILE = ''
+        metrics.record_run(1, success=True)
+
+        mock_write_to_textfile.assert_not_called()
+        self.assertEqual(metrics.registry.get_sample_value('mtp_transaction_uploader_last_run_success'), 1)
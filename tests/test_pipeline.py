@@ -0,0 +1,109 @@
+import asyncio
+from datetime import date
+import threading
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import pipeline, upload
+
+NEW_FILES = [
+    upload.RemoteFile(date(2014, 12, 9), 'Y01A.CARS.#D.444444.D091214', 1000),
+    upload.RemoteFile(date(2014, 12, 10), 'Y01A.CARS.#D.444444.D101214', 1000),
+    upload.RemoteFile(date(2014, 12, 11), 'Y01A.CARS.#D.444444.D111214', 1000),
+]
+
+
+@mock.patch('mtp_transaction_uploader.pipeline.get_authenticated_connection')
+@mock.patch('mtp_transaction_uploader.pipeline.upload.post_balance_for_file')
+@mock.patch('mtp_transaction_uploader.pipeline.upload.post_transactions')
+@mock.patch('mtp_transaction_uploader.pipeline.upload.get_transactions_from_local_file')
+@mock.patch('mtp_transaction_uploader.pipeline.upload.download_file')
+class PipelineTestCase(TestCase):
+
+    def _run(self, new_files=NEW_FILES):
+        return asyncio.run(pipeline.Pipeline(mock.MagicMock(), queue_size=1).run(new_files))
+
+    def test_balances_posted_in_date_order(
+        self, mock_download_file, mock_get_transactions, mock_post_transactions, mock_post_balance, _
+    ):
+        mock_download_file.side_effect = lambda conn, new_file: '/' + new_file.filename
+        mock_get_transactions.side_effect = lambda filename, balance_records: [{'amount': 100, 'category': 'credit'}]
+        mock_post_transactions.side_effect = lambda conn, filename, transactions: (
+            upload.UploadedTransactions(len(transactions), 100)
+        )
+        mock_post_balance.side_effect = lambda filename, uploaded: uploaded.transaction_count
+
+        transaction_count = self._run()
+
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(
+            [call.args[0] for call in mock_post_balance.call_args_list],
+            ['/' + new_file.filename for new_file in NEW_FILES],
+        )
+
+    def test_files_after_a_failed_file_are_not_uploaded(
+        self, mock_download_file, mock_get_transactions, mock_post_transactions, mock_post_balance, _
+    ):
+        mock_download_file.side_effect = lambda conn, new_file: '/' + new_file.filename
+        # first file is invalid
+        mock_get_transactions.side_effect = [None, [{'amount': 1}], [{'amount': 1}]]
+        # second file fails to upload
+        mock_post_transactions.side_effect = [None, upload.UploadedTransactions(1, 1)]
+        mock_post_balance.return_value = 1
+
+        transaction_count = self._run()
+
+        # the third file is left for the next run
+        self.assertEqual(transaction_count, 0)
+        self.assertEqual(mock_post_transactions.call_count, 1)
+        mock_post_balance.assert_not_called()
+
+    def test_stages_overlap(
+        self, mock_download_file, mock_get_transactions, mock_post_transactions, mock_post_balance, _
+    ):
+        last_file_downloaded = threading.Event()
+
+        def download_file(conn, new_file):
+            if new_file == NEW_FILES[-1]:
+                last_file_downloaded.set()
+            return '/' + new_file.filename
+
+        def post_transactions(conn, filename, transactions):
+            # the first upload can only finish if later files are downloaded while it is in progress
+            if filename == '/' + NEW_FILES[0].filename:
+                self.assertTrue(last_file_downloaded.wait(timeout=5))
+            return upload.UploadedTransactions(1, 0)
+
+        mock_download_file.side_effect = download_file
+        mock_get_transactions.return_value = [{'amount': 1}]
+        mock_post_transactions.side_effect = post_transactions
+        mock_post_balance.return_value = 1
+
+        self.assertEqual(self._run(), 3)
+
+    def test_download_errors_end_pipeline_after_earlier_balances(
+        self, mock_download_file, mock_get_transactions, mock_post_transactions, mock_post_balance, _
+    ):
+        mock_download_file.side_effect = ['/' + NEW_FILES[0].filename, IOError('connection lost')]
+        mock_get_transactions.return_value = [{'amount': 1}]
+        mock_post_transactions.return_value = upload.UploadedTransactions(1, 1)
+        mock_post_balance.return_value = 1
+
+        with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            self.assertEqual(self._run(), 1)
+
+        mock_post_balance.assert_called_once_with('/' + NEW_FILES[0].filename, upload.UploadedTransactions(1, 1))
+        mock_logger.error.assert_called_once()
+
+    def test_parse_errors_raised_after_earlier_balances(
+        self, mock_download_file, mock_get_transactions, mock_post_transactions, mock_post_balance, _
+    ):
+        mock_download_file.side_effect = lambda conn, new_file: '/' + new_file.filename
+        mock_get_transactions.side_effect = [[{'amount': 1}], ValueError('Unexpected record'), [{'amount': 1}]]
+        mock_post_transactions.return_value = upload.UploadedTransactions(1, 1)
+        mock_post_balance.return_value = 1
+
+        with self.assertRaisesRegex(ValueError, 'Unexpected record'):
+            self._run()
+
+        mock_post_transactions.assert_called_once()
+        mock_post_balance.assert_called_once_with('/' + NEW_FILES[0].filename, upload.UploadedTransactions(1, 1))
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import metrics, prisoner_locations, settings, upload
+from mtp_transaction_uploader.prisoner_locations import PrisonerLocationIndex
+
+
+class PrisonerLocationIndexTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.snapshot_path = os.path.join(temp_dir.name, 'prisoner_locations.csv')
+
+    def write_snapshot(self, *rows, mtime=None):
+        with open(self.snapshot_path, 'w') as f:
+            f.write('prisoner_number,prisoner_dob,prison\n')
+            for row in rows:
+                f.write(','.join(row) + '\n')
+        if mtime:
+            os.utime(self.snapshot_path, (mtime, mtime))
+
+    def test_matches(self):
+        self.write_snapshot(('A1234BY', '1986-12-09', 'BXI'), ('B4321XZ', '1992-11-08', 'LEI'))
+        index = PrisonerLocationIndex(self.snapshot_path)
+        self.assertEqual(len(index), 2)
+        self.assertTrue(index.matches('A1234BY', datetime.date(1986, 12, 9)))
+        self.assertTrue(index.matches('a1234by', datetime.date(1986, 12, 9)))
+        self.assertFalse(index.matches('A1234BY', datetime.date(1986, 12, 10)))
+        self.assertFalse(index.matches('A1234BZ', datetime.date(1986, 12, 9)))
+
+    def test_missing_snapshot_matches_nothing(self):
+        index = PrisonerLocationIndex(self.snapshot_path)
+        self.assertIsNone(index.matches('A1234BY', datetime.date(1986, 12, 9)))
+
+    def test_refresh(self):
+        self.write_snapshot(('A1234BY', '1986-12-09', 'BXI'), mtime=time.time() - 10)
+        index = PrisonerLocationIndex(self.snapshot_path)
+
+        self.write_snapshot(('B4321XZ', '1992-11-08', 'LEI'))
+        index.refresh()
+        self.assertFalse(index.matches('A1234BY', datetime.date(1986, 12, 9)))
+        self.assertTrue(index.matches('B4321XZ', datetime.date(1992, 11, 8)))
+
+        # a corrupt snapshot is ignored
+        self.write_snapshot(('A1234BY', 'unknown', 'BXI'), mtime=time.time() + 10)
+        index.refresh()
+        self.assertTrue(index.matches('B4321XZ', datetime.date(1992, 11, 8)))
+
+    def test_refreshes_in_background(self):
+        self.write_snapshot(mtime=time.time() - 10)
+        index = PrisonerLocationIndex(self.snapshot_path, refresh_seconds=0.01)
+        self.addCleanup(index.close)
+        self.assertEqual(len(index), 0)
+
+        self.write_snapshot(('A1234BY', '1986-12-09', 'BXI'))
+        for _ in range(100):
+            if len(index):
+                break
+            time.sleep(0.01)
+        self.assertTrue(index.matches('A1234BY', datetime.date(1986, 12, 9)))
+
+    def test_unmatched_references_logged_not_uploaded(self):
+        self.write_snapshot(('A1234BY', '1986-12-09', 'BXI'))
+        unmatched = metrics.PRISONER_REFERENCES.labels(match='unmatched')
+        unmatched_count = unmatched._value.get()
+
+        with mock.patch.multiple(settings, PRISONER_LOCATIONS_FILE=self.snapshot_path,
+                                 PRISONER_LOCATIONS_REFRESH_SECONDS=0), \
+                mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            transactions = upload.get_transactions_from_local_file('tests/data/testfile_1')
+
+        self.assertEqual(transactions[1]['prisoner_number'], 'A1234BY')
+        self.assertEqual(transactions[2]['prisoner_number'], 'B4321XZ')
+        for transaction in transactions:
+            self.assertNotIn('prisoner_location_matched', transaction)
+        self.assertEqual(unmatched._value.get(), unmatched_count + 1)
+        mock_logger.info.assert_any_call('Prisoner number %s is not in the prisoner locations snapshot', 'B4321XZ')
+
+    def test_shared_index_created_once(self):
+        self.write_snapshot(('A1234BY', '1986-12-09', 'BXI'))
+        with mock.patch.multiple(settings, PRISONER_LOCATIONS_FILE=self.snapshot_path,
+                                 PRISONER_LOCATIONS_REFRESH_SECONDS=0), \
+                mock.patch.object(prisoner_locations._prisoner_location_index, 'instance', None), \
+                mock.patch.object(prisoner_locations, 'PrisonerLocationIndex',
+                                  wraps=PrisonerLocationIndex) as mock_index_class, \
+                ThreadPoolExecutor(max_workers=4) as executor:
+            indexes = list(executor.map(lambda _: prisoner_locations.get_prisoner_location_index(), range(20)))
+
+        mock_index_class.assert_called_once()
+        self.assertTrue(all(index is indexes[0] for index in indexes))
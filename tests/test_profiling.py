@@ -0,0 +1,48 @@
+import cProfile
+import os
+import tempfile
+from unittest import TestCase
+
+from mtp_transaction_uploader import profiling
+
+
+def inner():
+    return sum(range(20000))
+
+
+def outer():
+    return [inner() for _ in range(5)]
+
+
+class ProfilingTestCase(TestCase):
+    def test_collapsed_stacks_follow_callers(self):
+        profile = cProfile.Profile()
+        profile.runcall(outer)
+        stacks = [line.rsplit(' ', 1)[0] for line in profiling.get_collapsed_stacks(profile)]
+        self.assertTrue(any(
+            'outer (test_profiling.py' in stack and stack.endswith('builtins.sum>')
+            and stack.index('outer') < stack.index('inner')
+            for stack in stacks
+        ), msg=stacks)
+
+    def test_nested_stages_are_part_of_outer_stage(self):
+        @profiling.profiled('inner')
+        def process_inner(filename):
+            return inner()
+
+        @profiling.profiled('outer')
+        def process_outer(filename):
+            return process_inner(filename)
+
+        with tempfile.TemporaryDirectory() as reports_dir:
+            profiler = profiling.start_profiling(reports_dir)
+            try:
+                process_outer(filename='/tmp/Y01A.CARS.#D.444444.D091214')
+            finally:
+                profiling.stop_profiling()
+            self.assertEqual(
+                sorted(os.listdir(os.path.join(profiler.reports_dir, 'Y01A.CARS.#D.444444.D091214'))),
+                ['outer.allocations.txt', 'outer.collapsed', 'outer.prof'],
+            )
+        # not profiled once stopped
+        self.assertEqual(process_outer('file'), inner())
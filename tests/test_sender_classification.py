@@ -0,0 +1,114 @@
+import json
+import os
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_common.bank_accounts import is_correspondence_account, roll_number_required
+
+from mtp_transaction_uploader import sender_classification
+from mtp_transaction_uploader.sender_classification import SenderClassificationCache, classify_account
+
+
+class ClassifyAccountTestCase(TestCase):
+    def test_classification_matches_bank_accounts(self):
+        accounts = [
+            ('608006', '29696666'),
+            ('623045', None),
+            ('623045', '00000000'),
+            ('203253', '12345678'),
+            ('200353', '73152596'),
+            ('123456', '67175315'),
+            (None, '12345678'),
+            ('123456', None),
+        ]
+        for sort_code, account_number in accounts:
+            classification = classify_account(sort_code, account_number)
+            building_soc_account_number = account_number or '00000000'
+            expected_roll_number_required = roll_number_required(sort_code, building_soc_account_number)
+            expected_account_number = (
+                building_soc_account_number if expected_roll_number_required else account_number
+            )
+            self.assertEqual(classification, (
+                expected_account_number,
+                expected_roll_number_required,
+                is_correspondence_account(sort_code, expected_account_number),
+                sort_code == '123456' and expected_account_number == '67175315',
+            ), msg=f'{sort_code} {account_number} classified incorrectly')
+
+
+class SenderClassificationCacheTestCase(TestCase):
+    def test_hits_and_misses(self):
+        cache = SenderClassificationCache(max_size=10)
+        for _ in range(3):
+            cache.classify('608006', '29696666')
+        cache.classify('623045', None)
+
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        self.assertEqual(cache.hit_rate, 0.5)
+        self.assertEqual(cache.most_common(1), [('608006', '29696666')])
+
+    def test_least_recently_used_evicted(self):
+        cache = SenderClassificationCache(max_size=2)
+        cache.classify('608006', '29696666')
+        cache.classify('245432', '78990056')
+        cache.classify('608006', '29696666')
+        cache.classify('623045', None)
+
+        self.assertEqual(list(cache.entries), [('608006', '29696666'), ('623045', None)])
+        cache.classify('245432', '78990056')
+        self.assertEqual(cache.misses, 4)
+
+    def test_priming_from_earlier_runs(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(sender_classification, 'settings') as mock_settings:
+            mock_settings.SENDER_CLASSIFICATION_CACHE_SIZE = 10
+            mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE = os.path.join(temp_dir, 'priming.json')
+            mock_settings.SENDER_CLASSIFICATION_PRIMING_COUNT = 1
+
+            # first run has no priming file
+            cache = sender_classification.start_sender_classification_cache()
+            self.assertEqual(len(cache.entries), 0)
+            cache.classify('245432', '78990056')
+            cache.classify('608006', '29696666')
+            cache.classify('608006', '29696666')
+            sender_classification.finish_sender_classification_cache()
+            with open(mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE) as f:
+                self.assertEqual(json.load(f), [['608006', '29696666']])
+            self.assertEqual(os.listdir(temp_dir), ['priming.json'])
+
+            # next run is primed with most common sender
+            cache = sender_classification.start_sender_classification_cache()
+            cache.classify('608006', '29696666')
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_each_run_starts_a_new_shared_cache(self):
+        with mock.patch.object(sender_classification, 'settings') as mock_settings:
+            mock_settings.SENDER_CLASSIFICATION_CACHE_SIZE = 10
+            mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE = ''
+
+            cache = sender_classification.start_sender_classification_cache()
+            cache.classify('608006', '29696666')
+            self.assertIs(sender_classification.get_sender_classification_cache(), cache)
+
+            next_cache = sender_classification.start_sender_classification_cache()
+            self.assertIsNot(next_cache, cache)
+            self.assertEqual(len(next_cache.entries), 0)
+            self.assertIs(sender_classification.get_sender_classification_cache(), next_cache)
+
+    def test_interrupted_save_keeps_priming_file(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.object(sender_classification, 'settings') as mock_settings:
+            mock_settings.SENDER_CLASSIFICATION_CACHE_SIZE = 10
+            mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE = os.path.join(temp_dir, 'priming.json')
+            mock_settings.SENDER_CLASSIFICATION_PRIMING_COUNT = 1
+            with open(mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE, 'w') as f:
+                json.dump([['608006', '29696666']], f)
+
+            sender_classification.start_sender_classification_cache().classify('245432', '78990056')
+            with mock.patch.object(sender_classification.json, 'dump', side_effect=KeyboardInterrupt), \
+                    self.assertRaises(KeyboardInterrupt):
+                sender_classification.finish_sender_classification_cache()
+
+            self.assertEqual(os.listdir(temp_dir), ['priming.json'])
+            with open(mock_settings.SENDER_CLASSIFICATION_PRIMING_FILE) as f:
+                self.assertEqual(json.load(f), [['608006', '29696666']])
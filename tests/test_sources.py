@@ -0,0 +1,92 @@
+import datetime
+import io
+import os
+import tempfile
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.archive import FileArchive
+from mtp_transaction_uploader.sources import ArchiveFileSource, get_file_source, LocalFileSource, MemoryFileSource
+
+
+class FileSourceTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.source_dir = temp_dir.name
+        for filename, content in [
+            ('Y01A.CARS.#D.444444.D091214', b'file 1'),
+            ('Y01A.CARS.#D.444444.D101214', b'file 2 content'),
+        ]:
+            with open(os.path.join(self.source_dir, filename), 'wb') as f:
+                f.write(content)
+        os.utime(os.path.join(self.source_dir, 'Y01A.CARS.#D.444444.D091214'), (1418083200, 1418083200))
+        os.mkdir(os.path.join(self.source_dir, 'subdirectory'))
+
+    def assertSourceFiles(self, source):  # noqa: N802
+        self.assertEqual(sorted(source.listdir()), ['Y01A.CARS.#D.444444.D091214', 'Y01A.CARS.#D.444444.D101214'])
+        stat = source.stat('Y01A.CARS.#D.444444.D091214')
+        self.assertEqual(stat.st_size, 6)
+        self.assertEqual(stat.st_mtime, 1418083200)
+        with source.open('Y01A.CARS.#D.444444.D101214', size=14) as f:
+            self.assertEqual(f.read(), b'file 2 content')
+        local_file = io.BytesIO()
+        source.getfo('Y01A.CARS.#D.444444.D091214', local_file)
+        self.assertEqual(local_file.getvalue(), b'file 1')
+        with tempfile.TemporaryDirectory() as temp_dir:
+            local_path = os.path.join(temp_dir, 'Y01A.CARS.#D.444444.D091214')
+            source.get('Y01A.CARS.#D.444444.D091214', local_path)
+            with open(local_path, 'rb') as f:
+                self.assertEqual(f.read(), b'file 1')
+
+    def test_local_source(self):
+        self.assertSourceFiles(LocalFileSource(self.source_dir))
+
+    def test_memory_source(self):
+        source = MemoryFileSource.from_directory(self.source_dir)
+        # later changes to the directory are not seen
+        os.remove(os.path.join(self.source_dir, 'Y01A.CARS.#D.444444.D091214'))
+        self.assertSourceFiles(source)
+
+    def test_archive_source(self):
+        with tempfile.TemporaryDirectory() as archive_dir:
+            archive = FileArchive(archive_dir, max_bytes=1000, max_age=60)
+            local_source = LocalFileSource(self.source_dir)
+            for filename in local_source.listdir():
+                stat = local_source.stat(filename)
+                remote_file = upload.RemoteFile(upload.parse_filename(filename, '444444'), filename,
+                                                stat.st_size, stat.st_mtime)
+                with local_source.open(filename) as f:
+                    archive.add(remote_file, '444444', f)
+            archive.add(upload.RemoteFile(datetime.date(2014, 12, 11), 'Y01A.CARS.#D.555555.D111214', 5, 0),
+                        '555555', io.BytesIO(b'other'))
+
+            self.assertSourceFiles(ArchiveFileSource(archive, '444444'))
+
+            with mock.patch.multiple(settings, FILE_SOURCE='archive', ARCHIVE_DIR=archive_dir), \
+                    get_file_source() as source:
+                self.assertIsInstance(source, ArchiveFileSource)
+        with mock.patch.multiple(settings, FILE_SOURCE='archive', ARCHIVE_DIR=''), self.assertRaises(ValueError):
+            get_file_source()
+
+    def test_source_chosen_from_settings(self):
+        for file_source, source_class in [('local', LocalFileSource), ('memory', MemoryFileSource)]:
+            with mock.patch.multiple(settings, FILE_SOURCE=file_source, FILE_SOURCE_DIR=self.source_dir), \
+                    get_file_source() as source:
+                self.assertIsInstance(source, source_class)
+                self.assertEqual(len(source.listdir()), 2)
+        with mock.patch.object(settings, 'FILE_SOURCE', 'ftp'), self.assertRaises(ValueError):
+            get_file_source()
+
+    def test_new_files_downloaded_from_source(self):
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                mock.patch.multiple(settings, FILE_SOURCE='memory', FILE_SOURCE_DIR=self.source_dir,
+                                    DS_NEW_FILES_DIR=temp_dir, ACCOUNT_CODE='444444'):
+            with get_file_source() as source:
+                new_files = upload.list_new_files(source, datetime.date(2014, 12, 9))
+                new_filenames = [upload.download_file(source, new_file) for new_file in new_files]
+            self.assertEqual([new_file.date for new_file in new_files], [datetime.date(2014, 12, 10)])
+            self.assertEqual(new_filenames, [os.path.join(temp_dir, 'Y01A.CARS.#D.444444.D101214')])
+            with open(new_filenames[0], 'rb') as f:
+                self.assertEqual(f.read(), b'file 2 content')
@@ -0,0 +1,62 @@
+from datetime import date
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader.spool import DeadLetterSpool
+
+TRANSACTIONS = [
+    {'amount': 100, 'category': 'credit', 'reference': 'A1234BC 01/01/1980'},
+    {'amount': 50, 'category': 'debit', 'reference': None},
+]
+
+
+class DeadLetterSpoolTestCase(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.spool_dir = os.path.join(self.temp_dir, 'dead_letters')
+
+    def test_dead_letters_listed_in_date_order(self):
+        spool = DeadLetterSpool(self.spool_dir, max_bytes=1000 * 1000, max_age=60)
+        self.assertEqual(spool.add('FILE2', date(2014, 12, 10), iter(TRANSACTIONS), 20, 'Server error'), 2)
+        self.assertEqual(spool.add('FILE1', date(2014, 12, 9), iter(TRANSACTIONS[:1]), 10, 'Server error'), 1)
+
+        dead_letters = spool.list()
+        self.assertEqual([dead_letter.filename for dead_letter in dead_letters], ['FILE1', 'FILE2'])
+        self.assertEqual(dead_letters[1].date, '2014-12-10')
+        self.assertEqual(dead_letters[1].balance_change, 20)
+        self.assertEqual(dead_letters[1].error, 'Server error')
+        self.assertEqual(dead_letters[1].attempts, 1)
+        self.assertEqual(list(spool.read_transactions(dead_letters[1])), TRANSACTIONS)
+
+        spool.remove(dead_letters[0])
+        self.assertEqual([dead_letter.filename for dead_letter in spool.list()], ['FILE2'])
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+    @mock.patch('mtp_transaction_uploader.spool.logger')
+    def test_old_dead_letters_discarded(self, mock_logger):
+        spool = DeadLetterSpool(self.spool_dir, max_bytes=1000 * 1000, max_age=60)
+        spool.add('FILE1', date(2014, 12, 9), iter(TRANSACTIONS), 0, 'Server error', created_at=time.time() - 120)
+        spool.add('FILE2', date(2014, 12, 10), iter(TRANSACTIONS), 0, 'Server error')
+
+        self.assertEqual([dead_letter.filename for dead_letter in spool.list()], ['FILE2'])
+        mock_logger.error.assert_called_once()
+
+    @mock.patch('mtp_transaction_uploader.spool.logger')
+    def test_oldest_dead_letters_discarded_when_spool_is_full(self, mock_logger):
+        spool = DeadLetterSpool(self.spool_dir, max_bytes=1000 * 1000, max_age=60)
+        spool.add('FILE1', date(2014, 12, 9), iter(TRANSACTIONS), 0, 'Server error')
+        size = os.path.getsize(spool.list()[0].path)
+
+        # room for two dead letters whose headers may compress a few bytes differently
+        spool.max_bytes = size * 5 // 2
+        spool.add('FILE3', date(2014, 12, 11), iter(TRANSACTIONS), 0, 'Server error')
+        spool.add('FILE2', date(2014, 12, 10), iter(TRANSACTIONS), 0, 'Server error')
+
+        self.assertEqual([dead_letter.filename for dead_letter in spool.list()], ['FILE2', 'FILE3'])
+        mock_logger.error.assert_called_once()
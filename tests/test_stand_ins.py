@@ -0,0 +1,294 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+import paramiko
+import sentry_sdk
+
+import main
+from mtp_transaction_uploader import api_client, governor, metrics, pipeline, settings, upload
+from mtp_transaction_uploader.archive import get_file_archive
+from mtp_transaction_uploader.governor import APIUnavailableError
+from mtp_transaction_uploader.profiling import start_profiling, stop_profiling
+from mtp_transaction_uploader.spool import get_dead_letter_spool
+from mtp_transaction_uploader.tracing import read_traces, TraceFileTransport
+from tests.stand_ins import Faults, StandInAPI, StandInSFTPServer
+
+TEST_FILE = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+
+class StandInEndToEndTestCase(TestCase):
+    """
+    Runs the whole uploader against in-process stand-ins for the API and SFTP server
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+        self.sftp_root = os.path.join(self.temp_dir, 'sftp')
+        os.makedirs(os.path.join(self.sftp_root, 'outbox'))
+        shutil.copy(TEST_FILE, os.path.join(self.sftp_root, 'outbox'))
+
+        private_key_path = os.path.join(self.temp_dir, 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(private_key_path)
+        self.settings = {
+            'SFTP_HOST': '127.0.0.1',
+            'SFTP_USER': 'stand-in',
+            'SFTP_PRIVATE_KEY': private_key_path,
+            'SFTP_DIR': 'outbox',
+            'DS_NEW_FILES_DIR': os.path.join(self.temp_dir, 'ds_new_files'),
+        }
+
+        patcher = mock.patch.dict(os.environ, {'OAUTHLIB_INSECURE_TRANSPORT': '1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_uploader(self, uploader, api_faults=None, api_endpoint_faults=None, sftp_faults=None):
+        with StandInAPI(faults=api_faults, endpoint_faults=api_endpoint_faults) as api, \
+                StandInSFTPServer(self.sftp_root, faults=sftp_faults) as sftp_server, \
+                mock.patch.multiple(settings, SFTP_PORT=sftp_server.port, API_URL=api.url, **self.settings), \
+                mock.patch.object(api_client, 'REQUEST_TOKEN_URL', f'{api.url}/oauth2/token/'), \
+                mock.patch.object(governor._api_governor, 'instance', None):
+            uploader()
+        return api
+
+    def assertUploaded(self, api):  # noqa: N802
+        self.assertEqual(len(api.transactions), 3)
+        self.assertEqual(
+            sorted(transaction['amount'] for transaction in api.transactions),
+            [8939, 9802, 288615],
+        )
+        self.assertEqual(api.balances, [{'date': '2014-02-05', 'closing_balance': 8939 + 9802 - 288615}])
+
+    def test_upload(self):
+        api = self.run_uploader(upload.main)
+        self.assertUploaded(api)
+
+    def test_upload_records_metrics(self):
+        def get_metrics():
+            return {
+                (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+                for metric in metrics.registry.collect()
+                for sample in metric.samples
+                if sample.name.endswith(('_total', '_count'))
+            }
+
+        metrics_before = get_metrics()
+        self.run_uploader(upload.main)
+        metrics_after = get_metrics()
+        changes = {
+            key: value - metrics_before.get(key, 0)
+            for key, value in metrics_after.items()
+            if value != metrics_before.get(key, 0)
+        }
+
+        self.assertEqual(changes, {
+            ('mtp_transaction_uploader_files_seen_total', ()): 1,
+            ('mtp_transaction_uploader_files_downloaded_total', (('source', 'sftp'),)): 1,
+            ('mtp_transaction_uploader_downloaded_bytes_total', (('source', 'sftp'),)): os.path.getsize(TEST_FILE),
+            ('mtp_transaction_uploader_records_parsed_total', ()): 4,
+            ('mtp_transaction_uploader_transactions_uploaded_total', (('category', 'credit'),)): 2,
+            ('mtp_transaction_uploader_transactions_uploaded_total', (('category', 'debit'),)): 1,
+            ('mtp_transaction_uploader_upload_chunk_seconds_count', ()): 1,
+            ('mtp_transaction_uploader_balance_post_seconds_count', ()): 1,
+        })
+
+    def test_pipelined_upload(self):
+        api = self.run_uploader(pipeline.main)
+        self.assertUploaded(api)
+
+    def test_upload_from_local_source(self):
+        self.settings.update(FILE_SOURCE='local', FILE_SOURCE_DIR=os.path.join(self.sftp_root, 'outbox'))
+        # the SFTP server is not used
+        api = self.run_uploader(upload.main, sftp_faults=Faults(error_rate=1))
+        self.assertUploaded(api)
+
+    def assertTraced(self, uploader):  # noqa: N802
+        traces_file = os.path.join(self.temp_dir, 'traces.jsonl')
+        sentry_sdk.init(traces_sample_rate=1, transport=TraceFileTransport(traces_file))
+        self.addCleanup(sentry_sdk.get_global_scope().set_client, None)
+        with sentry_sdk.start_transaction(op='uploader.run', name='Upload transactions'):
+            api = self.run_uploader(uploader)
+        self.assertUploaded(api)
+
+        (transaction,) = read_traces(traces_file)
+        self.assertEqual(transaction['contexts']['trace']['op'], 'uploader.run')
+        # requests to the API are also traced automatically as children of these spans
+        spans = [span for span in transaction['spans'] if span['op'] != 'http.client']
+        trace_span_id = transaction['contexts']['trace']['span_id']
+        parse_span = next(span for span in spans if span['op'] == 'file.parse')
+        # records are transformed while the file is parsed
+        self.assertTrue(all(
+            span['parent_span_id'] == (parse_span['span_id'] if span['op'] == 'records.transform' else trace_span_id)
+            for span in spans
+        ))
+        self.assertEqual(
+            {span['op'] for span in spans},
+            {
+                'sftp.connect', 'file.download', 'file.parse', 'records.transform',
+                'api.post_transactions', 'api.post_balance',
+            },
+        )
+        download_span = next(span for span in spans if span['op'] == 'file.download')
+        self.assertEqual(download_span['description'], os.path.basename(TEST_FILE))
+        self.assertEqual(download_span['data']['byte_count'], os.path.getsize(TEST_FILE))
+        transform_span = next(span for span in spans if span['op'] == 'records.transform')
+        self.assertEqual(transform_span['data']['record_count'], 4)
+
+    def test_upload_is_traced(self):
+        self.assertTraced(upload.main)
+
+    def test_pipelined_upload_is_traced(self):
+        self.assertTraced(pipeline.main)
+
+    def test_in_memory_upload(self):
+        with mock.patch.object(settings, 'IN_MEMORY_DOWNLOADS', True):
+            api = self.run_uploader(upload.main)
+        self.assertUploaded(api)
+        self.assertEqual(os.listdir(self.settings['DS_NEW_FILES_DIR']), [])
+
+    def test_upload_is_profiled(self):
+        reports_dir = os.path.join(self.temp_dir, 'profiles')
+        start_profiling(reports_dir)
+        try:
+            api = self.run_uploader(upload.main)
+        finally:
+            stop_profiling()
+        self.assertUploaded(api)
+
+        (run_dir,) = os.listdir(reports_dir)
+        run_dir = os.path.join(reports_dir, run_dir)
+        with open(os.path.join(run_dir, 'summary.jsonl')) as f:
+            summaries = [json.loads(line) for line in f]
+        stages = ['download', 'parse', 'upload', 'balance']
+        self.assertEqual([summary['stage'] for summary in summaries], stages)
+        self.assertTrue(all(summary['filename'] == os.path.basename(TEST_FILE) for summary in summaries))
+        self.assertTrue(all(summary['peak_rss'] > 0 for summary in summaries))
+        self.assertEqual(sorted(os.listdir(os.path.join(run_dir, os.path.basename(TEST_FILE)))), sorted(
+            f'{stage}.{report}' for stage in stages for report in ('prof', 'collapsed', 'allocations.txt')
+        ))
+        with open(os.path.join(run_dir, os.path.basename(TEST_FILE), 'parse.collapsed')) as f:
+            self.assertIn('transform_records', f.read())
+
+    def test_retry_uses_download_cache(self):
+        cache_dir = os.path.join(self.temp_dir, 'cache')
+        with mock.patch.object(settings, 'DOWNLOAD_CACHE_DIR', cache_dir):
+            self.run_uploader(upload.main)
+            api = self.run_uploader(upload.main, sftp_faults=Faults(bytes_per_second=1))
+            download_cache = get_file_archive()
+
+        self.assertUploaded(api)
+        self.assertEqual(download_cache.name, 'cache')
+        self.assertEqual(download_cache.stats, {'hits': 1, 'misses': 1, 'evictions': 0})
+
+    def test_later_run_uses_archive(self):
+        archive_dir = os.path.join(self.temp_dir, 'archive')
+        with mock.patch.object(settings, 'ARCHIVE_DIR', archive_dir):
+            self.run_uploader(upload.main)
+            archived_files = get_file_archive().find(account_code='444444')
+            downloads_before = metrics.registry.get_sample_value(
+                'mtp_transaction_uploader_files_downloaded_total', {'source': 'archive'}
+            ) or 0
+            api = self.run_uploader(upload.main, sftp_faults=Faults(bytes_per_second=1))
+
+        self.assertUploaded(api)
+        self.assertEqual([archived_file.filename for archived_file in archived_files], [os.path.basename(TEST_FILE)])
+        downloads = metrics.registry.get_sample_value(
+            'mtp_transaction_uploader_files_downloaded_total', {'source': 'archive'}
+        ) - downloads_before
+        self.assertEqual(downloads, 1)
+
+    def test_upload_with_latency_and_throughput_cap(self):
+        api = self.run_uploader(
+            upload.main,
+            api_faults=Faults(latency=0.01),
+            sftp_faults=Faults(latency=0.01, bytes_per_second=1000 * 1000),
+        )
+        self.assertUploaded(api)
+
+    @mock.patch('mtp_transaction_uploader.governor.logger')
+    def test_upload_retried_when_api_is_overloaded(self, mock_logger):
+        retries_before = metrics.registry.get_sample_value(
+            'mtp_transaction_uploader_api_retries_total', {'endpoint': 'transactions'}
+        ) or 0
+        overloaded = Faults(error_rate=0.5, error_status=429, retry_after=0, seed=1)
+        with mock.patch.multiple(settings, UPLOAD_REQUEST_SIZE=1, API_MAX_RETRIES=10):
+            api = self.run_uploader(upload.main, api_endpoint_faults={'POST transactions': overloaded})
+
+        self.assertUploaded(api)
+        retries = metrics.registry.get_sample_value(
+            'mtp_transaction_uploader_api_retries_total', {'endpoint': 'transactions'}
+        ) - retries_before
+        self.assertGreater(retries, 0)
+        self.assertEqual(mock_logger.warning.call_count, retries)
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    def test_upload_with_api_errors(self, mock_logger):
+        api = self.run_uploader(upload.main, api_endpoint_faults={'POST transactions': Faults(error_rate=1)})
+
+        self.assertEqual(api.transactions, [])
+        self.assertEqual(api.balances, [])
+        mock_logger.error.assert_called_once()
+
+    @mock.patch('mtp_transaction_uploader.upload.logger')
+    @mock.patch('mtp_transaction_uploader.governor.logger')
+    def test_upload_stops_when_api_is_down(self, mock_governor_logger, mock_upload_logger):
+        for date in ('060214', '070214'):
+            shutil.copy(TEST_FILE, os.path.join(self.sftp_root, 'outbox', f'Y01A.CARS.#D.444444.D{date}'))
+        dead_letter_dir = os.path.join(self.temp_dir, 'dead_letters')
+
+        def upload_and_replay():
+            upload.main()
+            upload.replay_dead_letters()
+
+        api_down = Faults(error_rate=1)
+        with mock.patch.multiple(settings, DEAD_LETTER_DIR=dead_letter_dir, API_CIRCUIT_BREAKER_THRESHOLD=1,
+                                 UPLOAD_CONCURRENCY=1), \
+                self.assertRaises(APIUnavailableError):
+            self.run_uploader(upload_and_replay, api_endpoint_faults={'POST transactions': api_down})
+
+        mock_governor_logger.warning.assert_called_once()
+        with mock.patch.object(settings, 'DEAD_LETTER_DIR', dead_letter_dir):
+            (dead_letter,) = get_dead_letter_spool().list()
+        # later files are left for the next run once the first fails
+        # and replaying stops without sending any requests once the circuit breaker opens
+        self.assertEqual(dead_letter.date, '2014-02-05')
+        self.assertEqual(dead_letter.attempts, 1)
+        mock_upload_logger.error.assert_called_once()
+
+    def test_upload_with_sftp_errors(self):
+        with self.assertRaises(IOError):
+            self.run_uploader(upload.main, sftp_faults=Faults(error_rate=1))
+
+
+class TraceFileTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.addCleanup(sentry_sdk.get_global_scope().set_client, None)
+
+    def test_errors_are_still_sent_to_sentry(self):
+        traces_file = os.path.join(self.temp_dir, 'traces.jsonl')
+        dsn = 'https://key@sentry.example.com/1'
+        with mock.patch.dict(os.environ, {'SENTRY_DSN': dsn}), \
+                mock.patch.multiple(settings, SENTRY_DSN=dsn, SENTRY_TRACES_FILE=traces_file,
+                                    SENTRY_TRACES_SAMPLE_RATE=1), \
+                mock.patch('logging.config.dictConfig'):
+            _, sentry_enabled = main.setup_monitoring()
+        self.assertTrue(sentry_enabled)
+
+        with mock.patch('sentry_sdk.transport.HttpTransport.capture_envelope') as sent_to_sentry:
+            with sentry_sdk.start_transaction(op='uploader.run', name='Upload transactions'):
+                sentry_sdk.capture_message('Upload failed')
+            sentry_sdk.flush()
+
+        (envelope,), _ = sent_to_sentry.call_args
+        self.assertIsNone(envelope.get_transaction_event())
+        self.assertEqual(envelope.get_event()['message'], 'Upload failed')
+        (transaction,) = read_traces(traces_file)
+        self.assertEqual(transaction['contexts']['trace']['op'], 'uploader.run')
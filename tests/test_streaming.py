@@ -0,0 +1,79 @@
+import io
+from unittest import TestCase
+
+from bankline_parser.data_services import parse
+from bankline_parser.data_services.exceptions import ParseError
+
+from mtp_transaction_uploader.streaming import iter_chunks, SpooledTransactions, StreamingDataServicesFile
+
+
+class StreamingDataServicesFileTestCase(TestCase):
+    test_files = [
+        'tests/data/testfile_1',
+        'tests/data/testfile_multiple_accounts',
+        'tests/data/testfile_roll_number',
+        'tests/data/testfile_settlement_credits',
+        'tests/data/testfile_incorrect_totals',
+        'tests/data/Y01A.CARS.#D.444444.D050214',
+    ]
+
+    def test_records_match_parser(self):
+        for test_file in self.test_files:
+            with open(test_file) as f:
+                data_services_file = parse(f)
+            with open(test_file) as f:
+                streaming_file = StreamingDataServicesFile(f)
+                streamed_records = list(streaming_file.records())
+
+            parsed_records = [record for account in data_services_file.accounts for record in account.records]
+            self.assertEqual(
+                [{name: value for name, value in vars(record).items() if name != 'row'} for record in streamed_records],
+                [vars(record) for record in parsed_records],
+                msg=f'{test_file} records differ',
+            )
+            self.assertEqual(streaming_file.errors, data_services_file.errors, msg=f'{test_file} errors differ')
+
+    def test_incorrect_totals(self):
+        with open('tests/data/testfile_incorrect_totals') as f:
+            streaming_file = StreamingDataServicesFile(f)
+            errors = streaming_file.validate()
+
+        self.assertFalse(streaming_file.is_valid())
+        self.assertEqual(errors, {
+            'account 0': [
+                'Monetary total of debit items does not match expected: counted 288615, expected 288610',
+                'Monetary total of credit items does not match expected: counted 18741, expected 18732',
+            ]
+        })
+
+    def test_truncated_file(self):
+        with open('tests/data/testfile_1') as f:
+            lines = f.readlines()[:-2]
+
+        with self.assertRaisesRegex(ParseError, 'File ended unexpectedly'):
+            StreamingDataServicesFile(io.StringIO(''.join(lines))).validate()
+
+    def test_file_without_accounts(self):
+        with open('tests/data/testfile_1') as f:
+            lines = f.readlines()[:1]
+
+        with self.assertRaisesRegex(ParseError, 'No accounts found'):
+            StreamingDataServicesFile(io.StringIO(''.join(lines))).validate()
+
+
+class IterChunksTestCase(TestCase):
+    def test_chunks(self):
+        self.assertEqual(list(iter_chunks(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(iter_chunks(iter(range(6)), 3)), [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(list(iter_chunks([], 3)), [])
+
+
+class SpooledTransactionsTestCase(TestCase):
+    def test_transactions_read_back(self):
+        transactions = [{'amount': 100, 'category': 'credit'}, {'amount': 50, 'prisoner_number': None}]
+        spooled_transactions = SpooledTransactions()
+        spooled_transactions.extend(iter(transactions))
+
+        self.assertEqual(len(spooled_transactions), 2)
+        self.assertEqual(list(spooled_transactions), transactions)
+        self.assertTrue(spooled_transactions.file.closed)
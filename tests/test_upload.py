@@ -1,10 +1,19 @@
-from datetime import date
+from datetime import date, datetime, time, timezone
+import io
+import os
+import shutil
+import tempfile
+import threading
 from unittest import mock, TestCase
 
 from bankline_parser.data_services import parse
+from bankline_parser.data_services.exceptions import ParseError
 from bankline_parser.data_services.models import DataRecord
+from slumber.exceptions import HttpServerError
 
-from mtp_transaction_uploader import upload
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.quarantine import get_record_quarantine
+from mtp_transaction_uploader.spool import get_dead_letter_spool
 
 
 class CreditReferenceParsingTestCase(TestCase):
@@ -174,21 +183,30 @@ class FilenameParsingTestCase(TestCase):
         self.assertEqual(expected_date, parsed_date)
 
 
+def download_new_files(last_date):
+    with upload.get_file_source() as source:
+        new_files = upload.list_new_files(source, last_date)
+        new_filenames = [upload.download_file(source, new_file) for new_file in new_files]
+    return [new_file.date for new_file in new_files], new_filenames
+
+
 @mock.patch('mtp_transaction_uploader.upload.settings')
-@mock.patch('mtp_transaction_uploader.upload.Connection')
+@mock.patch('mtp_transaction_uploader.sources.Connection')
 class FileDownloadTestCase(TestCase):
 
     def _download_new_files(self, mock_connection_class, mock_settings, dirlist, last_date):
         mock_connection = mock.MagicMock()
-        mock_connection_class().__enter__.return_value = mock_connection
+        mock_connection_class.return_value = mock_connection
 
         mock_connection.listdir.return_value = dirlist
-        mock_connection.stat.return_value = type('', (), {'st_size': 1000})()
+        mock_connection.stat.return_value = type('', (), {'st_size': 1000, 'st_mtime': 1418083200})()
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.LARGE_FILE_THRESHOLD_BYTES = 50 * 1000 * 1000
+        mock_settings.IN_MEMORY_DOWNLOADS = False
 
-        return upload.download_new_files(last_date)
+        return download_new_files(last_date)
 
     def test_download_new_files(self, mock_connection_class, mock_settings):
         dirlist = [
@@ -305,7 +323,7 @@ class FileDownloadTestCase(TestCase):
             '/Y01A.CARS.#D.444444.D141214',
         ], new_filenames)
 
-    def test_download_new_files_skips_large_files(
+    def test_download_new_files_downloads_large_files_in_chunks(
         self,
         mock_connection_class,
         mock_settings
@@ -314,48 +332,101 @@ class FileDownloadTestCase(TestCase):
             'Y01A.CARS.#D.444444.D091214',
             'Y01A.CARS.#D.444444.D101214',
             'Y01A.CARS.#D.444444.D111214',
-            'Y01A.CARS.#D.444444.D121214',
-            'Y01A.CARS.#D.444444.D131214',
-            'Y01A.CARS.#D.444444.D141214',
         ]
 
         mock_connection = mock.MagicMock()
-        mock_connection_class().__enter__.return_value = mock_connection
+        mock_connection_class.return_value = mock_connection
 
         mock_connection.listdir.return_value = dirlist
         mock_connection.stat.side_effect = [
-            type('', (), {'st_size': 1000})(),
-            type('', (), {'st_size': 1000})(),
-            type('', (), {'st_size': 1000})(),
-            type('', (), {'st_size': 1000})(),
-            type('', (), {'st_size': 100000000})(),
-            type('', (), {'st_size': 1000})(),
+            type('', (), {'st_size': 5, 'st_mtime': 1418083200})(),
+            type('', (), {'st_size': 12, 'st_mtime': 1418083200})(),
+            type('', (), {'st_size': 5, 'st_mtime': 1418083200})(),
         ]
+        mock_remote_file = mock_connection.open().__enter__.return_value
+        mock_remote_file.read.side_effect = [b'large ', b'file', b'..', b'']
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.LARGE_FILE_THRESHOLD_BYTES = 10
+        mock_settings.DOWNLOAD_CHUNK_SIZE_BYTES = 6
+        mock_settings.IN_MEMORY_DOWNLOADS = False
 
-        new_dates, new_filenames = upload.download_new_files(None)
+        with mock.patch('mtp_transaction_uploader.upload.open', mock.mock_open()) as mock_open:
+            new_dates, new_filenames = download_new_files(None)
 
         self.assertEqual([
             date(2014, 12, 9),
             date(2014, 12, 10),
             date(2014, 12, 11),
-            date(2014, 12, 12),
-            date(2014, 12, 14),
         ], [new_date for new_date in new_dates])
         self.assertEqual([
             '/Y01A.CARS.#D.444444.D091214',
             '/Y01A.CARS.#D.444444.D101214',
             '/Y01A.CARS.#D.444444.D111214',
-            '/Y01A.CARS.#D.444444.D121214',
-            '/Y01A.CARS.#D.444444.D141214',
         ], new_filenames)
 
+        # small files are downloaded in one go, large files chunk by chunk
+        self.assertEqual(mock_connection.get.call_count, 2)
+        mock_connection.open.assert_called_with('Y01A.CARS.#D.444444.D101214', 'rb')
+        mock_open.assert_called_once_with('/Y01A.CARS.#D.444444.D101214', 'wb')
+        self.assertEqual(
+            [call.args[0] for call in mock_open().write.call_args_list],
+            [b'large ', b'file', b'..'],
+        )
+
+    def test_incomplete_chunked_download_raises_error(self, mock_connection_class, mock_settings):
+        mock_connection = mock.MagicMock()
+        mock_connection.open().__enter__.return_value.read.side_effect = [b'trunc', b'']
+
+        mock_settings.DOWNLOAD_CHUNK_SIZE_BYTES = 6
+
+        with self.assertRaises(IOError):
+            upload.download_in_chunks(mock_connection, 'Y01A.CARS.#D.444444.D101214', io.BytesIO(), 12)
+
+    def test_download_new_files_in_memory(self, mock_connection_class, mock_settings):
+        dirlist = [
+            'Y01A.CARS.#D.444444.D091214',
+            'Y01A.CARS.#D.444444.D101214',
+        ]
+
+        mock_connection = mock.MagicMock()
+        mock_connection_class.return_value = mock_connection
+        mock_connection.listdir.return_value = dirlist
+        mock_connection.stat.return_value = type('', (), {'st_size': 8, 'st_mtime': 1418083200})()
+        mock_connection.getfo.side_effect = lambda filename, buffer: buffer.write(b'line 1\nline 2\n'[:8])
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mock_settings.ACCOUNT_CODE = '444444'
+            mock_settings.DS_NEW_FILES_DIR = temp_dir
+            mock_settings.LARGE_FILE_THRESHOLD_BYTES = 50 * 1000 * 1000
+            mock_settings.IN_MEMORY_DOWNLOADS = True
+            mock_settings.IN_MEMORY_DOWNLOAD_MAX_BYTES = 1000
+
+            new_dates, new_files = download_new_files(None)
+
+            # nothing is written to disk
+            self.assertEqual(os.listdir(temp_dir), [])
+            mock_connection.get.assert_not_called()
+
+        self.assertEqual(new_dates, [date(2014, 12, 9), date(2014, 12, 10)])
+        self.assertEqual(
+            [str(new_file) for new_file in new_files],
+            [os.path.join(temp_dir, filename) for filename in dirlist],
+        )
+        for new_file in new_files:
+            self.assertEqual(upload.get_downloaded_file_size(new_file), 8)
+            # can be read more than once
+            for _ in range(2):
+                with upload.open_downloaded_file(new_file) as f:
+                    self.assertEqual(f.read(), 'line 1\nl')
+            upload.discard_downloaded_file(new_file)
+            self.assertTrue(new_file.buffer.closed)
+
 
 class RetrieveNewFilesTestCase(TestCase):
 
-    @mock.patch('mtp_transaction_uploader.upload.Connection')
+    @mock.patch('mtp_transaction_uploader.sources.Connection')
     @mock.patch('mtp_transaction_uploader.upload.settings')
     @mock.patch('mtp_transaction_uploader.upload.os')
     @mock.patch('mtp_transaction_uploader.upload.shutil')
@@ -382,16 +453,20 @@ class RetrieveNewFilesTestCase(TestCase):
         ]
 
         mock_connection = mock.MagicMock()
-        mock_connection_class().__enter__.return_value = mock_connection
+        mock_connection_class.return_value = mock_connection
 
         mock_connection.listdir.return_value = dirlist
-        mock_connection.stat.return_value = type('', (), {'st_size': 1000})()
+        mock_connection.stat.return_value = type('', (), {'st_size': 1000, 'st_mtime': 1418083200})()
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
+        mock_settings.LARGE_FILE_THRESHOLD_BYTES = 50 * 1000 * 1000
+        mock_settings.IN_MEMORY_DOWNLOADS = False
         mock_os.path.join = lambda a, b: a + b
 
-        new_last_date, new_filenames = upload.retrieve_data_services_files()
+        with mock.patch.object(settings, 'UPLOAD_WATERMARK_FILE', ''):
+            upload.prepare_new_files_dir()
+            new_dates, new_filenames = download_new_files(upload.get_last_uploaded_date())
 
         self.assertFalse(mock_shutil.rmtree.called)
 
@@ -400,9 +475,9 @@ class RetrieveNewFilesTestCase(TestCase):
             '/Y01A.CARS.#D.444444.D131214',
             '/Y01A.CARS.#D.444444.D141214',
         ], new_filenames)
-        self.assertEqual(date(2014, 12, 14), new_last_date)
+        self.assertEqual(date(2014, 12, 14), new_dates[-1])
 
-    @mock.patch('mtp_transaction_uploader.upload.Connection')
+    @mock.patch('mtp_transaction_uploader.sources.Connection')
     @mock.patch('mtp_transaction_uploader.upload.settings')
     @mock.patch('mtp_transaction_uploader.upload.os')
     @mock.patch('mtp_transaction_uploader.upload.shutil')
@@ -422,38 +497,93 @@ class RetrieveNewFilesTestCase(TestCase):
         dirlist = []
 
         mock_connection = mock.MagicMock()
-        mock_connection_class().__enter__.return_value = mock_connection
+        mock_connection_class.return_value = mock_connection
 
         mock_connection.listdir.return_value = dirlist
-        mock_connection.stat.return_value = type('', (), {'st_size': 1000})()
 
         mock_settings.ACCOUNT_CODE = '444444'
         mock_settings.DS_NEW_FILES_DIR = '/'
-        mock_os.path.join = lambda a, b: a + b
 
-        new_last_date, new_filenames = upload.retrieve_data_services_files()
+        with mock.patch.object(settings, 'UPLOAD_WATERMARK_FILE', ''), \
+                mock.patch('mtp_transaction_uploader.upload.start_sender_classification_cache') as mock_start_cache:
+            new_dates, new_filenames = download_new_files(upload.get_last_uploaded_date())
+            upload.main()
 
         self.assertFalse(mock_shutil.rmtree.called)
-
         self.assertEqual([], new_filenames)
-        self.assertEqual(None, new_last_date)
+        self.assertEqual([], new_dates)
+        # nothing is uploaded and the API is only asked for the last uploaded date
+        mock_start_cache.assert_not_called()
+        mock_get_connection().transactions.post.assert_not_called()
+        mock_get_connection().batches.post.assert_not_called()
 
 
 def setup_settings(mock_settings, mark_transactions_as_unidentified=False):
+    mock_settings.LARGE_FILE_THRESHOLD_BYTES = 50 * 1000 * 1000
     mock_settings.NOMS_AGENCY_ACCOUNT_NUMBER = '67175315'
     mock_settings.NOMS_AGENCY_SORT_CODE = '123456'
     mock_settings.MARK_TRANSACTIONS_AS_UNIDENTIFIED = mark_transactions_as_unidentified
 
 
+NEW_FILES = [
+    upload.RemoteFile(date(2014, 12, 9), 'Y01A.CARS.#D.444444.D091214', 1000),
+    upload.RemoteFile(date(2014, 12, 10), 'Y01A.CARS.#D.444444.D101214', 1000),
+    upload.RemoteFile(date(2014, 12, 11), 'Y01A.CARS.#D.444444.D111214', 1000),
+]
+
+
+@mock.patch('mtp_transaction_uploader.upload.settings')
+@mock.patch('mtp_transaction_uploader.upload.download_file')
+class DownloadFilesInBackgroundTestCase(TestCase):
+
+    def test_files_yielded_in_order_while_later_files_download(self, mock_download_file, mock_settings):
+        mock_settings.PIPELINE_QUEUE_SIZE = 1
+        last_file_downloaded = threading.Event()
+
+        def download_file(conn, new_file):
+            if new_file == NEW_FILES[-1]:
+                last_file_downloaded.set()
+            return '/' + new_file.filename
+
+        mock_download_file.side_effect = download_file
+
+        downloaded_files = []
+        for filename in upload.download_files_in_background(mock.MagicMock(), NEW_FILES):
+            if not downloaded_files:
+                # processing of the first file can only finish once a later file is downloaded in the background
+                self.assertTrue(last_file_downloaded.wait(timeout=5))
+            downloaded_files.append(filename)
+
+        self.assertEqual(downloaded_files, ['/' + new_file.filename for new_file in NEW_FILES])
+
+    def test_download_errors_end_files_when_reached(self, mock_download_file, mock_settings):
+        mock_settings.PIPELINE_QUEUE_SIZE = 1
+        mock_download_file.side_effect = ['/' + NEW_FILES[0].filename, IOError('connection lost')]
+
+        with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            downloaded_files = list(upload.download_files_in_background(mock.MagicMock(), NEW_FILES))
+
+        self.assertEqual(downloaded_files, ['/' + NEW_FILES[0].filename])
+        self.assertEqual(mock_download_file.call_count, 2)
+        mock_logger.error.assert_called_once()
+
+    def test_downloads_stop_when_processing_stops(self, mock_download_file, mock_settings):
+        mock_settings.PIPELINE_QUEUE_SIZE = 1
+        mock_download_file.side_effect = lambda conn, new_file: '/' + new_file.filename
+
+        downloaded_files = upload.download_files_in_background(mock.MagicMock(), NEW_FILES * 10)
+        next(downloaded_files)
+        downloaded_files.close()
+
+        self.assertLess(mock_download_file.call_count, len(NEW_FILES) * 10)
+
+
 class TransactionsFromFileTestCase(TestCase):
     @mock.patch('mtp_transaction_uploader.upload.settings')
     def test_get_transactions(self, mock_settings):
         setup_settings(mock_settings)
 
-        with open('tests/data/testfile_1') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_1')
 
         self.assertEqual(len(transactions), 3)
 
@@ -499,10 +629,7 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[2]['incomplete_sender_info'], False)
 
     def test_populates_roll_numbers_when_relevant_sort_codes_found(self):
-        with open('tests/data/testfile_roll_number') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_roll_number')
 
         self.assertEqual(len(transactions), 7)
 
@@ -528,10 +655,7 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[6]['sender_roll_number'], 'A12345678')
 
     def test_does_not_populate_roll_number_typically(self):
-        with open('tests/data/testfile_1') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_1')
 
         self.assertEqual(len(transactions), 3)
 
@@ -540,10 +664,9 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[2]['sender_roll_number'], None)
 
     def test_does_not_populate_roll_number_if_not_matching_format(self):
-        with open('tests/data/testfile_bs_sort_code_invalid_roll_number') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file(
+            'tests/data/testfile_bs_sort_code_invalid_roll_number'
+        )
         self.assertEqual(len(transactions), 1)
         self.assertEqual(transactions[0]['sender_roll_number'], None)
 
@@ -551,10 +674,7 @@ class TransactionsFromFileTestCase(TestCase):
     def test_marks_incomplete_sender_information(self, mock_settings):
         setup_settings(mock_settings)
 
-        with open('tests/data/testfile_sender_information') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_sender_information')
 
         self.assertEqual(len(transactions), 4)
 
@@ -582,10 +702,7 @@ class TransactionsFromFileTestCase(TestCase):
     def test_marks_incomplete_sender_information_for_metro_bank(self, mock_settings):
         setup_settings(mock_settings)
 
-        with open('tests/data/testfile_metro_bank') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_metro_bank')
 
         self.assertEqual(len(transactions), 4)
 
@@ -595,17 +712,14 @@ class TransactionsFromFileTestCase(TestCase):
 
     @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
     def test_marks_administrative_transactions(self, mock_get_conn):
-        with open('tests/data/testfile_administrative_credits') as f:
-            # records are from 36th date of 2004, i.e. 2004-02-05 (see last 5 digits in each record)
-            data_services_file = parse(f)
-
+        # records are from 36th date of 2004, i.e. 2004-02-05 (see last 5 digits in each record)
         conn = mock_get_conn()
         conn.batches.get.return_value = {
             'count': 1,
             'results': [{'id': 10}]
         }
 
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_administrative_credits')
 
         self.assertEqual(transactions[0]['category'], 'debit')
         self.assertEqual(transactions[0]['source'], 'administrative')
@@ -622,17 +736,14 @@ class TransactionsFromFileTestCase(TestCase):
 
     @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
     def testfile_settlement_credits(self, mock_get_conn):
-        with open('tests/data/testfile_settlement_credits') as f:
-            # records are from 36th date of 2004, i.e. 2004-02-05 (see last 5 digits in each record)
-            data_services_file = parse(f)
-
+        # records are from 36th date of 2004, i.e. 2004-02-05 (see last 5 digits in each record)
         conn = mock_get_conn()
         conn.batches.get.return_value = {
             'count': 1,
             'results': [{'id': 10}]
         }
 
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_settlement_credits')
 
         # test file has 4 settlement transactions which are all "administrative" credits
         self.assertEqual(len(transactions), 4)
@@ -670,9 +781,7 @@ class TransactionsFromFileTestCase(TestCase):
     def test_marking_all_credit_transactions_as_unidentified(self, mock_settings):
         setup_settings(mock_settings, mark_transactions_as_unidentified=True)
 
-        with open('tests/data/testfile_1') as f:
-            data_services_file = parse(f)
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_1')
         self.assertEqual(len(transactions), 3)
 
         # transaction 0 - debit
@@ -704,14 +813,12 @@ class TransactionsFromFileTestCase(TestCase):
     def test_not_marking_administrative_credits_as_unidentified(self, mock_settings, mock_get_conn):
         setup_settings(mock_settings, mark_transactions_as_unidentified=True)
 
-        with open('tests/data/testfile_administrative_credits') as f:
-            data_services_file = parse(f)
         conn = mock_get_conn()
         conn.batches.get.return_value = {
             'count': 1,
             'results': [{'id': 10}]
         }
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_administrative_credits')
         self.assertEqual(len(transactions), 3)
 
         self.assertEqual(transactions[0]['category'], 'debit')
@@ -727,20 +834,14 @@ class TransactionsFromFileTestCase(TestCase):
 
     @mock.patch('mtp_transaction_uploader.upload.logger')
     def test_get_transactions_no_records(self, mock_logger):
-        with open('tests/data/testfile_no_records') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_no_records')
         mock_logger.info.assert_called_with('No records found.')
 
         self.assertEqual(transactions, None)
 
     @mock.patch('mtp_transaction_uploader.upload.logger')
     def test_get_transactions_incorrect_totals(self, mock_logger):
-        with open('tests/data/testfile_incorrect_totals') as f:
-            data_services_file = parse(f)
-
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_incorrect_totals')
         mock_logger.error.assert_called_with(
             'Errors: %s',
             {
@@ -755,16 +856,13 @@ class TransactionsFromFileTestCase(TestCase):
 
     @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
     def test_excludes_records_from_other_accounts(self, mock_get_conn):
-        with open('tests/data/testfile_multiple_accounts') as f:
-            data_services_file = parse(f)
-
         conn = mock_get_conn()
         conn.batches.get.return_value = {
             'count': 1,
             'results': [{'id': 10}]
         }
 
-        transactions = upload.get_transactions_from_file(data_services_file)
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_multiple_accounts')
 
         self.assertEqual(len(transactions), 2)
         # transaction 0 - debit
@@ -779,6 +877,478 @@ class TransactionsFromFileTestCase(TestCase):
         self.assertEqual(transactions[1]['received_at'], '2004-02-07T12:00:00+00:00')
 
 
+def get_transaction_from_record(record):
+    """
+    Transforms one record at a time as transform_records did before it worked column by column
+    """
+    sender_information = upload.extract_sender_information(record)
+    received_at = datetime.combine(record.date, time(12, 0, 0, tzinfo=timezone.utc))
+    transaction = {
+        'amount': record.amount,
+        'sender_sort_code': sender_information.sort_code,
+        'sender_account_number': sender_information.account_number,
+        'sender_roll_number': sender_information.roll_number,
+        'blocked': sender_information.anonymous,
+        'incomplete_sender_info': sender_information.incomplete,
+        'sender_name': record.transaction_description,
+        'reference': record.reference_number,
+        'received_at': received_at.isoformat(),
+        'processor_type_code': record.transaction_code.value,
+    }
+    # payment credits
+    if record.transaction_code in upload.PAYMENT_CREDIT_CODES and not sender_information.administrative:
+        transaction['category'] = 'credit'
+        transaction['source'] = 'bank_transfer'
+        upload.add_prisoner_details(transaction, record)
+    # other credits (e.g. bacs returned)
+    elif record.is_credit():
+        transaction['category'] = 'credit'
+        transaction['source'] = 'administrative'
+
+        batch_id = upload.get_matching_batch_id_for_settlement(record)
+        if batch_id:
+            transaction['batch'] = batch_id
+    # all debits
+    elif record.is_debit():
+        transaction['category'] = 'debit'
+        transaction['source'] = 'administrative'
+
+    return transaction
+
+
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class TransformRecordsTestCase(TestCase):
+    test_files = [
+        'tests/data/testfile_1',
+        'tests/data/testfile_administrative_credits',
+        'tests/data/testfile_bs_sort_code_invalid_roll_number',
+        'tests/data/testfile_metro_bank',
+        'tests/data/testfile_multiple_accounts',
+        'tests/data/testfile_roll_number',
+        'tests/data/testfile_sender_information',
+        'tests/data/testfile_settlement_credits',
+        'tests/data/Y01A.CARS.#D.444444.D050214',
+    ]
+
+    def _assert_matches_row_by_row_transform(self, mock_get_conn):
+        conn = mock_get_conn()
+        conn.batches.get.return_value = {'count': 1, 'results': [{'id': 10}]}
+        for test_file in self.test_files:
+            with open(test_file) as f:
+                data_services_file = parse(f)
+            records = [record for account in data_services_file.accounts for record in account.records]
+
+            conn.batches.get.reset_mock()
+            transactions = upload.transform_records(records)
+            batch_lookups = conn.batches.get.call_args_list
+
+            conn.batches.get.reset_mock()
+            expected_transactions = [
+                get_transaction_from_record(record)
+                for record in records
+                if not (record.is_total() or record.is_balance())
+            ]
+
+            self.assertEqual(transactions, expected_transactions, msg=f'{test_file} transformed differently')
+            self.assertEqual(
+                [list(transaction) for transaction in transactions],
+                [list(transaction) for transaction in expected_transactions],
+                msg=f'{test_file} transformed with different key order',
+            )
+            self.assertEqual(batch_lookups, conn.batches.get.call_args_list)
+
+    def test_matches_row_by_row_transform(self, mock_get_conn):
+        self._assert_matches_row_by_row_transform(mock_get_conn)
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    def test_matches_row_by_row_transform_marking_credits_as_unidentified(self, mock_settings, mock_get_conn):
+        setup_settings(mock_settings, mark_transactions_as_unidentified=True)
+        self._assert_matches_row_by_row_transform(mock_get_conn)
+
+
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class UploadTransactionsFromFilesTestCase(TestCase):
+    test_file = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+    def _upload(self, mock_get_connection, large_file_threshold):
+        conn = mock_get_connection()
+        conn.reset_mock()
+        conn.balances.get.return_value = {'count': 0, 'results': []}
+        conn.batches.get.return_value = {'count': 0, 'results': []}
+
+        with mock.patch('mtp_transaction_uploader.upload.settings') as mock_settings:
+            setup_settings(mock_settings)
+            mock_settings.ACCOUNT_CODE = '444444'
+            mock_settings.UPLOAD_REQUEST_SIZE = 2
+            mock_settings.UPLOAD_CONCURRENCY = 2
+            mock_settings.LARGE_FILE_THRESHOLD_BYTES = large_file_threshold
+            # not created when watching a drop directory
+            mock_settings.DS_NEW_FILES_DIR = os.path.join(tempfile.gettempdir(), 'missing-ds-new-files')
+            transaction_count = upload.upload_transactions_from_files([self.test_file])
+
+        return transaction_count, conn.transactions.post.call_args_list, conn.balances.post.call_args_list
+
+    def test_large_file_uploads_same_transactions(self, mock_get_connection):
+        small_file_upload = self._upload(mock_get_connection, 50 * 1000 * 1000)
+        large_file_upload = self._upload(mock_get_connection, 1)
+
+        transaction_count, transaction_posts, balance_posts = large_file_upload
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(len(transaction_posts), 2)
+        self.assertEqual(balance_posts[0].args[0]['date'], '2014-02-05')
+        self.assertEqual(small_file_upload, large_file_upload)
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    @mock.patch('mtp_transaction_uploader.upload.post_balance_for_file')
+    @mock.patch('mtp_transaction_uploader.upload.post_transactions')
+    @mock.patch('mtp_transaction_uploader.upload.get_transactions_from_local_file')
+    def test_files_uploaded_in_parallel_and_balances_updated_in_order(
+        self, mock_get_transactions, mock_post_transactions, mock_post_balance, mock_settings, _
+    ):
+        mock_settings.UPLOAD_CONCURRENCY = 2
+        files = ['/' + new_file.filename for new_file in NEW_FILES]
+        # the first file can only finish uploading while the second is uploading too
+        both_uploading = threading.Barrier(2, timeout=5)
+
+        def post_transactions(conn, filename, transactions):
+            if filename in files[:2]:
+                both_uploading.wait()
+            return upload.UploadedTransactions(len(list(transactions)), 0)
+
+        mock_get_transactions.side_effect = lambda filename, balance_records: [{'amount': 1}]
+        mock_post_transactions.side_effect = post_transactions
+        mock_post_balance.side_effect = lambda filename, uploaded: uploaded.transaction_count
+
+        self.assertEqual(upload.upload_transactions_from_files(iter(files)), 3)
+        self.assertEqual([call.args[0] for call in mock_post_balance.call_args_list], files)
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    @mock.patch('mtp_transaction_uploader.upload.post_balance_for_file')
+    @mock.patch('mtp_transaction_uploader.upload.post_transactions')
+    @mock.patch('mtp_transaction_uploader.upload.get_transactions_from_local_file')
+    def test_balances_not_updated_after_failed_file(
+        self, mock_get_transactions, mock_post_transactions, mock_post_balance, mock_settings, _
+    ):
+        mock_settings.UPLOAD_CONCURRENCY = 3
+        files = ['/' + new_file.filename for new_file in NEW_FILES]
+        mock_get_transactions.side_effect = [None, [{'amount': 1}], [{'amount': 1}]]
+        mock_post_transactions.side_effect = lambda conn, filename, transactions: (
+            None if filename == files[1] else upload.UploadedTransactions(1, 1)
+        )
+        mock_post_balance.return_value = 1
+
+        with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            transaction_count = upload.upload_transactions_from_files(files)
+
+        # the first file had nothing to upload and the second failed so the third's balance is held back
+        self.assertEqual(transaction_count, 0)
+        self.assertEqual(mock_post_transactions.call_count, 2)
+        mock_post_balance.assert_not_called()
+        mock_logger.error.assert_called_once()
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    @mock.patch('mtp_transaction_uploader.upload.post_balance_for_file')
+    @mock.patch('mtp_transaction_uploader.upload.post_transactions')
+    @mock.patch('mtp_transaction_uploader.upload.get_transactions_from_local_file')
+    def test_later_files_not_uploaded_after_file_raises(
+        self, mock_get_transactions, mock_post_transactions, mock_post_balance, mock_settings, _
+    ):
+        mock_settings.UPLOAD_CONCURRENCY = 2
+        files = ['/' + new_file.filename for new_file in NEW_FILES + NEW_FILES[:1]]
+        # the third file is parsed while the second is still being parsed
+        both_parsing = threading.Barrier(2, timeout=5)
+
+        def get_transactions(filename, balance_records):
+            if filename == files[1]:
+                both_parsing.wait()
+                raise ValueError('Unexpected record')
+            if filename == files[2]:
+                both_parsing.wait()
+            return [{'amount': 1}]
+
+        mock_get_transactions.side_effect = get_transactions
+        mock_post_transactions.return_value = upload.UploadedTransactions(1, 1)
+        mock_post_balance.return_value = 1
+
+        with self.assertRaisesRegex(ValueError, 'Unexpected record'):
+            upload.upload_transactions_from_files(iter(files))
+
+        # the third file's transactions are not posted so the second is still uploaded by the next run
+        self.assertEqual([call.args[1] for call in mock_post_transactions.call_args_list], files[:1])
+        self.assertEqual([call.args[0] for call in mock_post_balance.call_args_list], files[:1])
+        self.assertEqual(mock_get_transactions.call_count, 3)
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    @mock.patch('mtp_transaction_uploader.upload.post_balance_for_file')
+    @mock.patch('mtp_transaction_uploader.upload.post_transactions')
+    @mock.patch('mtp_transaction_uploader.upload.get_transactions_from_local_file')
+    def test_earlier_balances_updated_when_downloads_fail(
+        self, mock_get_transactions, mock_post_transactions, mock_post_balance, mock_settings, _
+    ):
+        mock_settings.UPLOAD_CONCURRENCY = 2
+        mock_get_transactions.return_value = [{'amount': 1}]
+        mock_post_transactions.return_value = upload.UploadedTransactions(1, 1)
+        mock_post_balance.return_value = 1
+
+        def downloaded_files():
+            yield '/' + NEW_FILES[0].filename
+            yield '/' + NEW_FILES[1].filename
+            raise IOError('Connection lost')
+
+        with self.assertRaisesRegex(IOError, 'Connection lost'):
+            upload.upload_transactions_from_files(downloaded_files())
+
+        self.assertEqual(
+            [call.args[0] for call in mock_post_balance.call_args_list],
+            ['/' + new_file.filename for new_file in NEW_FILES[:2]],
+        )
+
+    @mock.patch('mtp_transaction_uploader.upload.settings')
+    @mock.patch('mtp_transaction_uploader.upload.post_balance_for_file')
+    @mock.patch('mtp_transaction_uploader.upload.post_transactions')
+    @mock.patch('mtp_transaction_uploader.upload.get_transactions_from_local_file')
+    def test_held_back_balances_are_spooled(
+        self, mock_get_transactions, mock_post_transactions, mock_post_balance, mock_settings, _
+    ):
+        mock_settings.UPLOAD_CONCURRENCY = 3
+        mock_settings.ACCOUNT_CODE = '444444'
+        files = ['/' + new_file.filename for new_file in NEW_FILES]
+        mock_get_transactions.return_value = [{'amount': 1}]
+        mock_post_transactions.side_effect = lambda conn, filename, transactions: (
+            None if filename == files[0] else upload.UploadedTransactions(1, 5)
+        )
+
+        with tempfile.TemporaryDirectory() as dead_letter_dir, \
+                mock.patch.object(settings, 'DEAD_LETTER_DIR', dead_letter_dir), \
+                mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.upload_transactions_from_files(files), 0)
+            dead_letters = get_dead_letter_spool().list()
+
+            # balances of later runs also wait until the spool is replayed
+            self.assertEqual(upload.BalanceCommitStage().spooled_filename, dead_letters[0].filename)
+
+        mock_post_balance.assert_not_called()
+        self.assertEqual(
+            [(dead_letter.filename, dead_letter.balance_change) for dead_letter in dead_letters],
+            [(NEW_FILES[1].filename, 5), (NEW_FILES[2].filename, 5)],
+        )
+
+    def test_file_with_incorrect_totals_is_not_uploaded(self, mock_get_connection):
+        self.test_file = 'tests/data/testfile_incorrect_totals'
+
+        for large_file_threshold in (50 * 1000 * 1000, 1):
+            with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+                transaction_count, transaction_posts, balance_posts = self._upload(
+                    mock_get_connection, large_file_threshold,
+                )
+
+            self.assertEqual(transaction_count, 0)
+            self.assertEqual(transaction_posts, [])
+            self.assertEqual(balance_posts, [])
+            mock_logger.error.assert_called_once_with('Errors: %s', {
+                'account 0': [
+                    'Monetary total of debit items does not match expected: counted 288615, expected 288610',
+                    'Monetary total of credit items does not match expected: counted 18741, expected 18732',
+                ]
+            })
+
+    def test_truncated_file_is_not_uploaded(self, mock_get_connection):
+        with open(self.test_file) as f:
+            lines = f.readlines()[:-2]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.test_file = os.path.join(temp_dir, os.path.basename(self.test_file))
+            with open(self.test_file, 'w') as f:
+                f.writelines(lines)
+
+            with self.assertRaisesRegex(ParseError, 'File ended unexpectedly'):
+                self._upload(mock_get_connection, 50 * 1000 * 1000)
+
+        mock_get_connection().transactions.post.assert_not_called()
+
+
+@mock.patch('mtp_transaction_uploader.upload.time.sleep')
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class DeadLetterReplayTestCase(TestCase):
+    test_file = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        patcher = mock.patch.multiple(
+            settings,
+            DEAD_LETTER_DIR=os.path.join(temp_dir, 'dead_letters'),
+            DEAD_LETTER_REPLAY_ATTEMPTS=3,
+            DEAD_LETTER_REPLAY_BACKOFF_SECONDS=1,
+            UPLOAD_REQUEST_SIZE=1,
+            ACCOUNT_CODE='444444',
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload_with_second_chunk_failing(self, conn):
+        conn.balances.get.return_value = {'count': 0, 'results': []}
+        conn.batches.get.return_value = {'count': 0, 'results': []}
+        conn.transactions.post.side_effect = [None, HttpServerError(content=b'Server error')]
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.upload_transactions_from_files([self.test_file]), 0)
+        conn.balances.post.assert_not_called()
+        return conn.transactions.post.call_args_list[0].args[0][0]
+
+    def test_failed_transactions_spooled_and_replayed(self, mock_get_connection, mock_sleep):
+        conn = mock_get_connection()
+        uploaded_transaction = self._upload_with_second_chunk_failing(conn)
+
+        (dead_letter,) = get_dead_letter_spool().list()
+        self.assertEqual(dead_letter.filename, os.path.basename(self.test_file))
+        self.assertEqual(dead_letter.date, '2014-02-05')
+        self.assertEqual(dead_letter.balance_change, upload.get_balance_change([uploaded_transaction]))
+        self.assertEqual(dead_letter.error, 'Server error')
+        self.assertEqual(len(list(get_dead_letter_spool().read_transactions(dead_letter))), 2)
+
+        conn.transactions.post.reset_mock(side_effect=True)
+        self.assertEqual(upload.replay_dead_letters(), 2)
+
+        self.assertEqual(conn.transactions.post.call_count, 2)
+        conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 8939 + 9802 - 288615})
+        self.assertEqual(get_dead_letter_spool().list(), [])
+        mock_sleep.assert_not_called()
+
+    def test_held_back_balance_replayed(self, mock_get_connection, mock_sleep):
+        conn = mock_get_connection()
+        conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 100}]}
+        conn.balances.post.side_effect = [HttpServerError(content=b'Server error'), None]
+        get_dead_letter_spool().add(
+            os.path.basename(self.test_file), date(2014, 2, 5), [], 50, 'Balance held back',
+        )
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.replay_dead_letters(), 0)
+
+        conn.transactions.post.assert_not_called()
+        self.assertEqual(conn.balances.post.call_count, 2)
+        conn.balances.post.assert_called_with({'date': '2014-02-05', 'closing_balance': 150})
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(get_dead_letter_spool().list(), [])
+
+    def test_files_with_dead_letters_not_uploaded_again(self, mock_get_connection, mock_sleep):
+        self._upload_with_second_chunk_failing(mock_get_connection())
+
+        sftp_conn = mock.MagicMock()
+        sftp_conn.listdir.return_value = [os.path.basename(self.test_file), 'Y01A.CARS.#D.444444.D060214']
+        sftp_conn.stat.return_value = type('', (), {'st_size': 1000, 'st_mtime': 1418083200})()
+        new_files = upload.list_new_files(sftp_conn, date(2014, 2, 4))
+
+        self.assertEqual([new_file.filename for new_file in new_files], ['Y01A.CARS.#D.444444.D060214'])
+
+    def test_replay_backs_off_and_stops_after_repeated_failures(self, mock_get_connection, mock_sleep):
+        conn = mock_get_connection()
+        self._upload_with_second_chunk_failing(conn)
+
+        conn.transactions.post.reset_mock(side_effect=True)
+        conn.transactions.post.side_effect = HttpServerError(content=b'Server error')
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.replay_dead_letters(), 0)
+
+        self.assertEqual(conn.transactions.post.call_count, 3)
+        self.assertEqual([call.args[0] for call in mock_sleep.call_args_list], [1, 2])
+        (dead_letter,) = get_dead_letter_spool().list()
+        self.assertEqual(dead_letter.attempts, 4)
+        self.assertEqual(len(list(get_dead_letter_spool().read_transactions(dead_letter))), 2)
+        conn.balances.post.assert_not_called()
+
+
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class RecordQuarantineTestCase(TestCase):
+    test_file = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        patcher = mock.patch.multiple(
+            settings,
+            QUARANTINE_DIR=os.path.join(temp_dir, 'quarantine'),
+            DEAD_LETTER_DIR='',
+            UPLOAD_REQUEST_SIZE=10,
+            ACCOUNT_CODE='444444',
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _upload_with_odd_reference(self, conn):
+        conn.balances.get.return_value = {'count': 0, 'results': []}
+        conn.batches.get.return_value = {'count': 0, 'results': []}
+        extract_prisoner_details = upload.extract_prisoner_details
+
+        def fail_on_odd_reference(record):
+            if record.reference_number.startswith('B4321XZ'):
+                raise ValueError('Odd reference')
+            return extract_prisoner_details(record)
+
+        with mock.patch('mtp_transaction_uploader.upload.extract_prisoner_details', fail_on_odd_reference), \
+                mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            transaction_count = upload.upload_transactions_from_files([self.test_file])
+        return transaction_count, mock_logger
+
+    def test_records_that_fail_are_quarantined(self, mock_get_connection):
+        conn = mock_get_connection()
+        transaction_count, mock_logger = self._upload_with_odd_reference(conn)
+
+        self.assertEqual(transaction_count, 2)
+        (posted_transactions,) = [call.args[0] for call in conn.transactions.post.call_args_list]
+        self.assertEqual([transaction['amount'] for transaction in posted_transactions], [288615, 8939])
+        # the closing balance still includes the quarantined credit
+        conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 8939 + 9802 - 288615})
+        mock_logger.error.assert_called_once_with(
+            'Quarantined record from %s with reference %r: %s: %s',
+            os.path.basename(self.test_file), 'B4321XZ 8/11/1992 ', 'ValueError', mock.ANY,
+        )
+
+        quarantine = get_record_quarantine()
+        (quarantine_file,) = quarantine.list()
+        self.assertEqual(quarantine_file.filename, os.path.basename(self.test_file))
+        self.assertEqual(quarantine_file.date, '2014-02-05')
+        self.assertEqual(quarantine_file.balance_change, 9802)
+        (quarantined_record,) = quarantine.read_records(quarantine_file)
+        self.assertEqual(quarantined_record.record.amount, 9802)
+        self.assertEqual(quarantined_record.error, 'ValueError: Odd reference')
+
+    def test_records_raise_errors_without_quarantine(self, mock_get_connection):
+        conn = mock_get_connection()
+        with mock.patch.object(settings, 'QUARANTINE_DIR', ''), self.assertRaises(ValueError):
+            self._upload_with_odd_reference(conn)
+        conn.transactions.post.assert_not_called()
+
+    def test_quarantined_records_replayed(self, mock_get_connection):
+        conn = mock_get_connection()
+        self._upload_with_odd_reference(conn)
+        conn.reset_mock()
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.replay_quarantined_records(), 1)
+
+        (posted_transactions,) = [call.args[0] for call in conn.transactions.post.call_args_list]
+        self.assertEqual(len(posted_transactions), 1)
+        self.assertEqual(posted_transactions[0]['amount'], 9802)
+        self.assertEqual(posted_transactions[0]['prisoner_number'], 'B4321XZ')
+        conn.balances.post.assert_not_called()
+        self.assertEqual(get_record_quarantine().list(), [])
+
+    def test_quarantined_records_kept_if_replay_fails(self, mock_get_connection):
+        conn = mock_get_connection()
+        self._upload_with_odd_reference(conn)
+        conn.transactions.post.side_effect = HttpServerError(content=b'Server error')
+
+        with mock.patch('mtp_transaction_uploader.upload.logger'):
+            self.assertEqual(upload.replay_quarantined_records(), 0)
+
+        (quarantine_file,) = get_record_quarantine().list()
+        self.assertEqual(quarantine_file.balance_change, 9802)
+        (quarantined_record,) = get_record_quarantine().read_records(quarantine_file)
+        self.assertEqual(quarantined_record.record.amount, 9802)
+
+
 @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
 class UpdateNewBalanceTestCase(TestCase):
 
@@ -827,6 +1397,56 @@ class UpdateNewBalanceTestCase(TestCase):
         })
 
 
+@mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+class FileBalanceTestCase(TestCase):
+    filename = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+    def test_balance_records_read_from_file(self, _):
+        balance_records = []
+        transactions = upload.get_transactions_from_local_file('tests/data/testfile_file_balances', balance_records)
+
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual(len(balance_records), 1)
+        self.assertEqual(upload.get_file_balance(balance_records), upload.FileBalance(0, 8939 + 9802 - 288615))
+        self.assertIsNone(upload.get_file_balance([]))
+
+    @mock.patch.object(settings, 'USE_FILE_BALANCES', True)
+    def test_closing_balance_taken_from_file(self, mock_get_connection):
+        conn = mock_get_connection()
+        uploaded = upload.UploadedTransactions(3, -200, upload.FileBalance(1000, 800))
+
+        self.assertEqual(upload.post_balance_for_file(self.filename, uploaded), 3)
+
+        conn.balances.get.assert_not_called()
+        conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 800})
+
+    @mock.patch.object(settings, 'USE_FILE_BALANCES', True)
+    def test_mismatched_file_balance_is_reported(self, mock_get_connection):
+        conn = mock_get_connection()
+        conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 500}]}
+        uploaded = upload.UploadedTransactions(3, -200, upload.FileBalance(1000, 900))
+
+        with mock.patch('mtp_transaction_uploader.upload.logger') as mock_logger:
+            self.assertEqual(upload.post_balance_for_file(self.filename, uploaded), 3)
+
+        mock_logger.error.assert_called_once()
+        # closing balance follows on from the previous one in the API instead
+        conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 300})
+
+    def test_file_balances_can_be_disabled(self, mock_get_connection):
+        conn = mock_get_connection()
+        conn.balances.get.return_value = {'count': 1, 'results': [{'closing_balance': 500}]}
+        uploaded = upload.UploadedTransactions(3, -200, upload.FileBalance(1000, 800))
+
+        with mock.patch.object(settings, 'USE_FILE_BALANCES', False):
+            upload.post_balance_for_file(self.filename, uploaded)
+
+        conn.balances.post.assert_called_once_with({'date': '2014-02-05', 'closing_balance': 300})
+
+    def test_file_balances_not_used_by_default(self, mock_get_connection):
+        self.assertFalse(settings.USE_FILE_BALANCES)
+
+
 class SettlementDateParsingTestCase(TestCase):
     def test_parsable_settlement_2_digit_dates(self):
         values = [
@@ -0,0 +1,155 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import settings
+from mtp_transaction_uploader.watch import DropDirectoryWatcher
+
+TEST_FILE = 'tests/data/Y01A.CARS.#D.444444.D050214'
+
+
+@mock.patch('mtp_transaction_uploader.watch.upload.upload_transactions_from_files')
+@mock.patch('mtp_transaction_uploader.watch.upload.get_last_uploaded_date')
+class DropDirectoryWatcherTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        self.drop_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.drop_dir)
+        patcher = mock.patch.multiple(settings, ACCOUNT_CODE='444444', DEAD_LETTER_DIR='')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_watcher(self, **kwargs):
+        return DropDirectoryWatcher(self.drop_dir, **{'settle_seconds': 0.2, 'poll_seconds': 0.05, **kwargs})
+
+    def watch_until_uploaded(self, watcher, mock_upload, drop_files, upload_count=1, failing_filenames=()):
+        stop = threading.Event()
+        uploaded = []
+
+        def upload_transactions_from_files(paths, balance_commit):
+            uploaded.append([os.path.basename(path) for path in paths])
+            if len(uploaded) == upload_count:
+                stop.set()
+            for path in paths:
+                if os.path.basename(path) in failing_filenames:
+                    raise ValueError('Unexpected record')
+                balance_commit.finished_filenames.append(path)
+            return len(paths)
+
+        mock_upload.side_effect = upload_transactions_from_files
+        thread = threading.Thread(target=watcher.run, args=(stop,))
+        thread.start()
+        try:
+            drop_files()
+            self.assertTrue(stop.wait(timeout=10), msg='Dropped files were not uploaded')
+        finally:
+            stop.set()
+            thread.join()
+        return uploaded
+
+    def drop_file(self, filename):
+        shutil.copy(TEST_FILE, os.path.join(self.drop_dir, filename))
+
+    def assertDroppedFilesUploaded(self, watcher, mock_upload):  # noqa: N802
+        def drop_files():
+            self.drop_file('Y01A.CARS.#D.444444.D050214')
+            # wrong account and partly copied files are ignored
+            self.drop_file('Y01A.CARS.#D.555555.D060214')
+            self.drop_file('Y01A.CARS.#D.444444.D070214.part')
+
+        uploaded = self.watch_until_uploaded(watcher, mock_upload, drop_files)
+        self.assertEqual(uploaded, [['Y01A.CARS.#D.444444.D050214']])
+
+    def test_dropped_files_uploaded(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = datetime.date(2014, 2, 4)
+        self.assertDroppedFilesUploaded(self.make_watcher(), mock_upload)
+
+    def test_dropped_files_uploaded_when_polling(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = None
+        self.assertDroppedFilesUploaded(self.make_watcher(use_polling=True), mock_upload)
+
+    @mock.patch('mtp_transaction_uploader.watch.Observer')
+    def test_falls_back_to_polling(self, mock_observer, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = None
+        mock_observer().start.side_effect = OSError('inotify watch limit reached')
+        with mock.patch('mtp_transaction_uploader.watch.logger') as mock_logger:
+            self.assertDroppedFilesUploaded(self.make_watcher(), mock_upload)
+        mock_logger.warning.assert_called_once()
+
+    def test_files_dropped_earlier_uploaded_in_date_order(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = datetime.date(2014, 2, 4)
+        for filename in ('Y01A.CARS.#D.444444.D060214', 'Y01A.CARS.#D.444444.D040214', 'Y01A.CARS.#D.444444.D050214'):
+            self.drop_file(filename)
+
+        uploaded = self.watch_until_uploaded(self.make_watcher(), mock_upload, lambda: None)
+        self.assertEqual(uploaded, [['Y01A.CARS.#D.444444.D050214', 'Y01A.CARS.#D.444444.D060214']])
+
+    def test_each_date_uploaded_once(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = None
+
+        def drop_files():
+            self.drop_file('Y01A.CARS.#D.444444.D050214')
+            self.drop_file('Y01A.CARS.#D.444444.D060214')
+
+        def drop_files_again():
+            drop_files()
+            self.drop_file('Y01A.CARS.#D.444444.D070214')
+
+        watcher = self.make_watcher()
+        self.watch_until_uploaded(watcher, mock_upload, drop_files)
+        uploaded = self.watch_until_uploaded(watcher, mock_upload, drop_files_again, upload_count=1)
+        self.assertEqual(uploaded, [['Y01A.CARS.#D.444444.D070214']])
+
+    def test_last_date_read_before_each_batch(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = None
+
+        def drop_files():
+            # e.g. uploaded by a scheduled run since the first batch
+            mock_get_last_date.return_value = datetime.date(2014, 2, 6)
+            self.drop_file('Y01A.CARS.#D.444444.D060214')
+            self.drop_file('Y01A.CARS.#D.444444.D070214')
+
+        watcher = self.make_watcher()
+        self.watch_until_uploaded(watcher, mock_upload, lambda: self.drop_file('Y01A.CARS.#D.444444.D050214'))
+        uploaded = self.watch_until_uploaded(watcher, mock_upload, drop_files)
+        self.assertEqual(uploaded, [['Y01A.CARS.#D.444444.D070214']])
+
+    def test_unfinished_files_retried_before_later_files(self, mock_get_last_date, mock_upload):
+        mock_get_last_date.return_value = None
+        watcher = self.make_watcher()
+
+        with mock.patch('mtp_transaction_uploader.watch.logger'), \
+                mock.patch('mtp_transaction_uploader.watch.sentry_sdk.capture_exception'):
+            self.watch_until_uploaded(
+                watcher, mock_upload, lambda: self.drop_file('Y01A.CARS.#D.444444.D050214'),
+                failing_filenames={'Y01A.CARS.#D.444444.D050214'},
+            )
+        uploaded = self.watch_until_uploaded(
+            watcher, mock_upload, lambda: self.drop_file('Y01A.CARS.#D.444444.D060214'),
+        )
+        self.assertEqual(uploaded, [['Y01A.CARS.#D.444444.D050214', 'Y01A.CARS.#D.444444.D060214']])
+        self.assertEqual(watcher.unfinished_paths, [])
+
+    @mock.patch('mtp_transaction_uploader.watch.time.monotonic')
+    def test_files_uploaded_once_settled(self, mock_monotonic, mock_get_last_date, mock_upload):
+        watcher = self.make_watcher(settle_seconds=5)
+        path = os.path.join(self.drop_dir, 'Y01A.CARS.#D.444444.D050214')
+        with open(path, 'w') as f:
+            f.write('VOL1')
+        watcher.file_changed(path)
+
+        mock_monotonic.return_value = 100
+        self.assertEqual(watcher.get_settled_files(), [])
+        # still growing
+        with open(path, 'a') as f:
+            f.write('HDR1')
+        mock_monotonic.return_value = 104
+        self.assertEqual(watcher.get_settled_files(), [])
+        mock_monotonic.return_value = 108
+        self.assertEqual(watcher.get_settled_files(), [])
+        mock_monotonic.return_value = 109
+        self.assertEqual(watcher.get_settled_files(), [path])
+        self.assertEqual(watcher.pending, {})
@@ -0,0 +1,75 @@
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock, TestCase
+
+from mtp_transaction_uploader import settings, upload
+from mtp_transaction_uploader.watermark import UploadWatermark
+
+
+class UploadWatermarkTestCase(TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'watermark.json')
+
+    def test_advance(self):
+        watermark = UploadWatermark(self.path)
+        # nothing to advance from until the date is known from the API
+        watermark.advance(datetime.date(2014, 12, 9))
+        self.assertIsNone(watermark.read())
+
+        watermark.reconcile(None)
+        reconciled_at = watermark.read().reconciled_at
+        watermark.advance(datetime.date(2014, 12, 10))
+        watermark.advance(datetime.date(2014, 12, 9))
+        state = UploadWatermark(self.path).read()
+        self.assertEqual(state.last_date, datetime.date(2014, 12, 10))
+        self.assertEqual(state.reconciled_at, reconciled_at)
+
+    def test_reconcile_and_reset(self):
+        watermark = UploadWatermark(self.path)
+        watermark.reconcile(datetime.date(2014, 12, 10))
+        watermark.advance(datetime.date(2014, 12, 11))
+        watermark.reconcile(datetime.date(2014, 12, 10))
+        self.assertEqual(watermark.read().last_date, datetime.date(2014, 12, 10))
+
+        watermark.reset()
+        self.assertIsNone(watermark.read())
+        watermark.reset()
+
+    def test_corrupt_watermark_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"last_date": "yesterday"')
+        self.assertIsNone(UploadWatermark(self.path).read())
+
+    @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+    def test_last_uploaded_date_read_locally_until_reconciled(self, mock_get_connection):
+        conn = mock_get_connection()
+        conn.transactions.get.return_value = {'results': [{'received_at': '2014-12-09T12:00:00Z'}]}
+
+        with mock.patch.multiple(settings, UPLOAD_WATERMARK_FILE=self.path, UPLOAD_WATERMARK_RECONCILE_SECONDS=60):
+            self.assertEqual(upload.get_last_uploaded_date(), datetime.date(2014, 12, 9))
+            self.assertEqual(conn.transactions.get.call_count, 1)
+
+            upload.advance_upload_watermark('/tmp/Y01A.CARS.#D.444444.D101214')
+            self.assertEqual(upload.get_last_uploaded_date(), datetime.date(2014, 12, 10))
+            self.assertEqual(conn.transactions.get.call_count, 1)
+
+            with mock.patch('mtp_transaction_uploader.watermark.time.time', return_value=time.time() + 61):
+                self.assertEqual(upload.get_last_uploaded_date(), datetime.date(2014, 12, 9))
+            self.assertEqual(conn.transactions.get.call_count, 2)
+
+            upload.reset_upload_watermark()
+            self.assertFalse(os.path.exists(self.path))
+
+    @mock.patch('mtp_transaction_uploader.upload.get_authenticated_connection')
+    def test_watermark_advanced_after_upload(self, mock_get_connection):
+        conn = mock_get_connection()
+        with mock.patch.multiple(settings, UPLOAD_WATERMARK_FILE=self.path):
+            UploadWatermark(self.path).reconcile(datetime.date(2014, 12, 9))
+            upload.post_transactions(conn, '/tmp/Y01A.CARS.#D.444444.D111214', [{'amount': 1, 'category': 'credit'}])
+
+        self.assertEqual(UploadWatermark(self.path).read().last_date, datetime.date(2014, 12, 11))